@@ -0,0 +1,146 @@
+"""
+run mmmeta benchmarks against synthetic archives
+
+    python benchmarks/run.py --sizes 10000,100000 --out bench.json
+
+every step runs in a fresh process to record its wall time and peak RSS
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+# benchmark the current checkout
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from synthetic import churn_archive, generate_archive  # noqa
+
+STEPS = (
+    "generate",
+    "update",
+    "churn",
+    "generate_incremental",
+    "update_incremental",
+    "squash",
+    "load",
+    "iterate",
+    "dump",
+    "inspect",
+)
+
+
+def _step(name, root, params):
+    # imports are part of the measurement (see `inspect`)
+    from mmmeta import mmmeta
+
+    if name == "inspect":
+        from mmmeta.cli import cli
+
+        with open(os.devnull, "w") as sys.stdout:
+            cli(["--metadir", root, "inspect"], standalone_mode=False)
+        return
+
+    m = mmmeta(root)
+    if name in ("generate", "generate_incremental"):
+        m.generate(ensure_metadata=True)
+    elif name in ("update", "update_incremental"):
+        m.update()
+    elif name == "churn":
+        churn_archive(root, **params)
+    elif name == "squash":
+        m.squash()
+    elif name == "load":
+        import dataset
+
+        with dataset.connect("sqlite:///:memory:") as tx:
+            table = tx.get_table(
+                "files", primary_id=m.config.unique, primary_type=tx.types.text
+            )
+            m._metadata.load(table)
+    elif name == "iterate":
+        for file in m.files:
+            file.uid
+    elif name == "dump":
+        with open(os.devnull, "w") as f:
+            m.dump(f)
+
+
+def _run_step(name, root, params, queue):
+    start = time.perf_counter()
+    _step(name, root, params)
+    wall = time.perf_counter() - start
+    # kilobytes on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({"wall": wall, "peak_rss_mb": rss / 1024})
+
+
+def run_step(name, root, params):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_step, args=(name, root, params, queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise click.ClickException(f"Step `{name}` failed.")
+    return queue.get()
+
+
+def run(size, fields, depth, churn, workdir, steps=STEPS):
+    root = tempfile.mkdtemp(prefix=f"mmmeta-bench-{size}-", dir=workdir)
+    params = {"files": size, "fields": fields, "depth": depth, "churn": churn}
+    try:
+        start = time.perf_counter()
+        generate_archive(root, size, fields, depth)
+        result = {
+            "size": size,
+            "fields": fields,
+            "depth": depth,
+            "churn": churn,
+            "setup": time.perf_counter() - start,
+            "steps": {},
+        }
+        for step in steps:
+            result["steps"][step] = run_step(step, root, params)
+            click.echo(f"{size:>9} {step:<22} {_format(result['steps'][step])}")
+        return result
+    finally:
+        shutil.rmtree(root)
+
+
+def _format(res):
+    return f"{res['wall']:>10.2f}s {res['peak_rss_mb']:>10.1f}MB"
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    default="10000,100000,1000000",
+    help="Comma separated list of archive sizes (number of files)",
+    show_default=True,
+)
+@click.option("--fields", default=10, help="Metadata fields", show_default=True)
+@click.option("--depth", default=1, help="Nesting depth", show_default=True)
+@click.option("--churn", default=0.01, help="Churn rate", show_default=True)
+@click.option("--workdir", default=None, help="Directory for the synthetic archives")
+@click.option("--out", default=None, help="Write results as json to this path")
+def cli(sizes, fields, depth, churn, workdir, out):
+    results = []
+    click.echo(f"{'files':>9} {'step':<22} {'wall':>11} {'peak rss':>12}")
+    for size in sizes.split(","):
+        results.append(run(int(size), fields, depth, churn, workdir))
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,103 @@
+"""
+generate synthetic archives (json metadata files) for benchmarking
+"""
+
+import json
+import os
+import random
+from hashlib import sha1
+
+import yaml
+
+
+def make_uid(i, seed=""):
+    return sha1(f"{seed}{i}".encode()).hexdigest()
+
+
+def make_value(rand, depth, kind=0):
+    if depth > 0:
+        return {f"level_{depth}": make_value(rand, depth - 1, kind)}
+    # consistent types per field, as the state db is typed
+    if kind == 0:
+        return f"value {rand.random()}"
+    if kind == 1:
+        return rand.randint(1, 10**6)
+    if kind == 2:
+        return rand.choice(("2021-01-01T12:00:00", "2022-06-01T08:30:00"))
+    return rand.choice(("foo", "bar", "baz", None))
+
+
+def make_record(rand, i, fields=10, depth=0, seed=""):
+    uid = make_uid(i, seed)
+    data = {
+        "content_hash": uid,
+        "_file_name": f"{uid}.pdf",
+        "foreign_id": f"doc-{i}",
+        "published_at": "2021-01-01T12:00:00",
+    }
+    for f in range(fields):
+        # only some fields are nested
+        data[f"field_{f}"] = make_value(rand, depth if f % 3 == 0 else 0, f % 4)
+    return data
+
+
+def get_path(root, uid):
+    # 2-level sharding like most real archives
+    return os.path.join(root, uid[:2], uid[2:4], f"{uid}.json")
+
+
+def write_record(root, data):
+    fp = get_path(root, data["content_hash"])
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with open(fp, "w") as f:
+        json.dump(data, f)
+
+
+def write_config(root, fields=10, depth=0):
+    include = []
+    for f in range(fields):
+        key = f"field_{f}"
+        if depth and f % 3 == 0:
+            key += "".join(f":level_{d}" for d in range(depth, 0, -1))
+        include.append(key)
+    config = {
+        "metadata": {
+            "unique": "content_hash",
+            "file_name": "_file_name",
+            "required": ["foreign_id", "published_at"],
+            "include": include,
+        }
+    }
+    os.makedirs(os.path.join(root, "_mmmeta"), exist_ok=True)
+    with open(os.path.join(root, "_mmmeta", "config.yml"), "w") as f:
+        yaml.dump(config, f)
+
+
+def generate_archive(root, files=10000, fields=10, depth=0, seed=0):
+    """
+    write `files` json metadata files with `fields` fields (every third
+    nested `depth` levels deep) and a matching `_mmmeta/config.yml`
+    """
+    rand = random.Random(seed)
+    write_config(root, fields, depth)
+    for i in range(files):
+        write_record(root, make_record(rand, i, fields, depth))
+
+
+def churn_archive(root, files=10000, fields=10, depth=0, churn=0.01, seed=0):
+    """
+    simulate a publisher run on an archive created with `generate_archive`:
+    change, add and delete `churn` * `files` records (in equal parts)
+    """
+    rand = random.Random(f"churn-{seed}")
+    n = max(int(files * churn) // 3, 1)
+    for i in rand.sample(range(files), n):
+        record = make_record(rand, i, fields, depth)
+        record["foreign_id"] = f"changed-{i}"
+        write_record(root, record)
+    for i in range(files, files + n):
+        write_record(root, make_record(rand, i, fields, depth))
+    for i in rand.sample(range(files), n):
+        fp = get_path(root, make_uid(i))
+        if os.path.exists(fp):
+            os.remove(fp)
@@ -1 +1,7 @@
-from .metadir import Metadir as mmmeta  # noqa
+def __getattr__(name):
+    # import lazily, so that the cli and `mmmeta.settings` start fast
+    if name == "mmmeta":
+        from .metadir import Metadir
+
+        return Metadir
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,23 @@
+from .filesystem import FilesystemBackend
+
+S3_SCHEME = "s3://"
+
+
+def __getattr__(name):
+    # `boto3` is only imported when needed
+    if name == "S3Backend":
+        from .s3 import S3Backend
+
+        return S3Backend
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_backend(path):
+    """
+    return a storage backend for given local path or remote uri
+    """
+    if str(path).startswith(S3_SCHEME):
+        from .s3 import S3Backend
+
+        return S3Backend(path)
+    return FilesystemBackend(path)
@@ -1,36 +1,144 @@
 import csv
+import logging
+import os
+import re
+import socket
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import count
 
-import dataset
+from .. import settings
+from ..util import robust_dict, tmp_db
+from .filesystem import FilesystemBackend, ensure_directory, lock
+from .uids import UidIndex, write_uids
 
-from ..util import robust_dict
-from .filesystem import FilesystemBackend, ensure_directory
+log = logging.getLogger(__name__)
+
+SUFFIXES = ("append", "squashed")
+LOCK = ".lock"
+UIDS = "uids"
+
+_sequence = count()
+
+
+def parse_segment(path, unique):
+    """
+    parse and normalize the rows of the segment at `path` and merge the rows
+    of the same `unique` key (in order, like upserting them one by one), so
+    that only one compact row per file is passed back from a worker process
+    """
+    rows = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            row = _normalize(row, unique)
+            uid = row.get(unique)
+            if uid in rows:
+                rows[uid].update(row)
+            else:
+                rows[uid] = row
+    return list(rows.values())
+
+
+def _normalize(row, unique):
+    row = robust_dict(row)
+    keys = row.get("__mmmeta_keys")
+    if keys:
+        keys = keys.split(",") + [unique]
+        row = {k: v for k, v in row.items() if k in keys}
+    return row
+
+
+def get_writer_id():
+    """
+    identify this writer in segment names, defaults to `<hostname>_<pid>`
+    """
+    writer_id = settings.MMMETA_WRITER_ID or f"{socket.gethostname()}_{os.getpid()}"
+    return re.sub(r"[^A-Za-z0-9_]", "_", writer_id)
 
 
 class AppendOnlyBackend(FilesystemBackend):
-    def __init__(self, base_path, unique):
+    """
+    segments are named `<timestamp>-<writer id>-<sequence>.<suffix>`, so
+    multiple writers (publishers) can append to the same metadir concurrently
+    and the history is ordered deterministically by name
+    """
+
+    def __init__(self, base_path, unique, writer_id=None, workers=None):
         super().__init__(base_path)
         self.unique = unique
+        self.writer_id = writer_id or get_writer_id()
+        # processes for parsing segments in `load`
+        self.workers = workers or settings.MMMETA_LOAD_WORKERS
+        # segments replayed by the last `load` and written since
+        self._replayed = None
 
     def _get_table(self, tx, name="tmp"):
         return tx.get_table(name, primary_id=self.unique, primary_type=tx.types.text)
 
+    def get_children(
+        self, path=".", condition=None, exclude=(), suffix=SUFFIXES, workers=None
+    ):
+        """list segments only (no lock or temporary files)"""
+        return super().get_children(path, condition, exclude, suffix, workers)
+
+    def lock(self, exclusive=False):
+        """
+        advisory lock on the metadata db: appending segments requires a shared
+        lock, read-modify-write operations (like squash) an exclusive one
+        """
+        return lock(self.get_path(LOCK), exclusive)
+
+    def get_segment_name(self, suffix="append"):
+        ts = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        return f"{ts}-{self.writer_id}-{next(_sequence):06d}.{suffix}"
+
     def write(self, table, suffix="append"):
-        fp = self.get_path(datetime.now().isoformat() + f".{suffix}")
+        """
+        write rows from `table` (or any iterable of dicts) to a new segment
+        and return its path (or `None` if there were no rows)
+        """
+        with self.lock():
+            return self._write(table, suffix)
+
+    def _write(self, table, suffix="append", empty=False):
         ensure_directory(self.base_path)  # FIXME
         if hasattr(table, "all"):  # FIXME
             table = table.all()
         try:
             # maybe we have 0 rows:
             data = next(table)
-            with open(fp, "w") as f:
-                writer = csv.DictWriter(f, fieldnames=data.keys())
-                writer.writeheader()
-                writer.writerow(data)
-                for data in table:
-                    writer.writerow(data)
         except StopIteration:
-            pass
+            if not empty:
+                return
+            # e.g. a squashed segment still cuts off the history before it
+            data = None
+        # the timestamp is taken under the lock, so that no segment older
+        # than a squashed one can appear after squashing
+        fp = self.get_path(self.get_segment_name(suffix))
+        tmp_fp = os.path.join(self.base_path, f".{os.path.basename(fp)}.tmp")
+        with open(tmp_fp, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=(data or {self.unique: None}).keys())
+            writer.writeheader()
+            if data is not None:
+                writer.writerow(data)
+            for data in table:
+                writer.writerow(data)
+        # readers only ever see complete segments
+        os.replace(tmp_fp, fp)
+        if self._replayed is not None:
+            self._replayed.add(fp)
+        return fp
+
+    def has_new_segments(self):
+        """
+        if other writers appended segments since the last `load` (so data
+        derived from its table is outdated), call it under the exclusive lock
+        """
+        if self._replayed is None:
+            return True
+        return not set(self.get_steps()) <= self._replayed
 
     def load_step(self, path):
         path = self.get_path(path)
@@ -38,33 +146,177 @@ class AppendOnlyBackend(FilesystemBackend):
             reader = csv.DictReader(f)
             yield from reader
 
-    def load(self, table):
+    def get_steps(self):
         """
         files are named by timestamp, so we can order the history
-        walk up until the most recent squashed, then walk back down
-        from there to generate data
+        walk up until the most recent squashed and return the paths of the
+        segments to replay from there in order
         """
 
         def _get_steps():
-            steps = reversed(sorted(c[1] for c in self.get_children()))
+            # concurrent segments are merged by (timestamp, writer id, sequence)
+            steps = sorted(
+                (c[1] for c in self.get_children()),
+                key=os.path.basename,
+                reverse=True,
+            )
             for step in steps:
-                if step.endswith("append"):
-                    yield step
+                yield step
                 if step.endswith("squashed"):
-                    yield step
                     break
 
-        for step in reversed(list(_get_steps())):
-            for row in self.load_step(step):
-                row = robust_dict(row)
-                keys = row.get("__mmmeta_keys")
-                if keys:
-                    keys = keys.split(",") + [self.unique]
-                    row = {k: v for k, v in row.items() if k in keys}
+        return list(reversed(list(_get_steps())))
+
+    def load(self, table):
+        """
+        replay the history from the most recent squashed segment into `table`.
+        with more than one `workers`, the segments are parsed in parallel
+        processes. returns the size of the replayed segments in bytes
+
+        the shared lock keeps `squash` from removing the segments while they
+        are read
+        """
+        with self.lock():
+            return self._load(table)
+
+    def _load(self, table):
+        steps = self.get_steps()
+        self._replayed = set(steps)
+        size = sum(os.path.getsize(s) for s in steps)
+        if self.workers > 1 and len(steps) > 1:
+            rows = (r for rows in self._parse_parallel(steps) for r in rows)
+        else:
+            rows = (
+                _normalize(r, self.unique) for s in steps for r in self.load_step(s)
+            )
+        with warnings.catch_warnings():
+            # only this thread writes, but dataset warns about schema changes
+            # as soon as the thread of a process pool is running
+            warnings.filterwarnings(
+                "ignore", "Changing the database schema", RuntimeWarning
+            )
+            for row in rows:
                 table.upsert(row, [self.unique])
+        return size
+
+    def _parse_parallel(self, steps):
+        """
+        yield the parsed rows per segment in order, at most 2 segments per
+        worker are parsed ahead to bound memory
+        """
+        workers = min(self.workers, len(steps))
+        with ProcessPoolExecutor(workers) as executor:
+            pending = deque()
+            for step in steps:
+                pending.append(executor.submit(parse_segment, step, self.unique))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
 
-    def squash(self):
-        with dataset.connect("sqlite:///:memory:") as tx:
-            table = self._get_table(tx)
-            self.load(table)
-            self.write(table, "squashed")
+    def squash(
+        self,
+        tempdir=None,
+        memory_limit=None,
+        purge_before=None,
+        history=None,
+        on_squashed=None,
+    ):
+        """
+        replace the history with one squashed segment, see `util.tmp_db` for
+        `tempdir` and `memory_limit`. files soft deleted before `purge_before`
+        are purged, `history` is the number of squashed segments to keep
+        (older segments are removed). `on_squashed(table)` is called with the
+        squashed data (e.g. to write statistics)
+        """
+        with self.lock(exclusive=True):
+            with tmp_db(tempdir, memory_limit) as tx:
+                table = self._get_table(tx)
+                self._load(table)
+                purged = 0
+                if purge_before is not None:
+                    purged = self._purge(table, purge_before)
+                fp = self._write(table, "squashed", empty=purged > 0)
+                self.write_uids(table)
+                if on_squashed is not None:
+                    on_squashed(table)
+            if history is not None:
+                self._prune(history)
+            return fp
+
+    def _purge(self, table, before):
+        """
+        remove the files soft deleted before `before` from `table`
+        """
+        if not table.has_column("__deleted_at"):
+            return 0
+        # timestamps are strings in the segments, in sortable iso format
+        filters = {"__deleted": {"not": None}, "__deleted_at": {"lt": str(before)}}
+        purged = table.count(**filters)
+        if purged:
+            table.delete(**filters)
+            log.info(f"Purged {purged} files deleted before {before}.")
+        return purged
+
+    def _prune(self, history):
+        """
+        remove the segments before the `history` most recent squashed ones
+        """
+        steps = sorted((c[1] for c in self.get_children()), key=os.path.basename)
+        squashed = [os.path.basename(s) for s in steps if s.endswith("squashed")]
+        if len(squashed) < history:
+            return []
+        first = squashed[-history]
+        pruned = [s for s in steps if os.path.basename(s) < first]
+        for step in pruned:
+            os.remove(step)
+        log.info(f"Removed {len(pruned)} segments before `{first}`.")
+        return pruned
+
+    def write_uids(self, table):
+        """
+        write the sorted uids of all not deleted files in `table` for fast
+        membership lookups without a state db. the caller needs to hold the
+        exclusive lock, so that no segment is appended in between
+        """
+        from sqlalchemy import select
+
+        column = table.table.c[self.unique]
+        query = select(column)
+        if table.has_column("__deleted"):
+            query = query.where(table.table.c["__deleted"].is_(None))
+        uids = (row[self.unique] for row in table.db.query(query))
+        return write_uids(self.get_path(UIDS), uids)
+
+    def get_uids(self):
+        """
+        return the `UidIndex`, it is (re)built from the segments if missing or
+        outdated
+        """
+        index = getattr(self, "_uids", None)
+        outdated = self._uids_outdated()
+        if index is not None and index.is_current() and not outdated:
+            return index
+        if outdated:
+            import dataset
+
+            with self.lock(exclusive=True):
+                if self._uids_outdated():
+                    with dataset.connect("sqlite:///:memory:") as tx:
+                        table = self._get_table(tx)
+                        self._load(table)
+                        self.write_uids(table)
+        self._uids = UidIndex(self.get_path(UIDS))
+        return self._uids
+
+    def _uids_outdated(self):
+        """
+        the index is missing or a segment appeared after it was written (e.g.
+        by another writer or pulled via sync). compare the change times, as
+        copies can keep the modification time of the original
+        """
+        try:
+            written = os.stat(self.get_path(UIDS)).st_ctime_ns
+        except FileNotFoundError:
+            return True
+        return any(os.stat(fp).st_ctime_ns > written for _, fp in self.get_children())
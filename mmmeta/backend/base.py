@@ -7,7 +7,7 @@ from ..util import cast, datetime_to_json
 class Backend:
     """
     base class for metadir backends.
-    currently only local filesystem backend implemented.
+    implemented: local filesystem, s3 compatible object storage
     """
 
     def __init__(self, data_root):
@@ -34,8 +34,8 @@ class Backend:
 
     def save(self, path, content):
         """
-        store `content` in path and return absolute path to stored file or
-        cloud blob location
+        store `content` (string or bytes) in path and return absolute path to
+        stored file or cloud blob location
         """
         raise NotImplementedError
 
@@ -48,9 +48,21 @@ class Backend:
             raise FileNotFoundError(f"Path `{path}` not found in storage `{self}`")
         return self._load(path)
 
+    def load_bytes(self, path):
+        """return raw content as bytes for given path"""
+        raise NotImplementedError
+
     def load_json(self, path):
         return json.loads(self.load(path))
 
+    def load_many(self, paths, workers=None):
+        """
+        yield tuples of (path, content) for given `paths` in order, remote
+        backends can prefetch them concurrently with `workers` threads
+        """
+        for path in paths:
+            yield path, self.load(path)
+
     def dump_json(self, path, content):
         content = json.dumps(content, default=datetime_to_json)
         self.save(path, content)
@@ -71,8 +83,12 @@ class Backend:
         content = self.load(path)
         return transform(content)
 
-    def get_children(self, path=".", condition=lambda x: True):
-        """list all children under given path that match condition"""
+    def get_children(self, path=".", condition=None, exclude=(), suffix=None):
+        """
+        list all children under given path that match condition (a callable
+        on the full path) and file name `suffix`, skipping any directories
+        (or prefixes) named in `exclude`
+        """
         raise NotImplementedError
 
     def delete(self, path=""):
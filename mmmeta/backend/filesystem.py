@@ -1,17 +1,41 @@
 import os
 import shutil
+from contextlib import contextmanager
 
-from ..util import get_files
+from .. import settings
+from ..util import get_files, walk_files
 from .base import Backend
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 
 def ensure_directory(fp):
     fp = os.path.abspath(fp)
     if not os.path.isdir(fp):
-        os.makedirs(fp)
+        os.makedirs(fp, exist_ok=True)
     return fp
 
 
+@contextmanager
+def lock(fp, exclusive=True):
+    """
+    advisory lock (via `flock`) on the file at `fp`, shared or exclusive.
+    no-op on platforms without `fcntl`
+    """
+    ensure_directory(os.path.split(fp)[0])
+    with open(fp, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield f
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
 class FilesystemBackend(Backend):
     def get_base_path(self):
         return ensure_directory(self.data_root)
@@ -23,20 +47,43 @@ class FilesystemBackend(Backend):
     def save(self, path, content):
         path = self.get_path(path)
         ensure_directory(os.path.split(path)[0])
+        if isinstance(content, bytes):
+            # write binary content atomically
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            return path
         with open(path, "w") as f:
             content = str(content)
             f.write(content)
         return path
 
+    def load_bytes(self, path):
+        with open(self.get_path(path), "rb") as f:
+            return f.read()
+
     def _load(self, path):
         path = self.get_path(path)
         with open(path) as f:
             content = f.read().strip()
         return content
 
-    def get_children(self, path=".", condition=lambda x: True):
+    def get_children(
+        self, path=".", condition=None, exclude=(), suffix=None, workers=None
+    ):
+        path = self.get_path(path)
+        workers = workers or settings.MMMETA_WALK_WORKERS
+        return get_files(path, condition, exclude, suffix, workers)
+
+    def get_entries(self, path=".", exclude=(), suffix=None, workers=None):
+        """
+        yield `os.DirEntry` objects (with cached stat results) for all files
+        under given path
+        """
         path = self.get_path(path)
-        return get_files(path, condition)
+        workers = workers or settings.MMMETA_WALK_WORKERS
+        return walk_files(path, exclude, suffix, workers)
 
     def delete(self, path=""):
         path = self.get_path(path)
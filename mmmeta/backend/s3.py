@@ -0,0 +1,157 @@
+import posixpath
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from .. import settings
+from ..exceptions import ConfigError
+from . import S3_SCHEME as SCHEME
+from .base import Backend
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+
+MISSING = ("NoSuchKey", "404")
+
+
+def parse_uri(uri):
+    """return (bucket, key) for given `s3://bucket/key` uri"""
+    uri = urlparse(uri)
+    return uri.netloc, uri.path.strip("/")
+
+
+class S3Backend(Backend):
+    """
+    backend for s3 compatible object storages, `data_root` is an uri like
+    `s3://bucket/prefix`. set `MMMETA_S3_ENDPOINT_URL` for other storages
+    than aws (minio, ...)
+    """
+
+    def __init__(self, data_root, workers=None, page_size=None):
+        if boto3 is None:
+            raise ConfigError(
+                "Install `boto3` to use s3 storage: `pip install mmmeta[s3]`"
+            )
+        self.workers = workers or settings.MMMETA_S3_WORKERS
+        # keys per listing request (default: 1000)
+        self.page_size = page_size
+        self.bucket, self.prefix = parse_uri(data_root)
+        # one http connection per prefetch worker
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=settings.MMMETA_S3_ENDPOINT_URL,
+            config=BotoConfig(max_pool_connections=self.workers),
+        )
+        super().__init__(data_root)
+
+    def get_base_path(self):
+        return self.get_uri(self.prefix)
+
+    def get_uri(self, key):
+        return f"{SCHEME}{self.bucket}/{key}"
+
+    def get_key(self, path):
+        """return object key for relative `path` or absolute uri"""
+        if path.startswith(SCHEME):
+            bucket, key = parse_uri(path)
+            if bucket != self.bucket:
+                raise ValueError(f"Path `{path}` not in bucket `{self.bucket}`")
+            return key
+        key = posixpath.normpath(posixpath.join(self.prefix, path))
+        return "" if key == "." else key
+
+    def get_path(self, path):
+        return self.get_uri(self.get_key(path))
+
+    def exists(self, path):
+        key = self.get_key(path)
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            # permission errors, throttling, ... are not a missing object
+            if e.response["Error"]["Code"] not in MISSING:
+                raise
+            # maybe a "directory"
+            for _ in self._list(key + "/", max_keys=1):
+                return True
+            return False
+
+    def save(self, path, content):
+        key = self.get_key(path)
+        if not isinstance(content, bytes):
+            content = str(content).encode()
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=content)
+        return self.get_uri(key)
+
+    def _load(self, path):
+        return self.load_bytes(path).decode().strip()
+
+    def load_bytes(self, path):
+        # spare the extra `exists` request
+        try:
+            res = self.client.get_object(Bucket=self.bucket, Key=self.get_key(path))
+            return res["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in MISSING:
+                raise FileNotFoundError(f"Path `{path}` not found in storage `{self}`")
+            raise
+
+    def load(self, path):
+        return self._load(path)
+
+    def load_many(self, paths, workers=None):
+        workers = workers or self.workers
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # bounded prefetch window to keep memory constant
+            window = deque()
+            for path in paths:
+                window.append((path, executor.submit(self.load, path)))
+                if len(window) >= workers * 2:
+                    path, future = window.popleft()
+                    yield path, future.result()
+            while window:
+                path, future = window.popleft()
+                yield path, future.result()
+
+    def _list(self, prefix, max_keys=None):
+        paginator = self.client.get_paginator("list_objects_v2")
+        params = {"Bucket": self.bucket, "Prefix": prefix, "PaginationConfig": {}}
+        if max_keys is not None:
+            params["PaginationConfig"]["MaxItems"] = max_keys
+        if self.page_size is not None:
+            params["PaginationConfig"]["PageSize"] = self.page_size
+        for page in paginator.paginate(**params):
+            for obj in page.get("Contents", []):
+                yield obj
+
+    def get_children(self, path=".", condition=None, exclude=(), suffix=None):
+        prefix = self.get_key(path)
+        prefix = prefix + "/" if prefix else ""
+        exclude = set(exclude)
+        for obj in self._list(prefix):
+            key = obj["Key"]
+            parts = key[len(prefix) :].split("/")
+            if exclude.intersection(parts[:-1]):
+                continue
+            name = parts[-1]
+            if suffix is not None and not name.endswith(suffix):
+                continue
+            uri = self.get_uri(key)
+            if condition is None or condition(uri):
+                yield posixpath.splitext(name)[0], uri
+
+    def delete(self, path=""):
+        key = self.get_key(path)
+        keys = [key] if key else []
+        keys += [o["Key"] for o in self._list(key + "/" if key else "")]
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in keys[i : i + 1000]]},
+            )
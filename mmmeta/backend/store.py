@@ -23,10 +23,14 @@ class Store:
         return self._backend.get_value(attr)
 
     def __setitem__(self, attr, value=""):
+        self.set_value(attr, value)
+        self.touch()
+
+    def set_value(self, attr, value=""):
+        """set `attr` without touching `store_last_updated`"""
         if "/" in attr:
             raise StoreError(f"illegal key: {attr}")
         self._backend.set_value(attr, value)
-        self.touch()
 
     def __iter__(self):
         for key, _ in self._backend.get_children():
@@ -0,0 +1,80 @@
+import mmap
+import os
+
+
+def write_uids(path, uids):
+    """
+    atomically write `uids` as a sorted, newline separated file
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        for uid in sorted(str(u).encode() for u in uids):
+            f.write(uid + b"\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+class UidIndex:
+    """
+    membership lookups in a sorted uid file (see `write_uids`) via binary
+    search on a memory map, so nothing needs to be loaded into memory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat.st_size:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._data = b""
+
+    def __len__(self):
+        count, pos = 0, self._data.find(b"\n")
+        while pos > -1:
+            count += 1
+            pos = self._data.find(b"\n", pos + 1)
+        return count
+
+    def __contains__(self, uid):
+        return self._search(str(uid).encode())[0]
+
+    def _search(self, uid, lo=0):
+        """
+        return (found, offset of the first line >= `uid`), start at line
+        offset `lo`
+        """
+        data = self._data
+        hi = len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", lo, mid) + 1 or lo
+            end = data.find(b"\n", start)
+            if data[start:end] < uid:
+                lo = end + 1
+            else:
+                hi = start
+        end = data.find(b"\n", lo)
+        return end > -1 and data[lo:end] == uid, lo
+
+    def contains_many(self, uids):
+        """
+        return the subset of `uids` that exist
+        """
+        found = set()
+        uids = {str(u): u for u in uids}
+        lo = 0
+        # sorted lookups only need to search the remaining part
+        for key in sorted(uids, key=str.encode):
+            exists, lo = self._search(key.encode(), lo)
+            if exists:
+                found.add(uids[key])
+        return found
+
+    def is_current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return self.key == (stat.st_ino, stat.st_mtime_ns, stat.st_size)
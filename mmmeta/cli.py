@@ -1,12 +1,16 @@
 import logging
+from contextlib import contextmanager
+from types import SimpleNamespace
 
 import click
 
-from mmmeta import mmmeta, settings
-from mmmeta.logging import configure_logging
+from mmmeta import settings
 
 log = logging.getLogger(__name__)
 
+# commands that don't need (structured) logging, to start fast
+LIGHT_COMMANDS = ("inspect",)
+
 
 @click.group()
 @click.option(
@@ -27,14 +31,77 @@ log = logging.getLogger(__name__)
     help="Set logging level",
     show_default=True,
 )
+@click.option(
+    "--log-queue",
+    is_flag=True,
+    default=settings.LOG_QUEUE,
+    help="Format and write logs in a background thread",
+    show_default=True,
+)
+@click.option(
+    "--profile",
+    type=click.Choice(("cpu", "memory")),
+    help="Profile the command (cpu: pstats file, memory: top allocations report)",
+)
+@click.option(
+    "--profile-out",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Path for the profile [default: ./mmmeta-<profile>.prof|txt]",
+)
 @click.pass_context
-def cli(ctx, metadir, files_root, log_level, invoke_without_command=True):
-    configure_logging(log_level)
+def cli(
+    ctx,
+    metadir,
+    files_root,
+    log_level,
+    log_queue,
+    profile,
+    profile_out,
+    invoke_without_command=True,
+):
+    if ctx.invoked_subcommand not in LIGHT_COMMANDS:
+        from mmmeta.logging import configure_logging
+
+        configure_logging(log_level, use_queue=log_queue)
+    if profile:
+        from mmmeta.profiling import Profiler
+
+        profiler = Profiler(profile, profile_out).start()
+        # also on failures, to profile what went wrong
+        ctx.call_on_close(profiler.stop)
     if not metadir:
         raise click.BadParameter("Missing metadir root")
     if ctx.obj is None:
         ctx.obj = {}
-    ctx.obj["m"] = mmmeta(metadir)
+    ctx.obj["metadir"] = metadir
+
+
+def _get_metadir(ctx):
+    """
+    initialize the metadir on first use
+    """
+    if "m" not in ctx.obj:
+        from mmmeta import mmmeta
+
+        ctx.obj["m"] = mmmeta(ctx.obj["metadir"])
+    return ctx.obj["m"]
+
+
+@contextmanager
+def _report(m, command, stats_json=None, metrics_textfile=None):
+    """
+    write run stats and metrics after a (failed) run
+    """
+    report = SimpleNamespace(stats=None)
+    try:
+        yield report
+    finally:
+        if stats_json and report.stats is not None:
+            report.stats.to_json(stats_json)
+        if metrics_textfile:
+            from mmmeta.metrics import write_textfile
+
+            write_textfile(metrics_textfile, m, command, report.stats)
 
 
 @cli.command()
@@ -66,10 +133,70 @@ def cli(ctx, metadir, files_root, log_level, invoke_without_command=True):
     help="Read in actual files instead of json metadata files",
     show_default=True,
 )
+@click.option(
+    "--from-ndjson",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="Read metadata records from a (gzipped) newline delimited json file or `-` for stdin",  # noqa
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    help="Write a segment for each chunk of records (only with `--from-ndjson`)",
+)
+@click.option(
+    "--tempdir",
+    default=settings.MMMETA_TEMPDIR,
+    type=click.Path(file_okay=False),
+    help="Use a temporary database file in this directory instead of memory",
+)
+@click.option(
+    "--memory-limit",
+    default=settings.MMMETA_MEMORY_LIMIT,
+    help="Use a temporary database file with at most this page cache (like `512M`) instead of memory",  # noqa
+)
+@click.option(
+    "--stats-json",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write run statistics (counters and per-phase timings) as json to this path",  # noqa
+)
+@click.option(
+    "--metrics-textfile",
+    default=settings.MMMETA_METRICS_TEXTFILE,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write prometheus metrics to this path (for node-exporter textfile collector), `{command}` is replaced with the command",  # noqa
+)
 @click.pass_context
-def generate(ctx, replace, ensure, ensure_files, no_meta):
+def generate(
+    ctx,
+    replace,
+    ensure,
+    ensure_files,
+    no_meta,
+    from_ndjson,
+    chunk_size,
+    tempdir,
+    memory_limit,
+    stats_json,
+    metrics_textfile,
+):
     path = None  # FIXME
-    ctx.obj["m"].generate(path, replace, ensure, ensure_files, no_meta)
+    m = _get_metadir(ctx)
+    if from_ndjson and (ensure_files or no_meta):
+        raise click.BadParameter(
+            "`--from-ndjson` can't be combined with `--ensure-files` or `--no-meta`"
+        )
+    with _report(m, "generate", stats_json, metrics_textfile) as report:
+        if from_ndjson:
+            from mmmeta.util import read_ndjson
+
+            records = read_ndjson(from_ndjson)
+            report.stats = m.ingest(
+                records, ensure, chunk_size, replace, tempdir, memory_limit
+            )
+        else:
+            report.stats = m.generate(
+                path, replace, ensure, ensure_files, no_meta, tempdir, memory_limit
+            )
 
 
 @cli.command()
@@ -87,27 +214,125 @@ def generate(ctx, replace, ensure, ensure_files, no_meta):
     help="Try to do some data migrations, can be helpful when things break.",
     show_default=True,
 )
+@click.option(
+    "--swap",
+    is_flag=True,
+    default=False,
+    help="Build the new state in a copy of the state db and swap it in at the end, so that consumers are not blocked",  # noqa
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    help="Commit in chunks of this many files, an interrupted update resumes from the last chunk",  # noqa
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    help="Partition the state db into this many files by a hash of the unique key, updated in parallel (1: single state db)",  # noqa
+)
+@click.option(
+    "--stats-json",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write run statistics (counters and per-phase timings) as json to this path",  # noqa
+)
+@click.option(
+    "--metrics-textfile",
+    default=settings.MMMETA_METRICS_TEXTFILE,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write prometheus metrics to this path (for node-exporter textfile collector), `{command}` is replaced with the command",  # noqa
+)
 @click.pass_context
-def update(ctx, replace, cleanup):
-    ctx.obj["m"].update(replace, cleanup)
+def update(
+    ctx, replace, cleanup, swap, chunk_size, shards, stats_json, metrics_textfile
+):
+    if swap and chunk_size:
+        raise click.BadParameter("`--swap` can't be combined with `--chunk-size`")
+    m = _get_metadir(ctx)
+    with _report(m, "update", stats_json, metrics_textfile) as report:
+        report.stats = m.update(replace, cleanup, swap, chunk_size, shards)
 
 
 @cli.command()
+@click.option(
+    "--stats", is_flag=True, default=False, help="Show precomputed statistics"
+)
 @click.pass_context
-def inspect(ctx):
-    meta = ctx.obj["m"]
-    for key, value in meta.inspect().items():
-        click.echo(f"{key}: {value}")
+def inspect(ctx, stats):
+    meta = _get_metadir(ctx)
+    for key, value in meta.inspect(stats).items():
+        if isinstance(value, dict):
+            click.echo(f"{key}:")
+            for name, count in sorted(value.items()):
+                click.echo(f"  {name}: {count}")
+        else:
+            click.echo(f"{key}: {value}")
     click.echo(f"{meta.store.to_string()}")
 
 
 @cli.command()
+@click.option(
+    "--tempdir",
+    default=settings.MMMETA_TEMPDIR,
+    type=click.Path(file_okay=False),
+    help="Use a temporary database file in this directory instead of memory",
+)
+@click.option(
+    "--memory-limit",
+    default=settings.MMMETA_MEMORY_LIMIT,
+    help="Use a temporary database file with at most this page cache (like `512M`) instead of memory",  # noqa
+)
 @click.pass_context
-def squash(ctx):
-    ctx.obj["m"].squash()
+def squash(ctx, tempdir, memory_limit):
+    _get_metadir(ctx).squash(tempdir, memory_limit)
 
 
 @cli.command()
+@click.option(
+    "-c", "--column", "columns", multiple=True, help="Only dump these columns"
+)
+@click.pass_context
+def dump(ctx, columns):
+    _get_metadir(ctx).dump(columns=columns or None)
+
+
+@cli.group()
+def sync():
+    """
+    Synchronize metadir with a remote archive (path or uri)
+    """
+
+
+@sync.command()
+@click.argument("remote", default=settings.MMMETA_REMOTE, required=False)
+@click.option(
+    "--workers",
+    default=8,
+    help="Number of parallel uploads",
+    show_default=True,
+)
+@click.pass_context
+def push(ctx, remote, workers):
+    if not remote:
+        raise click.BadParameter("Missing remote")
+    res = _get_metadir(ctx).push(remote, workers)
+    click.echo(
+        f"Pushed {res['transferred']} of {res['total']} files ({res['bytes']} bytes)"
+    )
+
+
+@sync.command()
+@click.argument("remote", default=settings.MMMETA_REMOTE, required=False)
+@click.option(
+    "--workers",
+    default=8,
+    help="Number of parallel downloads",
+    show_default=True,
+)
 @click.pass_context
-def dump(ctx):
-    ctx.obj["m"].dump()
+def pull(ctx, remote, workers):
+    if not remote:
+        raise click.BadParameter("Missing remote")
+    res = _get_metadir(ctx).pull(remote, workers)
+    click.echo(
+        f"Pulled {res['transferred']} of {res['total']} files ({res['bytes']} bytes)"
+    )
@@ -1,5 +1,10 @@
-import yaml
-from banal import ensure_dict, ensure_list
+from datetime import timedelta
+from functools import cached_property
+
+from banal import as_bool, ensure_dict, ensure_list
+
+from .exceptions import ConfigError
+from .util import HASH_ALGORITHMS, get_projection
 
 
 class Config:
@@ -19,6 +24,15 @@ class Config:
     remote:
       url: https://my_bucket.s3.eu-central-1.amazonaws.com/foo/bar/{_file_name}
       uri: s3://my_bucket/foo/bar/{_file_name}
+    hashing:
+      algorithm: sha256
+      prehash: true
+    statistics:
+      facets:
+      - document_type
+    retention:
+      tombstones: 30  # days
+      history: 2  # squashed segments
     """
 
     def __init__(self, m):
@@ -26,11 +40,36 @@ class Config:
         self._config = {}
         config_path = m._backend.get_path("config.yml")
         if m._backend.exists(config_path):
+            import yaml
+
             with open(config_path) as f:
                 config = yaml.safe_load(f)
             self._config = ensure_dict(config)
         self._metadata = ensure_dict(self["metadata"])
         self._remote = ensure_dict(self["remote"])
+        self._hashing = ensure_dict(self["hashing"])
+        self._statistics = ensure_dict(self["statistics"])
+        self._retention = ensure_dict(self["retention"])
+        for key in ("tombstones", "history"):
+            value = self._retention.get(key)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise ConfigError(
+                    f"Invalid retention `{key}`: `{value}`, use a number >= 0"
+                )
+        if self.history == 0:
+            raise ConfigError("Retention `history` needs to keep at least 1 segment")
+        # consumers can write any other column, which `update` doesn't account
+        facets = set(self.facets) - self.keys
+        if facets:
+            raise ConfigError(
+                f"Statistics facets need to be metadata keys (`required` or `include`): {', '.join(sorted(facets))}"  # noqa
+            )
+        if self.hash_algorithm not in HASH_ALGORITHMS:
+            raise ConfigError(
+                f"Invalid hash algorithm `{self.hash_algorithm}`, use one of: {', '.join(HASH_ALGORITHMS)}"  # noqa
+            )
 
     def __getitem__(self, item):
         return self._config.get(item)
@@ -67,6 +106,36 @@ class Config:
 
         return set(_get_keys())
 
+    @cached_property
+    def projection(self):
+        """prefix tree of `keys` to only parse these from metadata"""
+        return get_projection(self.keys)
+
+    @property
+    def facets(self):
+        """metadata keys to count active files per value for in the statistics"""
+        return ensure_list(self._statistics.get("facets"))
+
+    @property
+    def tombstones(self):
+        """keep soft deleted files in the history for this long (`None`: forever)"""
+        days = self._retention.get("tombstones")
+        if days is not None:
+            return timedelta(days=days)
+
+    @property
+    def history(self):
+        """number of squashed segments to keep on squash (`None`: all)"""
+        return self._retention.get("history")
+
+    @property
+    def hash_algorithm(self):
+        return self._hashing.get("algorithm", "sha1")
+
+    @property
+    def prehash(self):
+        return as_bool(self._hashing.get("prehash"))
+
     def get_remote(self, data):
         """
         compute a remote url or uris with simple string replacement from
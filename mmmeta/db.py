@@ -1,89 +1,185 @@
 import logging
+import os
+import re
+import sqlite3
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from datetime import datetime
-from itertools import chain
-from pathlib import Path
+from itertools import chain, islice
 
 import dataset
 from banal import ensure_dict
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 
-from .exceptions import ValidationError
-from .util import casted_dict, checksum, dict_diff, dict_is_subset, robust_dict
+from . import profiling, settings
+from .backend.appendonly import UIDS
+from .exceptions import ConfigError, ValidationError
+from .file import ensure_changes_index
+from .shards import (
+    MARKER,
+    STATE_DB,
+    get_db_name,
+    get_migration,
+    get_name,
+    get_names,
+    get_shard,
+)
+from .statistics import FILE as STATISTICS
+from .statistics import add_change, compute, update_table, write_file
+from .stats import RunStats
+from .util import (
+    casted_dict,
+    checksum,
+    dict_diff,
+    dict_is_subset,
+    prehash,
+    robust_dict,
+    robust_projection,
+    tmp_db,
+)
 
 log = logging.getLogger(__name__)
 
+CHECKPOINT = "update_checkpoint"
+INSERT_CHUNK = 10_000  # bulk insert new files in chunks to bound memory
+# the name of a created table or index in its `CREATE` statement
+SCHEMA_NAME = re.compile(
+    r"^(CREATE\s+(?:UNIQUE\s+)?(?:TABLE|INDEX)\s+(?:IF\s+NOT\s+EXISTS\s+)?)", re.I
+)
 
-def _upsert(tx, metadir, files, prefix, ts, ensure=False, casted=False):
+
+def _upsert(
+    tx,
+    metadir,
+    files,
+    prefix,
+    ts,
+    ensure=False,
+    casted=False,
+    stats=None,
+    sweep=True,
+    statistics=None,
+):
     # use explicit operations instead of upsert_many to be able to set some
-    # more metadata
+    # more metadata. if a `statistics` counter is given, the changes for the
+    # precomputed statistics are accounted in it
+    stats = stats or RunStats(prefix)
+    facets = metadir.config.facets
+    unique = metadir.config.unique
+    validate = metadir.files.validate
     table = tx["files"]
     to_insert = []
-    updated = added = invalid = deleted = skipped = 0
     ignore_seen = set((("__seen", ts),))
-    for file in files:
+    for file in stats.iterate("load", files):
         if casted:
-            file = casted_dict(file)
+            with stats.phase("cast"):
+                file = casted_dict(file)
         if ensure:
             file["__seen"] = ts  # helper to do a quick scan later
         try:
-            metadir.files.validate(file)
-            uid = file[metadir.config.unique]
-            existing_file = table.find_one(**{metadir.config.unique: uid})
+            validate(file)
+            uid = file[unique]
+            with stats.phase("lookup") as phase:
+                existing_file = table.find_one(**{unique: uid})
+                phase.rows += 1
             if existing_file:
                 if dict_is_subset(file, existing_file, ignore_seen):
-                    skipped += 1
+                    stats.count("skipped")
                 else:
+                    file[f"__{prefix}_last_updated"] = ts
                     if file.get("__deleted", None) is not None:
-                        deleted += 1
+                        stats.count("deleted")
                     else:
-                        file[f"__{prefix}_last_updated"] = ts
-                        updated += 1
-                table.upsert(file, [metadir.config.unique])
+                        stats.count("updated")
+                    if statistics is not None:
+                        new_file = {**existing_file, **file}
+                        add_change(statistics, existing_file, new_file, facets)
+                with stats.phase("upsert") as phase:
+                    table.upsert(file, [unique])
+                    phase.rows += 1
             else:
                 file[f"__{prefix}_added"] = ts
                 file[f"__{prefix}_last_updated"] = ts
                 to_insert.append(file)
-                added += 1
+                stats.count("added")
+                if statistics is not None:
+                    add_change(statistics, None, file, facets)
+                if len(to_insert) >= INSERT_CHUNK:
+                    _insert(table, to_insert, stats)
         except ValidationError as e:
-            invalid += 1
-            fname = file.get(metadir.config.unique) or "undefined"
-            log.error(f"File `{fname}` not valid: {e}")
+            # aggregated by missing keys, summary at the end of the run
+            fname = file.get(unique) or "undefined"
+            if stats.add_invalid(e.missing, fname):
+                log.error(f"File `{fname}` not valid: {e}")
 
     # at least bulk insert
-    table.insert_many(to_insert)
+    _insert(table, to_insert, stats)
+
+    if ensure and sweep:
+        _sweep(table, metadir, prefix, ts, ts, stats, statistics)
+
+    new_count = len(table)
+    stats.total = new_count
+
+    log.info(f"Updated {stats.counters['updated']} files.")
+    log.info(f"Added {stats.counters['added']} new files.")
+    log.info(f"Skipped {stats.counters['skipped']} not changed files.")
+    if stats.counters["invalid"]:
+        log.warning(f"{stats.counters['invalid']} invalid files")
+    if stats.counters["deleted"]:
+        log.warning(f"{stats.counters['deleted']} soft deleted files")
+    log.info(f"Now {new_count} files in database.")
+
+    return stats
+
+
+def _insert(table, files, stats):
+    with stats.phase("insert") as phase:
+        table.insert_many(files)
+        phase.rows += len(files)
+    files.clear()
+
+
+def _get_unseen(table, since):
+    # already deleted files stay as they are, this includes files that were
+    # purged from the metadata (see `retention`)
+    filters = {"__deleted": None} if table.has_column("__deleted") else {}
+    return chain(
+        table.find(__seen={"lt": since}, **filters),
+        table.find(__seen=None, **filters),
+    )
+
 
-    if ensure:
-        for file in chain(
-            table.find(__seen={"lt": ts}),
-            table.find(__seen=None),
-        ):
+def _sweep(table, metadir, prefix, ts, since, stats, statistics=None):
+    """
+    soft delete all files that were not seen since `since`
+    """
+    with stats.phase("sweep") as phase:
+        for file in _get_unseen(table, since):
+            old_file = dict(file)
             file["__deleted"] = 1
             file["__deleted_at"] = ts
             file["__deleted_reason"] = f"{prefix}-missing"
             file[f"__{prefix}_last_updated"] = ts
             table.update(file, [metadir.config.unique])
-            deleted += 1
+            stats.count("deleted")
+            phase.rows += 1
+            if statistics is not None:
+                add_change(statistics, old_file, file, metadir.config.facets)
 
-    new_count = len(table)
 
-    log.info(f"Updated {updated} files.")
-    log.info(f"Added {added} new files.")
-    log.info(f"Skipped {skipped} not changed files.")
-    if invalid:
-        log.warning(f"{invalid} invalid files")
-    if deleted:
-        log.warning(f"{deleted} soft deleted files")
-    log.info(f"Now {new_count} files in database.")
+def _load_metadata(content, metadir, ts, ensure_files=False, stats=None):
+    if stats is not None:
+        stats.phase("load").bytes += len(content)
+    return _load_record(content, metadir, ts, ensure_files)
 
-    return updated, added, invalid, deleted, skipped
 
-
-def _load_metadata(fp, metadir, ts, ensure_files=False):
-    # use robust dict for performance
-    keys = metadir.config.keys
-    data = metadir._backend.load_json(fp)
-    data = robust_dict(data)
-    data = {k: v for k, v in data.items() if not keys or k in keys}
+def _load_record(data, metadir, ts, ensure_files=False):
+    # use robust dict (of only the configured keys) for performance
+    data = robust_projection(data, metadir.config.projection)
     if ensure_files:
         if not metadir.files.ensure(data):
             data["__meta_last_updated"] = ts
@@ -93,87 +189,809 @@ def _load_metadata(fp, metadir, ts, ensure_files=False):
     return data
 
 
-def _load_files(files):
-    for _, fp in files:
-        p = Path(fp)
-        data = p.stat()
-        yield {
-            "file_name": p.name,
-            "file_path": fp,
+def _load_files(entries, algorithm="sha1", known=None):
+    """
+    read in actual files. if `known` (file_path -> (prehash, content_hash)) is
+    given, files are pre-hashed and only hashed fully if the pre-hash changed
+    """
+    # `os.DirEntry.stat` caches the result per entry, so the stat call (which
+    # follows symlinks like `os.stat`) happens once per file
+    for entry in entries:
+        data = entry.stat()
+        file = {
+            "file_name": entry.name,
+            "file_path": entry.path,
             "file_size": data.st_size,
             "created_at": datetime.fromtimestamp(data.st_ctime),
             "modified_at": datetime.fromtimestamp(data.st_mtime),
-            "content_hash": checksum(fp),
         }
+        if known is not None:
+            file["content_prehash"] = prehash(entry.path, algorithm)
+            cached = known.get(entry.path)
+            if cached and cached[0] == file["content_prehash"]:
+                file["content_hash"] = cached[1]
+        if "content_hash" not in file:
+            file["content_hash"] = checksum(entry.path, algorithm)
+        # use robust dict for comparison with existing metadata, but keep a
+        # size of 0 for empty files
+        file = robust_dict(file)
+        file["file_size"] = str(data.st_size)
+        yield file
+
+
+def _get_known_files(metadb):
+    """
+    return a lookup file_path -> (prehash, content_hash) for existing files
+    """
+    columns = ("file_path", "content_prehash", "content_hash")
+    if not all(metadb.has_column(c) for c in columns):
+        return {}
+    query = select(*(metadb.table.c[c] for c in columns))
+    return {
+        r["file_path"]: (r["content_prehash"], r["content_hash"])
+        for r in metadb.db.query(query)
+    }
 
 
 def _get_table(tx, primary_id, name="files"):
     return tx.get_table(name, primary_id=primary_id, primary_type=tx.types.text)
 
 
-def update_state_db(metadir, replace=False, cleanup=False):
+def _mark_changes(table, unique, ts):
     """
-    update remote metadata to local state
+    mark all files changed by this update for the change feed. this is a
+    separate column, as local changes by consumers set `__state_last_updated`
+    as well
     """
+    ensure_changes_index(table, unique)
+    table.update(
+        {"__state_changed": ts, "__state_last_updated": ts}, ["__state_last_updated"]
+    )
+
+
+def update_state_db(
+    metadir, replace=False, cleanup=False, swap=False, chunk_size=None, shards=None
+):
+    """
+    update remote metadata to local state, return `stats.RunStats`
+
+    swap: build the new state in a copy of the state db and atomically swap
+    it in at the end, so that consumers are not blocked during the update
+
+    chunk_size: commit in chunks of this many files, an interrupted update
+    resumes from the last committed chunk (not with `swap`, as the side copy
+    is discarded on failure)
+
+    shards: partition the state db into this many files by a hash of the
+    unique key (1 for a single state db), existing state is migrated. the
+    shards of a sharded state db are updated in parallel processes
+    """
+
+    if swap and chunk_size:
+        raise ValueError("`swap` can't be combined with `chunk_size`")
 
     log.info(f"Updating metadata and state for `{metadir}` ...")
+    stats = RunStats("update")
+    _finish_reshard(metadir)
 
-    with metadir._db as tx:
-        if replace:
-            # FIXME implement a soft delete? aka backup db file first
-            tx["files"].drop()
+    if shards is not None and (shards if shards > 1 else None) != metadir.shards:
+        with stats.phase("reshard"):
+            _reshard(metadir, shards)
 
-        table = _get_table(tx, metadir.config.unique)
-        primary_keys = table.table.primary_key.columns.keys()
-        if metadir.config.unique not in primary_keys:
-            # table was created before with another primary key
-            # this is a bit hacky, but because of SQLite limitations,
-            # we just make a new copy of the table with the new primary key...
-            tmp_table = _get_table(tx, metadir.config.unique, "tmp")
+    if metadir.shards:
+        _update_shards(metadir, replace, cleanup, swap, chunk_size, stats)
+    else:
+        path = metadir._backend.get_path(STATE_DB)
+        _update_db(metadir, path, replace, cleanup, swap, chunk_size, stats)
+
+    if stats.changed:
+        # added or updated:
+        metadir.touch("state_last_updated")
+    return stats.finish()
+
+
+def _update_db(metadir, path, replace, cleanup, swap, chunk_size, stats, load=None):
+    """
+    update the state db at `path` with the files of the metadata, `load(table)`
+    fills `table` with them (default: replay all segments)
+    """
+    if swap:
+        _swap_update(metadir, path, replace, cleanup, stats, chunk_size, load)
+        return
+    db = dataset.connect(f"sqlite:///{path}")
+    try:
+        with db as tx:
+            _update_state(tx, metadir, replace, cleanup, stats, chunk_size, load)
+    finally:
+        db.close()
+
+
+def _update_shards(metadir, replace, cleanup, swap, chunk_size, stats):
+    """
+    update each shard of a sharded state db in its own process and merge the
+    stats of the shards into `stats`. the segments are parsed once and their
+    files are routed to a table per shard in a temporary db
+    """
+    shards = metadir.shards
+    workers = min(shards, settings.MMMETA_SHARD_WORKERS or os.cpu_count() or 1)
+    fd, meta_path = tempfile.mkstemp(
+        prefix="mmmeta-", suffix=".db", dir=settings.MMMETA_TEMPDIR
+    )
+    os.close(fd)
+    try:
+        _route_metadata(metadir, meta_path, shards, stats)
+        log.info(f"Updating {shards} state db shards with {workers} workers ...")
+        args = (metadir._base_path, metadir._files_root, meta_path, shards)
+        args_ = (replace, cleanup, swap, chunk_size)
+        with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+            futures = [
+                executor.submit(_update_shard, *args, shard, *args_)
+                for shard in range(shards)
+            ]
+            for future in futures:
+                stats.merge(future.result())
+    finally:
+        os.remove(meta_path)
+
+
+class _ShardRouter:
+    """
+    stands in for the table `AppendOnlyBackend.load` upserts into and routes
+    each file to the table of its shard
+    """
+
+    def __init__(self, tables, unique):
+        self.tables = tables
+        self.unique = unique
+
+    def upsert(self, row, keys):
+        shard = get_shard(row[self.unique], len(self.tables))
+        return self.tables[shard].upsert(row, keys)
+
+
+def _route_metadata(metadir, path, shards, stats):
+    """
+    replay the segments into a `shard_<i>` table per shard in the db at `path`
+    """
+    unique = metadir.config.unique
+    # a throwaway db that is only read by the shard processes
+    statements = ["PRAGMA journal_mode=OFF", "PRAGMA synchronous=OFF"]
+    db = dataset.connect(
+        f"sqlite:///{path}", sqlite_wal_mode=False, on_connect_statements=statements
+    )
+    try:
+        with db as tx:
+            tables = [_get_table(tx, unique, f"shard_{i}") for i in range(shards)]
+            with stats.phase("segments") as phase:
+                phase.bytes += metadir._metadata.load(_ShardRouter(tables, unique))
+    finally:
+        db.close()
+
+
+def _init_worker():
+    # profiles only cover the parent process
+    if profiling.active is not None:
+        profiling.active.detach()
+
+
+def _update_shard(base_path, files_root, meta_path, shards, shard, *args):
+    from .metadir import Metadir
+
+    metadir = Metadir(base_path, files_root)
+    path = metadir._backend.get_path(get_name(shard, shards))
+    stats = RunStats("update")
+
+    def load(table):
+        # the files of this shard, routed by `_update_shards`
+        db = dataset.connect(f"sqlite:///{meta_path}", sqlite_wal_mode=False)
+        try:
+            name = f"shard_{shard}"
+            if db.has_table(name):
+                for chunk in _chunks(db[name].all(), INSERT_CHUNK):
+                    table.insert_many(chunk)
+        finally:
+            db.close()
+
+    _update_db(metadir, path, *args, stats, load)
+    return stats
+
+
+def _reshard(metadir, shards):
+    """
+    move the files of the current state db (or its shards) into `shards` new
+    ones (a single state db for 1), including all consumer data. other
+    tables (statistics, checkpoints) are rebuilt by the next update
+
+    the sources are write locked during the whole migration. the new layout
+    is written to temporary files and switched to via the `shards.MARKER`
+    before the sources are removed, so an interrupted migration leaves a
+    consistent layout (see `shards.get_shards`)
+    """
+    unique = metadir.config.unique
+    paths = [p for p in metadir._state_paths if os.path.exists(p)]
+    names = get_names(shards)
+    targets = [metadir._backend.get_path(f"{n}.{os.getpid()}.tmp") for n in names]
+    log.info(f"Migrating state db to {len(names)} shard(s) ...")
+    locks = []
+    try:
+        for path in paths:
+            # block consumer writes (not reads) until the sources are gone
+            conn = sqlite3.connect(path, isolation_level=None)
+            locks.append(conn)
+            conn.execute("BEGIN IMMEDIATE")
+        _copy_shards(paths, targets, unique)
+        marker = metadir._backend.get_path(MARKER)
+        with open(f"{marker}.tmp", "w") as f:
+            f.write(str(shards))
+        os.replace(f"{marker}.tmp", marker)
+        for name, target in zip(names, targets):
+            os.replace(target, metadir._backend.get_path(name))
+        for path in paths:
+            _remove_db(path)
+    finally:
+        for conn in locks:
+            conn.close()
+        for target in targets:
+            _remove_db(target)
+    os.remove(marker)
+
+
+def _copy_shards(paths, targets, unique):
+    """
+    distribute the files of the state dbs at `paths` over the `targets`
+    """
+    dbs = [dataset.connect(f"sqlite:///{p}", sqlite_wal_mode=False) for p in targets]
+    try:
+        tables = [_get_table(db, unique) for db in dbs]
+        for table in tables:
+            # creates the (maybe empty) table
+            table.create_column(unique, table.db.types.text)
+        for path in paths:
+            db = dataset.connect(f"sqlite:///{path}")
             try:
-                tmp_table.insert_many([i for i in table])
-            except IntegrityError as e:
-                log.warning(
-                    f"Cannot perform `state.db` migration under such circumstances. Is your config correct? `{e}`"  # noqa
-                )
-            table.drop()
-            table = _get_table(tx, metadir.config.unique)
-            table.insert_many([i for i in tmp_table])
-            tmp_table.drop()
-
-        if cleanup:
-            log.info("Cleaning up ...")
-            tmp_table = _get_table(tx, metadir.config.unique, "tmp")
-            keys = metadir.config.keys
-            tmp_table.insert_many(
-                [
-                    casted_dict(
-                        {
-                            k: v
-                            for k, v in f.items()
-                            if not keys or k in keys or k.startswith("_")
-                        }
-                    )
-                    for f in table
-                ]
+                if not db.has_table("files"):
+                    continue
+                source = db["files"]
+                for column in source.table.columns:
+                    # keep the column types instead of guessing them from rows
+                    for table in tables:
+                        table.create_column(column.name, column.type)
+                for chunk in _iter_chunks(source, unique, INSERT_CHUNK):
+                    grouped = {}
+                    for row in chunk:
+                        shard = get_shard(row[unique], len(targets))
+                        grouped.setdefault(shard, []).append(row)
+                    for shard, rows in grouped.items():
+                        tables[shard].insert_many(rows)
+            finally:
+                db.close()
+    finally:
+        for db in dbs:
+            db.close()
+
+
+def _remove_db(path):
+    for fp in (path, f"{path}-wal", f"{path}-shm", f"{path}-journal"):
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
+def _finish_reshard(metadir):
+    """
+    remove the left over files of an interrupted migration: the old layout if
+    it switched already, the incomplete new one otherwise
+    """
+    base = metadir._backend.base_path
+    if get_migration(base) is None:
+        return
+    current = get_names(metadir.shards)
+    for name in os.listdir(base):
+        if get_db_name(name) not in (None, *current):
+            log.warning(f"Removing `{name}` of an interrupted migration.")
+            os.remove(os.path.join(base, name))
+    os.remove(os.path.join(base, MARKER))
+
+
+def _prepare_state(tx, metadir, replace, cleanup):
+    """
+    drop, migrate or clean up the files table in `tx` before an update
+    """
+    if replace:
+        # FIXME implement a soft delete? aka backup db file first
+        tx["files"].drop()
+
+    table = _get_table(tx, metadir.config.unique)
+    primary_keys = table.table.primary_key.columns.keys()
+    if metadir.config.unique not in primary_keys:
+        # table was created before with another primary key
+        # this is a bit hacky, but because of SQLite limitations,
+        # we just make a new copy of the table with the new primary key...
+        tmp_table = _get_table(tx, metadir.config.unique, "tmp")
+        try:
+            tmp_table.insert_many([i for i in table])
+        except IntegrityError as e:
+            log.warning(
+                f"Cannot perform `state.db` migration under such circumstances. Is your config correct? `{e}`"  # noqa
             )
-            table = table.drop()
-            table = _get_table(tx, metadir.config.unique)
-            table.insert_many([i for i in tmp_table])
+        table.drop()
+        table = _get_table(tx, metadir.config.unique)
+        table.insert_many([i for i in tmp_table])
+        tmp_table.drop()
 
-        log.info(f"{len(table)} exsiting files in `{tx}`")
+    if cleanup:
+        log.info("Cleaning up ...")
+        tmp_table = _get_table(tx, metadir.config.unique, "tmp")
+        keys = metadir.config.keys
+        tmp_table.insert_many(
+            [
+                casted_dict(
+                    {
+                        k: v
+                        for k, v in f.items()
+                        if not keys or k in keys or k.startswith("_")
+                    }
+                )
+                for f in table
+            ]
+        )
+        table = table.drop()
+        table = _get_table(tx, metadir.config.unique)
+        table.insert_many([i for i in tmp_table])
 
-        files = tx["meta_files"]
-        metadir._metadata.load(files)
+    return table
+
+
+def _get_last_segment(metadir):
+    steps = metadir._metadata.get_steps()
+    if steps:
+        return os.path.basename(steps[-1])
+
+
+def _get_checkpoint(tx, segment):
+    """
+    return the checkpoint of an interrupted update of the same segments
+    """
+    if not tx.has_table(CHECKPOINT):
+        return
+    checkpoint = tx[CHECKPOINT].find_one()
+    if checkpoint is None:
+        return
+    if checkpoint["segment"] != segment or not tx.has_table("meta_files"):
+        log.warning("Metadata changed since the interrupted update, starting over.")
+        tx[CHECKPOINT].delete()
+        return
+    return checkpoint
+
+
+def _save_checkpoint(tx, **data):
+    table = tx[CHECKPOINT]
+    table.delete()
+    table.insert(data)
+
+
+def _commit(tx, stats):
+    # commit and continue with a new transaction
+    with stats.phase("commit"):
+        tx.commit()
+        tx.begin()
+
+
+def _update_state(tx, metadir, replace, cleanup, stats, chunk_size=None, load=None):
+    """
+    update the state db in `tx` and commit, returns the columns of the
+    metadata (the ones that are owned by `update`). `load(table)` fills the
+    metadata files into `table` (default: replay all segments, a shard gets
+    its files routed instead)
+
+    with `chunk_size`, the files are upserted and committed in chunks and a
+    checkpoint is kept in the state db, so that an interrupted update resumes
+    where it stopped. the sweep runs after all chunks are applied
+    """
+    unique = metadir.config.unique
+    segment = _get_last_segment(metadir)
+    checkpoint = _get_checkpoint(tx, segment) if chunk_size else None
+    if checkpoint is None:
+        table = _prepare_state(tx, metadir, replace, cleanup)
+        log.info(f"{len(table)} exsiting files in `{tx}`")
+        if tx.has_table("meta_files"):
+            tx["meta_files"].drop()
+        # keyed by the unique key, an auto increment id would end up in the
+        # state and differ between shards
+        files = _get_table(tx, unique, "meta_files")
+        with stats.phase("segments") as phase:
+            if load is None:
+                phase.bytes += metadir._metadata.load(files)
+            else:
+                load(files)
+            phase.rows += len(files)
         # use a consistent timestamp for state diff queries
         ts = datetime.now()
-        res = _upsert(tx, metadir, files, "state", ts, ensure=True, casted=True)
-        files.drop()
+        rebuild = replace or cleanup
+        offset, last_uid = 0, None
+        if chunk_size:
+            _save_checkpoint(
+                tx, segment=segment, ts=ts, offset=0, uid=None, rebuild=rebuild
+            )
+            _commit(tx, stats)
+    else:
+        table = tx["files"]
+        files = tx["meta_files"]
+        ts, rebuild = checkpoint["ts"], bool(checkpoint["rebuild"])
+        offset, last_uid = checkpoint["offset"], checkpoint["uid"]
+        log.info(f"Resuming interrupted update after {offset} files ...")
+    meta_columns = set(files.columns)
+    facets = metadir.config.facets
+    delta = Counter()
+    if not chunk_size:
+        _upsert(
+            tx,
+            metadir,
+            files,
+            "state",
+            ts,
+            ensure=True,
+            casted=True,
+            stats=stats,
+            statistics=delta,
+        )
+    else:
+        for chunk in _iter_chunks(files, unique, chunk_size, last_uid):
+            offset += len(chunk)
+            last_uid = chunk[-1][unique]
+            _upsert(
+                tx,
+                metadir,
+                chunk,
+                "state",
+                ts,
+                ensure=True,
+                casted=True,
+                stats=stats,
+                sweep=False,
+                statistics=delta,
+            )
+            with stats.phase("statistics"):
+                update_table(tx, table, delta, facets)
+                delta.clear()
+            _save_checkpoint(
+                tx, segment=segment, ts=ts, offset=offset, uid=last_uid, rebuild=rebuild
+            )
+            _commit(tx, stats)
+        # deletions only after all files were seen
+        _sweep(table, metadir, "state", ts, ts, stats, delta)
+        stats.total = len(table)
+    with stats.phase("changes"):
+        _mark_changes(table, unique, ts)
+    with stats.phase("statistics"):
+        update_table(tx, table, delta, facets, rebuild)
+    files.drop()
+    if tx.has_table(CHECKPOINT):
+        tx[CHECKPOINT].drop()
+    with stats.phase("commit"):
+        tx.commit()
+    return meta_columns
 
-    if any(res[:4]):
-        # added or updated:
-        metadir.touch("state_last_updated")
-    return res
+
+def _swap_update(metadir, path, replace, cleanup, stats, chunk_size=None, load=None):
+    """
+    run the update on a side copy of the state db at `path` (consumers keep
+    reading and writing the live one), then copy over the columns consumers
+    changed in the meantime and swap in the new state at once
+    """
+    side_path = f"{path}.{os.getpid()}.tmp"
+    keep = not replace and os.path.exists(path)
+    try:
+        if keep:
+            with stats.phase("backup"):
+                with closing(sqlite3.connect(path)) as src:
+                    with closing(sqlite3.connect(side_path)) as dst:
+                        # copy in steps to not block writers for too long
+                        src.backup(dst, pages=1024)
+        db = dataset.connect(f"sqlite:///{side_path}")
+        try:
+            with db as tx:
+                meta_columns = _update_state(
+                    tx, metadir, replace, cleanup, stats, chunk_size, load
+                )
+        finally:
+            db.close()
+        with stats.phase("swap"):
+            _swap(metadir, path, side_path, meta_columns if keep else None, cleanup)
+    finally:
+        for fp in (side_path, f"{side_path}-wal", f"{side_path}-shm"):
+            if os.path.exists(fp):
+                os.remove(fp)
+
+
+def _is_consumer_column(column, unique, meta_columns):
+    # `__seen` is the scan timestamp of every update
+    if column in (unique, "__seen") or column in meta_columns:
+        return False
+    return not column.startswith(("__meta_", "__state_", "__deleted"))
+
+
+def _swap(metadir, path, side_path, meta_columns=None, cleanup=False):
+    """
+    replace the state db at `path` with the one at `side_path`, consumer
+    owned columns (leases, own data) and files inserted by consumers are
+    copied over from `path` first if `meta_columns` are given (only the
+    columns that survived a `cleanup`)
+
+    everything happens in one write transaction on the live db, so consumers
+    can't write in between: the tables are replaced via sql instead of
+    renaming the file, as the `-wal` and `-shm` files of the live db (WAL
+    mode) belong to it and are used by open consumer connections. readers
+    keep their snapshot until they finish
+    """
+    unique = metadir.config.unique
+    with closing(sqlite3.connect(side_path, isolation_level=None)) as conn:
+        conn.execute("ATTACH DATABASE ? AS live", (path,))
+        # block writers (not readers) until the new state is written
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if meta_columns is not None:
+                _copy_consumer_columns(conn, unique, meta_columns, cleanup)
+            _replace_tables(conn, "main", "live")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def _get_columns(conn, schema):
+    rows = conn.execute(f"PRAGMA {schema}.table_info(files)").fetchall()
+    return {r[1]: r[2] for r in rows}
+
+
+def _copy_consumer_columns(conn, unique, meta_columns, cleanup=False):
+    """
+    copy the consumer columns from `live.files` to `main.files` and insert
+    the files that only exist in `live.files` (the update doesn't remove
+    files, so consumers inserted them in the meantime)
+    """
+    live_columns = _get_columns(conn, "live")
+    if not live_columns:
+        return
+    side_columns = _get_columns(conn, "main")
+    columns = [
+        c
+        for c in live_columns
+        if _is_consumer_column(c, unique, meta_columns)
+        # the cleanup keeps underscore columns, e.g. the lease columns of a
+        # first claim during the update
+        and (c in side_columns or not cleanup or c.startswith("_"))
+    ]
+    for column in columns:
+        if column not in side_columns:
+            # created by a consumer during the update
+            conn.execute(
+                f'ALTER TABLE main.files ADD COLUMN "{column}" {live_columns[column]}'
+            )
+    if columns:
+        names = ", ".join(f'"{c}"' for c in columns)
+        log.info(f"Copying consumer columns: {names}")
+        conn.execute(
+            f"UPDATE main.files SET ({names}) = (SELECT {names} FROM live.files AS l "
+            f'WHERE l."{unique}" = main.files."{unique}") '
+            f'WHERE "{unique}" IN (SELECT "{unique}" FROM live.files)'
+        )
+    side_columns = _get_columns(conn, "main")
+    names = ", ".join(f'"{c}"' for c in live_columns if c in side_columns)
+    res = conn.execute(
+        f"INSERT INTO main.files ({names}) SELECT {names} FROM live.files "
+        f'WHERE "{unique}" NOT IN (SELECT "{unique}" FROM main.files)'
+    )
+    if res.rowcount > 0:
+        log.info(f"Copying {res.rowcount} files inserted by consumers.")
+
+
+def _replace_tables(conn, source, target):
+    """
+    replace all tables (and their indexes) of the `target` schema with the
+    ones of `source` within the current transaction of `conn`
+    """
+
+    def _get_schema(schema):
+        return conn.execute(
+            f"SELECT type, name, sql FROM {schema}.sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY type = 'index'"
+        ).fetchall()
+
+    for type_, name, _ in _get_schema(target):
+        if type_ == "table":  # drops its indexes as well
+            conn.execute(f'DROP TABLE {target}."{name}"')
+    for type_, name, sql in _get_schema(source):
+        # qualify the created table or index with the target schema
+        conn.execute(SCHEMA_NAME.sub(rf"\g<1>{target}.", sql, count=1))
+        if type_ == "table":
+            conn.execute(
+                f'INSERT INTO {target}."{name}" SELECT * FROM {source}."{name}"'
+            )
+
+
+def _load_metadb(tx, metadir, stats):
+    """
+    replay the segments into a meta db table in `tx`
+    """
+    metadb = _get_table(tx, metadir.config.unique)
+    with stats.phase("segments") as phase:
+        phase.bytes += metadir._metadata.load(metadb)
+        phase.rows += metadb.count()
+    log.info(f"{phase.rows} existing files.")
+    return metadb
+
+
+def _snapshot(tx, metadir, metadb, uids=None):
+    """
+    keep the old state of all files or only the given `uids` for the diff
+    """
+    unique = metadir.config.unique
+    old_state = _get_table(tx, unique, "old_state")
+    old_state.delete()
+    if uids is None:
+        for rows in _iter_chunks(metadb, unique, INSERT_CHUNK):
+            old_state.insert_many(rows)
+    else:
+        uids = list(uids)
+        for i in range(0, len(uids), 500):
+            old_state.insert_many(metadb.find(**{unique: {"in": uids[i : i + 500]}}))
+    return old_state
+
+
+def _write_diff(tx, metadir, metadb, old_state, ts, stats):
+    """
+    export the diff of all files changed at `ts` to the append only db
+    """
+    unique = metadir.config.unique
+    diff = _get_table(tx, unique, "diff")
+    diff.delete()
+    with stats.phase("diff") as phase:
+        for file in metadb.find(__meta_last_updated=ts):
+            old_file = ensure_dict(old_state.find_one(**{unique: file[unique]}))
+            changed = dict(dict_diff(file, old_file))
+            diff_data = {
+                **changed,
+                **{unique: file[unique]},
+                **{"__mmmeta_keys": ",".join(changed.keys())},
+            }
+            diff.insert(diff_data)
+            phase.rows += 1
+    with stats.phase("write") as phase:
+        fp = metadir._metadata.write(diff)
+        if fp is not None:
+            phase.rows += len(diff)
+            phase.bytes += os.path.getsize(fp)
+    return fp
+
+
+def _generate(tx, metadir, metadb, files, ts, ensure, stats, uids=None, sweep=True):
+    """
+    upsert `files` into the meta db and write the diff as a new segment,
+    returns its path (or `None` if nothing changed)
+    """
+    with stats.phase("snapshot") as phase:
+        old_state = _snapshot(tx, metadir, metadb, uids)
+        phase.rows += len(old_state)
+    _upsert(tx, metadir, files, "meta", ts, ensure, stats=stats, sweep=sweep)
+    return _write_diff(tx, metadir, metadb, old_state, ts, stats)
+
+
+def _write_indexes(metadir, metadb, changed, stats):
+    """
+    write the uid index and the statistics of the meta db if it changed (or
+    they don't exist yet). if other writers appended segments meanwhile,
+    `metadb` misses their files: the uid index is removed (it is rebuilt from
+    the segments on first use) and the statistics are computed from the
+    segments
+    """
+    backend = metadir._metadata
+    write_uids = changed or not backend.exists(UIDS)
+    write_statistics = changed or not backend.exists(STATISTICS)
+    if not write_uids and not write_statistics:
+        return
+    with backend.lock(exclusive=True):
+        outdated = backend.has_new_segments()
+        if outdated:
+            log.info("Segments were appended meanwhile by other writers.")
+        if write_uids:
+            with stats.phase("uids"):
+                if not outdated:
+                    backend.write_uids(metadb)
+                elif backend.exists(UIDS):
+                    os.remove(backend.get_path(UIDS))
+        if write_statistics:
+            with stats.phase("statistics"):
+                if not outdated:
+                    write_file(backend, compute(metadb, metadir.config.facets))
+                else:
+                    with tmp_db() as tx:
+                        table = backend._get_table(tx)
+                        backend._load(table)
+                        write_file(backend, compute(table, metadir.config.facets))
+
+
+def _iter_chunks(table, unique, size, last_uid=None):
+    """
+    yield all rows of `table` in lists of `size` rows ordered by `unique`
+    (keyset pagination, so that a whole table is never loaded at once)
+    """
+    while True:
+        filters = {unique: {"gt": last_uid}} if last_uid is not None else {}
+        chunk = list(table.find(order_by=unique, _limit=size, **filters))
+        if not chunk:
+            return
+        yield chunk
+        last_uid = chunk[-1][unique]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ingest_metadata(
+    metadir,
+    records,
+    ensure=False,
+    chunk_size=None,
+    replace=False,
+    tempdir=None,
+    memory_limit=None,
+):
+    """
+    ingest metadata `records` (dicts) directly instead of reading json files.
+    with `chunk_size`, a segment is written for each chunk of records, so
+    unbounded iterables can be streamed
+
+    ensure: soft delete all previously existing files not in `records`
+
+    tempdir, memory_limit: see `generate_metadata`
+
+    returns `stats.RunStats`
+    """
+    stats = RunStats("ingest")
+    unique = metadir.config.unique
+    if replace:
+        log.warning(f"Replacing metadata for `{metadir}` ...")
+        metadir._metadata.delete()
+    else:
+        log.info(f"Ingesting metadata for `{metadir}` ...")
+    start = datetime.now()
+    with tmp_db(tempdir, memory_limit) as tx:
+        metadb = _load_metadb(tx, metadir, stats)
+        if not chunk_size:
+            files = (_load_record(r, metadir, start) for r in records)
+            changed = _generate(tx, metadir, metadb, files, start, ensure, stats)
+        else:
+            changed = False
+            for chunk in _chunks(records, chunk_size):
+                # each chunk is diffed by its own timestamp
+                ts = datetime.now()
+                files = [_load_record(r, metadir, ts) for r in chunk]
+                uids = [f[unique] for f in files if f.get(unique)]
+                fp = _generate(
+                    tx, metadir, metadb, files, ts, ensure, stats, uids, sweep=False
+                )
+                changed = changed or fp is not None
+            if ensure:
+                ts = datetime.now()
+                uids = [f[unique] for f in _get_unseen(metadb, start)]
+                old_state = _snapshot(tx, metadir, metadb, uids)
+                _sweep(metadb, metadir, "meta", ts, start, stats)
+                fp = _write_diff(tx, metadir, metadb, old_state, ts, stats)
+                changed = changed or fp is not None
+        stats.total = metadb.count()
+        _write_indexes(metadir, metadb, changed, stats)
+
+    if stats.changed:
+        metadir.touch("meta_last_updated")
+
+    return stats.finish()
 
 
 def generate_metadata(
@@ -183,6 +1001,8 @@ def generate_metadata(
     ensure_metadata=False,
     ensure_files=False,
     no_meta=False,
+    tempdir=None,
+    memory_limit=None,
 ):
     """
     generate or update file metadata
@@ -190,8 +1010,14 @@ def generate_metadata(
     it is stored under `_mmmeta/db/*.json.meta` one file for each file
 
     ensure: soft delete all previously existing files not found in metadata
+
+    tempdir, memory_limit: work in a temporary database file (in `tempdir`)
+    with a bounded page cache instead of in memory
+
+    returns `stats.RunStats`
     """
     metadata = metadir._metadata
+    stats = RunStats("generate")
 
     if replace:
         log.warning(f"Replacing metadata for `{filebackend}` ...")
@@ -202,49 +1028,34 @@ def generate_metadata(
     # use a consistent timestamp for state diff queries
     ts = datetime.now()
 
-    # either read in json metadata files or actual files (only local filesystem here)
-    if no_meta:
-        files = _load_files(
-            filebackend.get_children(condition=lambda x: "_mmmeta" not in x)
-        )
-    else:
-        files = (
-            _load_metadata(fp, metadir, ts, ensure_files)
-            for _, fp in filebackend.get_children(
-                condition=lambda x: x.endswith(".json")
-            )
-        )
-
-    with dataset.connect("sqlite:///:memory:") as tx:
-        metadb = _get_table(tx, metadir.config.unique)
-        metadata.load(metadb)
-        log.info(f"{metadb.count()} existing files.")
-
-        # keep old state
-        old_state = _get_table(tx, metadir.config.unique, "old_state")
-        old_state.insert_many([i for i in metadb])
-
-        res = _upsert(tx, metadir, files, "meta", ts, ensure_metadata)
+    with tmp_db(tempdir, memory_limit) as tx:
+        metadb = _load_metadb(tx, metadir, stats)
 
-        # export diff to append only db
-        diff = _get_table(tx, metadir.config.unique, "diff")
-        for file in metadb.find(__meta_last_updated=ts):
-            old_file = ensure_dict(
-                old_state.find_one(
-                    **{metadir.config.unique: file[metadir.config.unique]}
+        # either read in json metadata files or actual files (only local
+        # filesystem for the latter)
+        if no_meta:
+            if not hasattr(filebackend, "get_entries"):
+                raise ConfigError(
+                    f"Reading actual files is not supported for `{filebackend}`"
                 )
+            algorithm = metadir.config.hash_algorithm
+            known = _get_known_files(metadb) if metadir.config.prehash else None
+            files = _load_files(
+                filebackend.get_entries(exclude=("_mmmeta",)), algorithm, known
             )
-            changed = dict(dict_diff(file, old_file))
-            diff_data = {
-                **changed,
-                **{metadir.config.unique: file[metadir.config.unique]},
-                **{"__mmmeta_keys": ",".join(changed.keys())},
-            }
-            diff.insert(diff_data)
-        metadata.write(diff)
+        else:
+            # remote backends prefetch the json files concurrently
+            paths = filebackend.get_children(exclude=("_mmmeta",), suffix=".json")
+            files = (
+                _load_metadata(content, metadir, ts, ensure_files, stats)
+                for _, content in filebackend.load_many(fp for _, fp in paths)
+            )
+
+        fp = _generate(tx, metadir, metadb, files, ts, ensure_metadata, stats)
+        _write_indexes(metadir, metadb, fp is not None, stats)
 
-    if any(res[:4]):
+    if stats.changed:
         # added or updated:
         metadir.touch("meta_last_updated")
 
-    return res
+    return stats.finish()
@@ -11,4 +11,6 @@ class StoreError(Exception):
 
 
 class ValidationError(Exception):
-    pass
+    def __init__(self, message, missing=()):
+        super().__init__(message)
+        self.missing = missing
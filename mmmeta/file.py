@@ -1,27 +1,125 @@
+import base64
+import heapq
+import json
 import os
-from datetime import datetime
+import socket
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import chain, islice
 from types import SimpleNamespace
+from uuid import uuid4
 
 from banal import clean_dict
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import OperationalError
 
 from .exceptions import ValidationError
+from .shards import get_shard
+
+CHANGED = "__state_changed"
+CHANGES_INDEX = "ix_files_changes"
+LEASE_OWNER = "__lease_owner"
+LEASE_TOKEN = "__lease_token"
+LEASE_EXPIRES = "__lease_expires"
+BATCH_SIZE = 1000  # partial files per query for lazily fetched columns
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}_{os.getpid()}"
+
+
+def ensure_lease_columns(table):
+    """
+    create the columns for `FilesWrapper.claim` in dataset `table` on first
+    use, so that state dbs of consumers that never claim don't get them
+    """
+    types = table.db.types
+    for name, type_ in (
+        (LEASE_OWNER, types.text),
+        (LEASE_TOKEN, types.text),
+        (LEASE_EXPIRES, types.datetime),
+    ):
+        try:
+            table.create_column(name, type_)
+        except OperationalError:
+            # another consumer created it in the meantime
+            table._reflect_table()
+            if not table.has_column(name):
+                raise
+
+
+def ensure_changes_index(table, unique):
+    """create the column and index for `FilesWrapper.changed_since`"""
+    table.create_column(CHANGED, table.db.types.datetime)
+    table.create_index([CHANGED, unique], name=CHANGES_INDEX)
+
+
+def encode_cursor(ts, uid):
+    data = json.dumps([ts.isoformat(), uid]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor):
+    ts, uid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(ts), uid
+
+
+class _Batch:
+    """
+    the full rows of a chunk of partial files, fetched at once on the first
+    access of a not selected column
+    """
+
+    def __init__(self, files, uids):
+        self._files = files
+        self._uids = uids
+        self._rows = None
+
+    def get(self, uid):
+        if self._rows is None:
+            self._rows = self._files._get_rows(self._uids)
+        return self._rows.get(uid)
 
 
 class File:
-    def __init__(self, metadir, data):
+    def __init__(self, metadir, data, partial=False, files=None, batch=None):
         self._metadir = metadir
         self._data = data
         self._unique = metadir.config.unique
+        # only some columns were selected, fetch the others on access
+        self._partial = partial
+        # the `FilesWrapper` (and `_Batch` of partial files) this came from
+        self._files = files
+        self._batch = batch
 
     def __setitem__(self, attr, value):
         self.update(**{attr: value})
 
     def __getitem__(self, attr, default=None):
+        if attr not in self._data:
+            self._load()
         return self._data.get(attr, default)
 
     def __contains__(self, key):
+        if key not in self._data:
+            self._load()
         return key in self._data
 
+    def _load(self):
+        if self._partial:
+            if self._batch is not None:
+                data = self._batch.get(self.uid)
+            else:
+                data = self._get_files()._get_row(self.uid)
+            self._data = {**(data or {}), **self._data}
+            self._partial = False
+            self._batch = None
+
+    def _get_files(self):
+        if self._files is None:
+            self._files = self._metadir.files
+        return self._files
+
     def update(self, **data):
         """
         bulk attribute update (like dict.update)
@@ -31,10 +129,22 @@ class File:
         self._data["__state_last_updated"] = datetime.now()
 
     def save(self):
-        with self._metadir._db as db:
+        with self._metadir._get_db(self.uid) as db:
             db["files"].update(self._data, [self._unique])
 
+    def ack(self, **data):
+        """
+        finish a claimed file: write `data` and release the lease, returns
+        `False` if the lease expired and the file was claimed by another worker
+        """
+        return bool(self._get_files().ack([self], **data))
+
+    def release(self):
+        """give a claimed file back without changes"""
+        return bool(self._get_files().release([self]))
+
     def serialize(self):
+        self._load()
         return {**self._data, **vars(self.remote)}
 
     @property
@@ -43,13 +153,55 @@ class File:
 
     @property
     def name(self):
-        return self._data.get(self._metadir.config.file_name, self.uid)
+        return self[self._metadir.config.file_name] or self.uid
 
     @property
     def remote(self):
+        self._load()
         return SimpleNamespace(**dict(self._metadir.config.get_remote(self._data)))
 
 
+class ChangeFeed:
+    """
+    iterate over files changed in the state db since `cursor` in pages of
+    `chunk_size`, ordered by change time and uid. after (or during) iteration,
+    `cursor` points to the last consumed file. if `store_key` is given, the
+    cursor is read from and persisted to the metadir store after each page
+    """
+
+    def __init__(self, files, cursor=None, chunk_size=1000, store_key=None, **filters):
+        self._files = files
+        self._store = files._metadir.store
+        self.store_key = store_key
+        if cursor is None and store_key is not None:
+            cursor = self._store[store_key]
+        self.cursor = cursor
+        self.chunk_size = chunk_size
+        self.filters = filters
+
+    def _get_page(self):
+        return self._files._changes_page(self.cursor, self.chunk_size, self.filters)
+
+    def _persist(self):
+        if self.store_key is not None and self.cursor is not None:
+            self._store[self.store_key] = self.cursor
+
+    def __iter__(self):
+        if not self._files._has_changes():
+            return
+        while True:
+            page = self._get_page()
+            for data in page:
+                yield File(self._files._metadir, data, files=self._files)
+                # the consumer came back, so this file is done
+                self.cursor = encode_cursor(
+                    data[CHANGED], data[self._files.config.unique]
+                )
+            self._persist()
+            if len(page) < self.chunk_size:
+                return
+
+
 class FilesWrapper:
     """
     yield actual `File` objects from dataset table,
@@ -64,23 +216,166 @@ class FilesWrapper:
         self.config = metadir.config
 
     def __iter__(self):
-        for data in self._table:
-            yield File(self._metadir, data)
+        return self.find()
 
     def __len__(self):
         return len(self._table)
 
+    @property
+    def shards(self):
+        """the wrappers of the state db shards (only this one if not sharded)"""
+        return [self]
+
     def __contains__(self, file):
         return bool(self.find_one(**{self.config.unique: file[self.config.unique]}))
 
-    def find(self, *args, **kwargs):
-        for data in self._table.find(*args, **kwargs):
-            yield File(self._metadir, data)
+    def find(self, *args, columns=None, chunk_size=None, **kwargs):
+        """
+        yield `File` objects for matching rows (see `dataset.Table.find`).
+        `columns` limits the selected columns (the unique key is always
+        included), other columns are fetched lazily on access. rows are
+        fetched from the cursor in chunks of `chunk_size`
+        """
+        if chunk_size is not None:
+            kwargs["_step"] = chunk_size
+        if columns is None:
+            for data in self._table.find(*args, **kwargs):
+                yield File(self._metadir, data, files=self)
+            return
+        rows = self._find_columns(columns, *args, **kwargs)
+        # other columns are fetched for a whole chunk at once
+        for chunk in _chunks(rows, chunk_size or BATCH_SIZE):
+            batch = _Batch(self, [data[self.config.unique] for data in chunk])
+            for data in chunk:
+                yield File(self._metadir, data, True, self, batch)
+
+    def _find_columns(
+        self, columns, *clauses, _limit=None, _offset=0, order_by=None, **kwargs
+    ):
+        table = self._table
+        if not table.exists:
+            return []
+        columns = [self.config.unique] + [c for c in columns if c != self.config.unique]
+        columns = [table.table.c[c] for c in columns if table.has_column(c)]
+        step = kwargs.pop("_step", None)
+        query = (
+            select(*columns)
+            .where(table._args_to_clause(kwargs, clauses=clauses))
+            .limit(_limit)
+            .offset(_offset)
+        )
+        orderings = table._args_to_order_by(order_by)
+        if orderings:
+            query = query.order_by(*orderings)
+        if step is not None:
+            return table.db.query(query, _step=step)
+        return table.db.query(query)
 
     def find_one(self, *args, **kwargs):
         data = self._table.find_one(*args, **kwargs)
         if data:
-            return File(self._metadir, data)
+            return File(self._metadir, data, files=self)
+
+    def _get_row(self, uid):
+        return self._table.find_one(**{self.config.unique: uid})
+
+    def _get_rows(self, uids):
+        unique = self.config.unique
+        rows = self._table.find(**{unique: {"in": list(uids)}})
+        return {row[unique]: row for row in rows}
+
+    def claim(self, n=1, lease=timedelta(minutes=10), worker=None, **filters):
+        """
+        lease up to `n` files matching `filters` to `worker` (defaults to
+        `<hostname>_<pid>`) for the duration of `lease`. files that are leased
+        by another worker are skipped until their lease expires, so multiple
+        consumer processes can work on the same state db in parallel.
+
+        claimed files need to be finished via `ack` (ideally with data that
+        excludes them from `filters`, e.g. `imported=True`) or given back via
+        `release`
+        """
+        ensure_lease_columns(self._table)
+        worker = worker or get_worker_id()
+        token = uuid4().hex
+        now = datetime.now()
+        table = self._table.table
+        unique = table.c[self.config.unique]
+        available = or_(table.c[LEASE_OWNER].is_(None), table.c[LEASE_EXPIRES] < now)
+        clause = self._table._args_to_clause(filters, clauses=[available])
+        # select and lease in one statement so that concurrent claims never
+        # overlap (sqlite serializes writers)
+        candidates = select(unique).where(clause).order_by(unique).limit(n)
+        stmt = (
+            table.update()
+            .where(unique.in_(candidates.scalar_subquery()))
+            .values(
+                {LEASE_OWNER: worker, LEASE_TOKEN: token, LEASE_EXPIRES: now + lease}
+            )
+        )
+        with self._table.db as tx:
+            tx.executable.execute(stmt)
+        return list(self.find(**{LEASE_TOKEN: token}))
+
+    def changed_since(self, cursor=None, chunk_size=1000, store_key=None, **filters):
+        """
+        return a `ChangeFeed` of files added, updated or soft deleted by
+        `update` since `cursor` (`None` for all files), optionally
+        matching `filters`. the feed's `cursor` can be persisted to continue
+        later, or pass `store_key` to keep it in the metadir store
+        """
+        return ChangeFeed(self, cursor, chunk_size, store_key, **filters)
+
+    def _has_changes(self):
+        return self._table.has_column(CHANGED)
+
+    def _changes_page(self, cursor, limit, filters):
+        table = self._table
+        changed = table.table.c[CHANGED]
+        unique = table.table.c[self.config.unique]
+        clauses = [changed.isnot(None)]
+        if cursor is not None:
+            ts, uid = decode_cursor(cursor)
+            # keyset pagination instead of offsets
+            clauses.append(or_(changed > ts, and_(changed == ts, unique > uid)))
+        clause = table._args_to_clause(filters, clauses=clauses)
+        query = select(table.table).where(clause).order_by(changed, unique).limit(limit)
+        return list(table.db.query(query))
+
+    def ack(self, files, **data):
+        """
+        finish claimed `files`: write `data` to each of them and release the
+        lease, returns the number of files that were still leased. the
+        `__state_*` columns belong to `update` and are not touched
+        """
+        return self._finish(files, data)
+
+    def release(self, files):
+        """
+        give claimed `files` back without changes, returns the number of files
+        that were still leased
+        """
+        return self._finish(files)
+
+    def _finish(self, files, data=None):
+        ensure_lease_columns(self._table)
+        values = {**(data or {}), LEASE_OWNER: None, LEASE_TOKEN: None}
+        values[LEASE_EXPIRES] = None
+        values = self._table._sync_columns(values, ensure=True)
+        table = self._table.table
+        unique = table.c[self.config.unique]
+        finished = 0
+        with self._table.db as tx:
+            for file in files:
+                # only the current lease holder can finish a file
+                clause = and_(
+                    unique == file.uid, table.c[LEASE_TOKEN] == file[LEASE_TOKEN]
+                )
+                res = tx.executable.execute(table.update().where(clause).values(values))
+                if res.rowcount:
+                    file._data.update(values)
+                    finished += 1
+        return finished
 
     def __getattr__(self, attr):
         """
@@ -97,7 +392,7 @@ class FilesWrapper:
         data = clean_dict(data)
         remaining = self.config.required_keys - set(data.keys())
         if remaining:
-            raise ValidationError(f"Missing keys: {remaining}")
+            raise ValidationError(f"Missing keys: {remaining}", remaining)
         return True
 
     def ensure(self, data):
@@ -111,3 +406,143 @@ class FilesWrapper:
             self._metadir._files_root, data[self._metadir.config.file_name]
         )
         return os.path.exists(fp)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _get_sort_key(order_by):
+    """
+    return (key function, reverse) to merge rows that are each sorted by
+    dataset's `order_by` (sqlite sorts `NULL` first)
+    """
+    if isinstance(order_by, str):
+        order_by = [order_by]
+    columns = [c.lstrip("-") for c in order_by]
+    descending = {c.startswith("-") for c in order_by}
+    if len(descending) > 1:
+        raise ValueError(
+            "Mixed sort directions are not supported for a sharded state db"
+        )
+
+    def key(file):
+        return tuple(
+            (file._data.get(c) is not None, file._data.get(c)) for c in columns
+        )
+
+    return key, descending.pop()
+
+
+class ShardedFilesWrapper(FilesWrapper):
+    """
+    fan out the operations of `FilesWrapper` over the shards of a sharded
+    state db (see `mmmeta.shards`), the shard connections are opened on
+    first access
+    """
+
+    def __init__(self, paths, metadir):
+        self._paths = paths
+        self._metadir = metadir
+        self.config = metadir.config
+        self._shards = None
+
+    def __len__(self):
+        return sum(len(s) for s in self.shards)
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        raise AttributeError(f"`{attr}` is not supported for a sharded state db")
+
+    @property
+    def shards(self):
+        if self._shards is None:
+            import dataset
+
+            self._shards = [
+                FilesWrapper(dataset.connect(f"sqlite:///{p}")["files"], self._metadir)
+                for p in self._paths
+            ]
+        return self._shards
+
+    @property
+    def columns(self):
+        columns = {}
+        for shard in self.shards:
+            columns.update(dict.fromkeys(shard._table.columns))
+        return list(columns)
+
+    def _get_shard(self, uid):
+        return self.shards[get_shard(uid, len(self._paths))]
+
+    def find(self, *args, columns=None, chunk_size=None, **kwargs):
+        uid = kwargs.get(self.config.unique)
+        if isinstance(uid, (str, int)):
+            # only one shard can match
+            shard = self._get_shard(uid)
+            return shard.find(*args, columns=columns, chunk_size=chunk_size, **kwargs)
+        limit = kwargs.pop("_limit", None)
+        offset = kwargs.pop("_offset", 0) or 0
+        order_by = kwargs.get("order_by")
+        files = [
+            s.find(
+                *args,
+                columns=columns,
+                chunk_size=chunk_size,
+                _limit=None if limit is None else limit + offset,
+                **kwargs,
+            )
+            for s in self.shards
+        ]
+        if order_by:
+            key, reverse = _get_sort_key(order_by)
+            files = heapq.merge(*files, key=key, reverse=reverse)
+        else:
+            files = chain(*files)
+        return islice(files, offset, None if limit is None else offset + limit)
+
+    def find_one(self, *args, **kwargs):
+        for file in self.find(*args, _limit=1, **kwargs):
+            return file
+
+    def _get_row(self, uid):
+        return self._get_shard(uid)._get_row(uid)
+
+    def claim(self, n=1, lease=timedelta(minutes=10), worker=None, **filters):
+        worker = worker or get_worker_id()
+        # start at a different shard per worker to spread the write locks
+        start = get_shard(worker, len(self._paths))
+        shards = self.shards[start:] + self.shards[:start]
+        files = []
+        for shard in shards:
+            files.extend(shard.claim(n - len(files), lease, worker, **filters))
+            if len(files) >= n:
+                break
+        return files
+
+    def _finish(self, files, data=None):
+        grouped = defaultdict(list)
+        for file in files:
+            grouped[get_shard(file.uid, len(self._paths))].append(file)
+        return sum(self.shards[i]._finish(f, data) for i, f in grouped.items())
+
+    def _has_changes(self):
+        return any(s._has_changes() for s in self.shards)
+
+    def _changes_page(self, cursor, limit, filters):
+        unique = self.config.unique
+        pages = [
+            s._changes_page(cursor, limit, filters)
+            for s in self.shards
+            if s._has_changes()
+        ]
+        rows = heapq.merge(*pages, key=lambda r: (r[CHANGED], r[unique]))
+        return list(islice(rows, limit))
@@ -1,7 +1,11 @@
+import atexit
 import logging
+import os
+import queue
 import sys
 import time
 import uuid
+from logging.handlers import QueueHandler, QueueListener
 
 import structlog
 from structlog.contextvars import (
@@ -16,12 +20,17 @@ LOG_FORMAT_TEXT = "TEXT"
 LOG_FORMAT_JSON = "JSON"
 
 
-def configure_logging(level=settings.LOGGING, out=sys.stdout):
+def configure_logging(level=settings.LOGGING, out=sys.stdout, use_queue=None):
     """
     default: mmmeta = INFO, all others = WARNING
+
+    use_queue: format and write log records in a background thread (via a
+    `QueueHandler` / `QueueListener`) instead of the logging thread
     """
+    if use_queue is None:
+        use_queue = settings.LOG_QUEUE
     if level is None:
-        _configure(level=logging.INFO, out=out)
+        _configure(level=logging.INFO, out=out, use_queue=use_queue)
         for logger_name in logging.root.manager.loggerDict:
             if "mmmeta" not in logger_name:
                 logger = logging.getLogger(logger_name)
@@ -29,11 +38,11 @@ def configure_logging(level=settings.LOGGING, out=sys.stdout):
     else:
         if isinstance(level, str):
             level = level.upper()
-        _configure(level, out=out)
+        _configure(level, out=out, use_queue=use_queue)
 
 
 # borrowed from aleph servicelayer
-def _configure(level=logging.INFO, out=sys.stdout):
+def _configure(level=logging.INFO, out=sys.stdout, use_queue=False):
     """Configure log levels and structured logging"""
     common_processors = [
         structlog.stdlib.add_log_level,
@@ -83,8 +92,26 @@ def _configure(level=logging.INFO, out=sys.stdout):
     root_logger.setLevel(logging.DEBUG)
     # check to prevent adding duplicate handlers
     if not root_logger.handlers:
-        root_logger.addHandler(out_handler)
-        root_logger.addHandler(error_handler)
+        if use_queue:
+            log_queue = queue.SimpleQueue()
+            listener = QueueListener(
+                log_queue, out_handler, error_handler, respect_handler_level=True
+            )
+            listener.start()
+            # flush the remaining records on exit
+            atexit.register(listener.stop)
+            root_logger.addHandler(_QueueHandler(log_queue))
+            # forked processes (sharded update) don't run the listener thread
+            os.register_at_fork(
+                after_in_child=lambda: _replace_handlers(root_logger, listener)
+            )
+        else:
+            root_logger.addHandler(out_handler)
+            root_logger.addHandler(error_handler)
+
+
+def _replace_handlers(logger, listener):
+    logger.handlers = list(listener.handlers)
 
 
 def format_stackdriver(_, __, ed):
@@ -109,6 +136,16 @@ def apply_task_context(task, **kwargs):
     )
 
 
+class _QueueHandler(QueueHandler):
+    """
+    pass the records as they are to the listener thread, the default
+    `prepare` would already render them here (and break structlog records)
+    """
+
+    def prepare(self, record):
+        return record
+
+
 class _MaxLevelFilter(object):
     def __init__(self, highest_log_level):
         self._highest_log_level = highest_log_level
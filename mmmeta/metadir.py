@@ -1,20 +1,24 @@
 import csv
 import os
+import sqlite3
 import sys
+from contextlib import closing
+from datetime import datetime
 
-import dataset
-from sqlalchemy.sql import func
-
-from . import settings
+from . import profiling, settings, shards, statistics, sync
+from .backend import get_backend
 from .backend.appendonly import AppendOnlyBackend
 from .backend.filesystem import FilesystemBackend
 from .backend.store import Store
 from .config import Config
-from .db import generate_metadata, update_state_db
-from .file import FilesWrapper
 
 
 class Metadir:
+    """
+    `dataset` (and with it sqlalchemy) is only imported when the databases
+    are accessed, so that light operations like `inspect` start fast
+    """
+
     def __init__(self, base_path=None, files_root=None):
         self._base_path = base_path or settings.MMMETA
         self._files_root = files_root or base_path or settings.MMMETA_FILES_ROOT
@@ -34,12 +38,37 @@ class Metadir:
 
     @property
     def files(self):
+        from .file import FilesWrapper, ShardedFilesWrapper
+
+        if self.shards:
+            return ShardedFilesWrapper(self._state_paths, self)
         return FilesWrapper(self._db["files"], self)
 
     @property  # Shorthand
     def _db(self):
+        import dataset
+
         return dataset.connect(self._db_path)
 
+    @property
+    def shards(self):
+        """number of state db shards, `None` if not sharded"""
+        return shards.get_shards(self._backend.base_path)
+
+    @property
+    def _state_paths(self):
+        return [self._backend.get_path(n) for n in shards.get_names(self.shards)]
+
+    def _get_db(self, uid):
+        """return the state db (shard) that holds the file with `uid`"""
+        import dataset
+
+        n = self.shards
+        if not n:
+            return self._db
+        path = self._backend.get_path(shards.get_name(shards.get_shard(uid, n), n))
+        return dataset.connect(f"sqlite:///{path}")
+
     def generate(
         self,
         path=None,
@@ -47,32 +76,142 @@ class Metadir:
         ensure_metadata=False,
         ensure_files=False,
         no_meta=False,
+        tempdir=None,
+        memory_limit=None,
     ):
         """
-        generate or update metadata
+        generate or update metadata, returns `stats.RunStats`. with `tempdir`
+        or `memory_limit` (bytes or like `512M`), a temporary database file
+        is used instead of memory
         """
-        backend = FilesystemBackend(path or self._files_root)
+        from .db import generate_metadata
+
+        backend = get_backend(path or self._files_root)
         return generate_metadata(
-            backend, self, replace, ensure_metadata, ensure_files, no_meta
+            backend,
+            self,
+            replace,
+            ensure_metadata,
+            ensure_files,
+            no_meta,
+            tempdir,
+            memory_limit,
         )
 
-    def squash(self):
-        self._metadata.squash()
+    def ingest(
+        self,
+        records,
+        ensure=False,
+        chunk_size=None,
+        replace=False,
+        tempdir=None,
+        memory_limit=None,
+    ):
+        """
+        generate or update metadata from an iterable of dicts instead of json
+        files, write a segment per `chunk_size` records (or one for all),
+        returns `stats.RunStats`
+        """
+        from .db import ingest_metadata
 
-    def update(self, replace=False, cleanup=False):
+        return ingest_metadata(
+            self, records, ensure, chunk_size, replace, tempdir, memory_limit
+        )
+
+    def squash(self, tempdir=None, memory_limit=None):
         """
-        update local state with meta db
+        replace the metadata history with one squashed segment, enforcing
+        the `retention` config (purge old soft deleted files, remove old
+        segments)
         """
-        return update_state_db(self, replace, cleanup)
+        purge_before = None
+        if self.config.tombstones is not None:
+            purge_before = datetime.now() - self.config.tombstones
+
+        def _write_statistics(table):
+            # purged files are gone from the statistics as well
+            facets = self.config.facets
+            statistics.write_file(self._metadata, statistics.compute(table, facets))
 
-    def inspect(self):
+        with profiling.marker("squash"):
+            return self._metadata.squash(
+                tempdir,
+                memory_limit,
+                purge_before,
+                self.config.history,
+                _write_statistics,
+            )
+
+    def contains(self, uid):
         """
-        return some insights
+        check if a (not deleted) file with `uid` exists in the meta db, this
+        works on a synced metadir without a state db
         """
-        return {
-            "files": len(self),
+        return uid in self._metadata.get_uids()
+
+    def contains_many(self, uids):
+        """
+        return the subset of `uids` that exist in the meta db
+        """
+        return self._metadata.get_uids().contains_many(uids)
+
+    def update(
+        self, replace=False, cleanup=False, swap=False, chunk_size=None, shards=None
+    ):
+        """
+        update local state with meta db, returns `stats.RunStats`. with
+        `swap`, the new state is built in a copy of the state db that is
+        swapped in at the end, so that consumers are never blocked. with
+        `chunk_size`, it is committed in chunks and resumed if interrupted.
+        `shards` changes the number of state db shards (1 for a single db)
+        """
+        from .db import update_state_db
+
+        return update_state_db(self, replace, cleanup, swap, chunk_size, shards)
+
+    def push(self, remote, workers=8):
+        """
+        upload new segments and store keys to remote archive (path or uri)
+        """
+        return sync.push(self, remote, workers)
+
+    def pull(self, remote, workers=8):
+        """
+        download new segments and store keys from remote archive (path or uri)
+        """
+        return sync.pull(self, remote, workers)
+
+    def inspect(self, stats=False):
+        """
+        return some insights, with `stats` include the precomputed statistics
+        of the state db and the metadata
+        """
+        data = {
+            "files": self._count_files(),
             "path": str(self._backend),
         }
+        if self.shards:
+            data["shards"] = self.shards
+        if stats:
+            data["statistics"] = {}
+            for path in self._state_paths:
+                for key, value in statistics.read_table(path).items():
+                    data["statistics"][key] = data["statistics"].get(key, 0) + value
+            data["meta_statistics"] = statistics.read_file(self._metadata)
+        return data
+
+    def _count_files(self):
+        # plain sqlite, as this is used for frequent monitoring
+        return sum(self._count_shard(p) for p in self._state_paths)
+
+    def _count_shard(self, path):
+        if not os.path.exists(path):
+            return 0
+        with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+            try:
+                return conn.execute("SELECT count(*) FROM files").fetchone()[0]
+            except sqlite3.OperationalError:  # no files table yet
+                return 0
 
     def touch(self, key):
         """
@@ -80,30 +219,44 @@ class Metadir:
         """
         return self.store.touch(key)
 
-    def dump(self, out=sys.stdout):
+    def dump(self, out=None, columns=None, chunk_size=1000):
         """
-        dump csv
+        dump csv, optionally only the given `columns` (including remote
+        attributes)
         """
-        file = self.files.find_one()
-        columns = set(file._data.keys()) | set(vars(file.remote).keys())
-        writer = csv.DictWriter(out, fieldnames=columns)
+        out = out or sys.stdout
+        remote = list(self.config._remote.keys())
+        if columns is None:
+            columns = self.files.columns + remote
+        writer = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore")
         writer.writeheader()
-        for file in self.files:
-            writer.writerow(file.serialize())
+        selected = [c for c in columns if c not in remote]
+        if set(columns) & set(remote):
+            # remote attributes are computed from all columns
+            selected = None
+        for file in self.files.find(columns=selected, chunk_size=chunk_size):
+            if selected is None:
+                writer.writerow(file.serialize())
+            else:
+                writer.writerow(file._data)
 
     @property
     def state_last_updated(self):
-        table = self.files._table.table
-        query = func.max(table.c["__state_last_updated"])
-        for res in self._db.query(query):
-            return res.get("max_1")
+        return self._get_max("__state_last_updated")
 
     @property
     def meta_last_updated(self):
-        table = self.files._table.table
-        query = func.max(table.c["__meta_last_updated"])
-        for res in self._db.query(query):
-            return res.get("max_1")
+        return self._get_max("__meta_last_updated")
+
+    def _get_max(self, column):
+        from sqlalchemy.sql import func
+
+        values = []
+        for files in self.files.shards:
+            query = func.max(files._table.table.c[column])
+            for res in files._table.db.query(query):
+                values.append(res.get("max_1"))
+        return max((v for v in values if v is not None), default=None)
 
     @property
     def last_touched(self):
@@ -0,0 +1,161 @@
+"""
+export run metrics in the prometheus textfile collector format:
+https://github.com/prometheus/node_exporter#textfile-collector
+"""
+
+import logging
+import os
+from datetime import datetime
+
+from .util import datetime_to_json, walk_files
+
+log = logging.getLogger(__name__)
+
+PREFIX = "mmmeta"
+LAST_SUCCESS = "{command}_last_success"  # store key, not synced
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    labels = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return "{" + labels + "}"
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+
+
+class Metrics:
+    """
+    collect gauges and render them in prometheus text format
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self._metrics = {}
+
+    def add(self, name, value, help="", **labels):
+        if value is None:
+            return
+        name = f"{PREFIX}_{name}"
+        if name not in self._metrics:
+            self._metrics[name] = (help, [])
+        self._metrics[name][1].append(({**self.labels, **labels}, value))
+
+    def __iter__(self):
+        for name, (help, samples) in self._metrics.items():
+            for labels, value in samples:
+                yield name, labels, value
+
+    def render(self):
+        lines = []
+        for name, (help, samples) in self._metrics.items():
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+
+
+def get_metrics(metadir, command, stats=None):
+    """
+    collect metrics for `metadir` after a run of `command`, `stats` is the
+    `stats.RunStats` of a successful run or `None` for a failed one
+    """
+    metrics = Metrics(metadir=metadir._base_path)
+    metrics.add(
+        "run_success",
+        int(stats is not None),
+        "Whether the last run was successful",
+        command=command,
+    )
+    if stats is not None:
+        for counter, value in stats.counters.items():
+            metrics.add(
+                "run_files",
+                value,
+                "Files by result of the last run",
+                command=command,
+                result=counter,
+            )
+        metrics.add(
+            "run_duration_seconds",
+            stats.wall,
+            "Wall time of the last run",
+            command=command,
+        )
+        for name, phase in stats.phases.items():
+            metrics.add(
+                "run_phase_duration_seconds",
+                phase.wall,
+                "Wall time per phase of the last run",
+                command=command,
+                phase=name,
+            )
+            metrics.add(
+                "run_phase_rows",
+                phase.rows,
+                "Rows per phase of the last run",
+                command=command,
+                phase=name,
+            )
+        metrics.add(
+            "table_files",
+            stats.total,
+            "Files in the meta or state database after the last run",
+            command=command,
+        )
+    # persisted, so that it is still there after a failed run
+    metrics.add(
+        "last_success_timestamp_seconds",
+        _timestamp(metadir.store[LAST_SUCCESS.format(command=command)]),
+        "Timestamp of the last successful run",
+        command=command,
+    )
+
+    segments = list(metadir._metadata.get_children())
+    metrics.add("segments", len(segments), "Segments in the metadata db")
+    metrics.add(
+        "metadir_bytes",
+        sum(e.stat().st_size for e in walk_files(metadir._backend.base_path)),
+        "Size of the metadir",
+    )
+    for key, value in metadir.store:
+        value = _timestamp(value)
+        if value is not None:
+            metrics.add(
+                "store_timestamp_seconds",
+                value,
+                "Timestamps from the metadir store",
+                key=key,
+            )
+    return metrics
+
+
+def write_textfile(path, metadir, command, stats=None):
+    """
+    atomically write metrics to `path` (should end in `.prom`), a `{command}`
+    placeholder in `path` is replaced with `command`, so that runs of
+    different commands don't overwrite each other's metrics
+    """
+    path = path.replace("{command}", command)
+    if stats is not None:
+        ts = stats.finished_at or datetime.now()
+        # local bookkeeping, not a change of the metadir
+        metadir.store.set_value(
+            LAST_SUCCESS.format(command=command), datetime_to_json(ts)
+        )
+    content = get_metrics(metadir, command, stats).render()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    log.info(f"Metrics written to `{path}`")
+    return path
@@ -0,0 +1,137 @@
+"""
+profiling of cli commands (`mmmeta --profile cpu|memory <command>`): a cpu
+profile as pstats file (e.g. for `python -m pstats` or snakeviz) or a report
+of the top memory allocations, both with the cpu time / allocated memory per
+phase of the run (the `stats.RunStats` phases and `marker`)
+"""
+
+import cProfile
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+PROFILES = ("cpu", "memory")
+TOP_N = 25  # allocations in the memory report
+FRAMES = 10  # traceback depth for memory allocations
+
+# the running profiler, phases are only measured if set
+active = None
+
+
+class Profiler:
+    def __init__(self, mode, out=None, top=TOP_N):
+        if mode not in PROFILES:
+            raise ValueError(f"Unsupported profile: `{mode}`")
+        self.mode = mode
+        self.out = out or f"mmmeta-{mode}.{'prof' if mode == 'cpu' else 'txt'}"
+        self.top = top
+        self.phases = {}  # name: [calls, cpu seconds, allocated bytes]
+        self._profile = None
+
+    def start(self):
+        global active
+        if self.mode == "cpu":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            tracemalloc.start(FRAMES)
+        active = self
+        return self
+
+    def stop(self):
+        """
+        stop profiling and write the profile to `out`, returns its path
+        """
+        global active
+        active = None
+        if self.mode == "cpu":
+            self._profile.disable()
+            self._profile.dump_stats(self.out)
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(self.out, "w") as f:
+                f.write(self.render_memory(snapshot, current, peak))
+        for line in self.render_phases():
+            log.info(f"Profile phase {line}")
+        log.info(f"Profile written to `{self.out}`")
+        return self.out
+
+    def detach(self):
+        """
+        stop profiling without writing the profile (in a forked process)
+        """
+        global active
+        active = None
+        if self.mode == "cpu":
+            self._profile.disable()
+        else:
+            tracemalloc.stop()
+
+    def enter(self):
+        if self.mode == "cpu":
+            return time.process_time()
+        return tracemalloc.get_traced_memory()[0]
+
+    def exit(self, name, start):
+        phase = self.phases.setdefault(name, [0, 0, 0])
+        phase[0] += 1
+        if self.mode == "cpu":
+            phase[1] += time.process_time() - start
+        else:
+            phase[2] += tracemalloc.get_traced_memory()[0] - start
+
+    def render_phases(self):
+        for name, (calls, cpu, allocated) in self.phases.items():
+            if self.mode == "cpu":
+                yield f"{name}: {cpu:.3f}s cpu ({calls} calls)"
+            else:
+                yield f"{name}: {_format_size(allocated)} allocated ({calls} calls)"
+
+    def render_memory(self, snapshot, current, peak):
+        # ignore the profiler itself and module imports
+        snapshot = snapshot.filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            )
+        )
+        lines = [
+            "# mmmeta memory profile",
+            f"peak: {_format_size(peak)}, current: {_format_size(current)}",
+            "",
+            "## phases (net allocated)",
+            *self.render_phases(),
+            "",
+            f"## top {self.top} allocations",
+        ]
+        for stat in snapshot.statistics("traceback")[: self.top]:
+            lines.append(f"{_format_size(stat.size)} in {stat.count} blocks")
+            traceback = stat.traceback.format(limit=FRAMES, most_recent_first=True)
+            lines.extend(f"  {line}" for line in traceback)
+        return "\n".join(lines) + "\n"
+
+
+def _format_size(size):
+    return f"{size / 1024 / 1024:.2f} MiB"
+
+
+@contextmanager
+def marker(name):
+    """
+    measure a phase `name` if a profiler is running
+    """
+    profiler = active
+    if profiler is None:
+        yield
+        return
+    start = profiler.enter()
+    try:
+        yield
+    finally:
+        profiler.exit(name, start)
@@ -5,8 +5,42 @@ def get_env(key, default=None):
     return os.environ.get(key, default)
 
 
+def get_path(path):
+    # remote uris like s3://bucket/prefix
+    if "://" in path:
+        return path
+    return os.path.abspath(path)
+
+
 MMMETA = os.path.abspath(get_env("MMMETA", os.getcwd()))
-MMMETA_FILES_ROOT = os.path.abspath(get_env("MMMETA_FILES_ROOT", MMMETA))
+MMMETA_FILES_ROOT = get_path(get_env("MMMETA_FILES_ROOT", MMMETA))
+# parallel threads for walking the files root (for high-latency filesystems)
+MMMETA_WALK_WORKERS = int(get_env("MMMETA_WALK_WORKERS", 1))
+
+# identifier for this publisher in metadata segment names (default: hostname_pid)
+MMMETA_WRITER_ID = get_env("MMMETA_WRITER_ID")
+
+# s3 compatible storage for files root
+MMMETA_S3_ENDPOINT_URL = get_env("MMMETA_S3_ENDPOINT_URL")
+MMMETA_S3_WORKERS = int(get_env("MMMETA_S3_WORKERS", 16))
+
+# remote archive root (path or uri) for `mmmeta sync`
+MMMETA_REMOTE = get_env("MMMETA_REMOTE")
+
+# parallel processes for parsing metadata segments (replaying the history)
+MMMETA_LOAD_WORKERS = int(get_env("MMMETA_LOAD_WORKERS", 1))
+
+# parallel processes for updating a sharded state db (default: cpu count)
+MMMETA_SHARD_WORKERS = int(get_env("MMMETA_SHARD_WORKERS", 0))
+
+MMMETA_METRICS_TEXTFILE = get_env("MMMETA_METRICS_TEXTFILE")
+
+# temporary on-disk database instead of memory for `generate` and `squash`,
+# the memory limit (like `512M`) bounds its page cache
+MMMETA_TEMPDIR = get_env("MMMETA_TEMPDIR")
+MMMETA_MEMORY_LIMIT = get_env("MMMETA_MEMORY_LIMIT")
 
 LOGGING = get_env("LOGGING")
 LOG_FORMAT = get_env("LOG_FORMAT", "TEXT")
+# format and write logs in a background thread
+LOG_QUEUE = get_env("LOG_QUEUE", "").lower() in ("1", "true", "yes")
@@ -0,0 +1,103 @@
+"""
+optional hash partitioned layout of the state db: files are distributed over
+`n` sqlite files `_mmmeta/state.<i>-of-<n>.db` by a crc32 hash of their
+unique key, so that `update` can process the shards in parallel processes.
+
+the layout is detected from the files on disk (`update --shards N` migrates
+an existing state db), `FilesWrapper` fans out over the shards transparently.
+a migration writes the new layout next to the old one and records it in the
+`_mmmeta/state.reshard` marker before switching: once the new layout is
+complete it is the current one, left over files of the old layout are ignored
+(and removed by the next update)
+"""
+
+import os
+import re
+import zlib
+
+from .exceptions import ConfigError
+
+STATE_DB = "state.db"
+PATTERN = re.compile(r"^state\.(\d+)-of-(\d+)\.db$")
+MARKER = "state.reshard"
+
+
+def get_shard(uid, shards):
+    """
+    return the shard index of `uid` for a layout of `shards` files
+    """
+    return zlib.crc32(str(uid).encode()) % shards
+
+
+def get_name(shard, shards):
+    return f"state.{shard}-of-{shards}.db"
+
+
+def get_names(shards):
+    """
+    file names of the state db(s) for a layout of `shards` files (`None`
+    or 1 for the single `state.db`)
+    """
+    if not shards or shards < 2:
+        return [STATE_DB]
+    return [get_name(i, shards) for i in range(shards)]
+
+
+def get_db_name(name):
+    """
+    return the state db name (of any layout) the file `name` belongs to (the
+    db itself or one of its journal files), `None` for other files
+    """
+    name = re.sub(r"-(wal|shm|journal)$", "", name)
+    if name == STATE_DB or PATTERN.match(name):
+        return name
+
+
+def get_migration(path):
+    """
+    return the number of shards a migration in the metadir at `path` switches
+    to, `None` if there is no (interrupted) migration
+    """
+    try:
+        with open(os.path.join(path, MARKER)) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return
+
+
+def get_shards(path):
+    """
+    detect the number of shards in the metadir at `path`, `None` if the state
+    db is not sharded
+    """
+    if not os.path.isdir(path):
+        return
+    found = {}
+    for name in os.listdir(path):
+        match = PATTERN.match(name)
+        if match:
+            shard, shards = int(match.group(1)), int(match.group(2))
+            found.setdefault(shards, set()).add(shard)
+    target = get_migration(path)
+    if target is not None:
+        names = get_names(target)
+        if all(os.path.exists(os.path.join(path, n)) for n in names):
+            # the migration switched, ignore the old layout
+            return target if target > 1 else None
+        # not switched yet, the old layout is still the current one
+        found.pop(target, None)
+    if not found:
+        return
+    if len(found) > 1:
+        raise ConfigError(
+            f"Mixed state db shard layouts in `{path}`: {sorted(found)}. "
+            "Run `update --shards N` to migrate."
+        )
+    shards, existing = found.popitem()
+    missing = set(range(shards)) - existing
+    if missing:
+        raise ConfigError(
+            f"Missing state db shards in `{path}`: "
+            f"{', '.join(get_name(i, shards) for i in sorted(missing))}"
+        )
+    return shards
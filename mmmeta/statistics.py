@@ -0,0 +1,161 @@
+"""
+precomputed statistics about the files (counts per deletion reason and
+configured facets, total file size), so that `inspect --stats` doesn't need to
+scan the files tables.
+
+`update` keeps them in the `statistics` table of the state db and applies the
+changes of each run incrementally. `generate` writes them for the meta db to
+`_mmmeta/db/statistics` (json), so that they are synced to consumers as well.
+"""
+
+import json
+import os
+import sqlite3
+from collections import Counter
+from contextlib import closing
+
+from .util import cast
+
+TABLE = "statistics"
+FILE = "statistics"
+
+
+def _is_deleted(row):
+    return row.get("__deleted") is not None
+
+
+def _file_size(value):
+    value = cast(value)
+    if isinstance(value, (int, float)):
+        return value
+    return 0
+
+
+def get_contribution(row, facets=()):
+    """
+    return the statistics counter for a single `row`
+    """
+    res = Counter(total=1)
+    if _is_deleted(row):
+        res["deleted"] += 1
+        res[f"deleted:{row.get('__deleted_reason') or 'unknown'}"] += 1
+        return res
+    res["active"] += 1
+    for facet in facets:
+        value = row.get(facet)
+        if value is not None:
+            res[f"facet:{facet}:{value}"] += 1
+    size = _file_size(row.get("file_size"))
+    if size:
+        res["file_size"] += size
+    return res
+
+
+def add_change(delta, old, new, facets=()):
+    """
+    account the change of a row from `old` to `new` (either may be `None`)
+    in the `delta` counter
+    """
+    if old is not None:
+        delta.subtract(get_contribution(old, facets))
+    if new is not None:
+        delta.update(get_contribution(new, facets))
+
+
+def compute(table, facets=()):
+    """
+    compute the statistics for a whole dataset `table` via sql aggregations
+    """
+    from sqlalchemy import func, literal, select
+
+    res = Counter()
+    if not table.exists:
+        return res
+    columns = table.table.c
+    if "__deleted" in columns:
+        deleted = columns["__deleted"].isnot(None)
+        active = columns["__deleted"].is_(None)
+    else:
+        deleted, active = literal(False), literal(True)
+    reason = columns["__deleted_reason"] if "__deleted_reason" in columns else None
+
+    table_ = table.table
+    query = select(func.count().label("count")).select_from(table_).where(deleted)
+    if reason is not None:
+        query = query.add_columns(reason.label("reason")).group_by(reason)
+    for row in table.db.query(query):
+        if row["count"]:
+            res["deleted"] += row["count"]
+            res[f"deleted:{row.get('reason') or 'unknown'}"] += row["count"]
+
+    query = select(func.count().label("count")).select_from(table_).where(active)
+    for row in table.db.query(query):
+        res["active"] = row["count"]
+    res["total"] = res["active"] + res["deleted"]
+    for facet in facets:
+        if facet not in columns:
+            continue
+        column = columns[facet]
+        query = (
+            select(column.label("value"), func.count().label("count"))
+            .where(active)
+            .where(column.isnot(None))
+            .group_by(column)
+        )
+        for row in table.db.query(query):
+            res[f"facet:{facet}:{row['value']}"] += row["count"]
+    if "file_size" in columns:
+        # sqlite sums up numeric strings (meta db) as well
+        query = select(func.sum(columns["file_size"]).label("size")).where(active)
+        for row in table.db.query(query):
+            res["file_size"] = row["size"] or 0
+    return _clean(res)
+
+
+def _clean(statistics):
+    # keep the main counts always
+    res = {"total": 0, "active": 0, "deleted": 0}
+    res.update({k: v for k, v in statistics.items() if v})
+    return res
+
+
+def update_table(tx, files, delta, facets=(), rebuild=False):
+    """
+    apply `delta` to the statistics table in `tx` or rebuild it from the
+    `files` table if it doesn't exist yet
+    """
+    if rebuild or not tx.has_table(TABLE):
+        if tx.has_table(TABLE):
+            tx[TABLE].drop()
+        current = compute(files, facets)
+    else:
+        current = Counter({r["name"]: r["value"] for r in tx[TABLE]})
+        current.update(delta)
+        current = _clean(current)
+    table = tx.get_table(TABLE, primary_id="name", primary_type=tx.types.text)
+    table.delete()
+    table.insert_many([{"name": k, "value": v} for k, v in sorted(current.items())])
+    return current
+
+
+def read_table(db_path):
+    """
+    read the statistics of a state db at `db_path` (plain sqlite for speed)
+    """
+    if not os.path.exists(db_path):
+        return {}
+    with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+        try:
+            return dict(conn.execute(f"SELECT name, value FROM {TABLE}").fetchall())
+        except sqlite3.OperationalError:  # no statistics yet
+            return {}
+
+
+def write_file(backend, statistics):
+    backend.save(FILE, json.dumps(statistics, indent=2, sort_keys=True))
+
+
+def read_file(backend):
+    if not backend.exists(FILE):
+        return {}
+    return json.loads(backend.load_bytes(FILE))
@@ -0,0 +1,217 @@
+import json
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+
+import structlog
+
+from . import profiling
+from .util import datetime_to_json
+
+log = structlog.wrap_logger(logging.getLogger(__name__))
+
+COUNTERS = ("updated", "added", "invalid", "deleted", "skipped")
+INVALID_EXAMPLES = 5  # logged example files per set of missing keys
+
+
+class Phase:
+    """
+    accumulated wall time, rows and bytes of one phase of a run, can be
+    entered multiple times (e.g. once per row)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0
+        self.rows = 0
+        self.bytes = 0
+        self._start = None
+        self._profiler = None
+
+    def __enter__(self):
+        # phase markers for `mmmeta --profile`
+        self._profiler = profiling.active
+        if self._profiler is not None:
+            self._marker = self._profiler.enter()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.wall += time.perf_counter() - self._start
+        if self._profiler is not None:
+            self._profiler.exit(self.name, self._marker)
+
+    def serialize(self):
+        return {
+            "wall": round(self.wall, 6),
+            "rows": self.rows,
+            "rows_per_second": round(self.rows / self.wall, 2) if self.wall else None,
+            "bytes": self.bytes,
+        }
+
+
+class InvalidFiles:
+    """
+    invalid files aggregated by their set of missing keys, with the first
+    `examples` files of each set kept as examples
+    """
+
+    def __init__(self, examples=INVALID_EXAMPLES):
+        self.max_examples = examples
+        self.counts = Counter()
+        self.examples = {}
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def add(self, missing, uid):
+        """
+        count an invalid file, returns if it is kept as example
+        """
+        key = tuple(sorted(missing))
+        self.counts[key] += 1
+        examples = self.examples.setdefault(key, [])
+        if len(examples) < self.max_examples:
+            examples.append(uid)
+            return True
+        return False
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        for key, examples in other.examples.items():
+            own = self.examples.setdefault(key, [])
+            own.extend(examples[: self.max_examples - len(own)])
+
+    def serialize(self):
+        return [
+            {"missing": list(key), "count": count, "examples": self.examples[key]}
+            for key, count in self.counts.most_common()
+        ]
+
+
+class RunStats:
+    """
+    counters and per-phase timings of a `generate` or `update` run
+
+    for backwards compatibility it behaves like the tuple
+    (updated, added, invalid, deleted, skipped)
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.total = None
+        self.phases = {}
+        self.invalid = InvalidFiles()
+        self._start = time.perf_counter()
+        self.wall = 0
+
+    def __getitem__(self, index):
+        return self.as_tuple()[index]
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def __len__(self):
+        return len(COUNTERS)
+
+    def __eq__(self, other):
+        return self.as_tuple() == tuple(other)
+
+    def __repr__(self):
+        return f"<RunStats `{self.command}`: {self.counters}>"
+
+    def as_tuple(self):
+        return tuple(self.counters[c] for c in COUNTERS)
+
+    def phase(self, name):
+        """
+        context manager to measure (accumulated) wall time for phase `name`:
+
+            with stats.phase("load") as phase:
+                phase.rows += 1
+        """
+        if name not in self.phases:
+            self.phases[name] = Phase(name)
+        return self.phases[name]
+
+    def iterate(self, name, iterable):
+        """
+        yield from `iterable` and measure the time spent in it (e.g. for
+        lazy loading) as phase `name`
+        """
+        phase = self.phase(name)
+        iterable = iter(iterable)
+        while True:
+            with phase:
+                try:
+                    item = next(iterable)
+                except StopIteration:
+                    return
+            phase.rows += 1
+            yield item
+
+    def count(self, counter, value=1):
+        self.counters[counter] += value
+
+    def add_invalid(self, missing, uid):
+        """
+        count an invalid file by its `missing` keys, returns if it should be
+        logged (only the first examples for each set of missing keys)
+        """
+        self.count("invalid")
+        return self.invalid.add(missing, uid)
+
+    def merge(self, other):
+        """
+        add the counters, phases and invalid files of `other` (e.g. the run
+        of a state db shard) to this run
+        """
+        for counter, value in other.counters.items():
+            self.count(counter, value)
+        if other.total is not None:
+            self.total = (self.total or 0) + other.total
+        for name, phase in other.phases.items():
+            own = self.phase(name)
+            own.wall += phase.wall
+            own.rows += phase.rows
+            own.bytes += phase.bytes
+        self.invalid.merge(other.invalid)
+        return self
+
+    def finish(self, total=None):
+        self.finished_at = datetime.now()
+        self.wall = time.perf_counter() - self._start
+        if total is not None:
+            self.total = total
+        for item in self.invalid.serialize():
+            log.warning(
+                f"{item['count']} invalid files. Missing keys: {item['missing']}",
+                examples=item["examples"],
+            )
+        log.info("mmmeta run", **self.serialize())
+        return self
+
+    @property
+    def changed(self):
+        """added, updated, invalid or deleted"""
+        return any(self[:4])
+
+    def serialize(self):
+        return {
+            "command": self.command,
+            "started_at": datetime_to_json(self.started_at),
+            "finished_at": datetime_to_json(self.finished_at),
+            "wall": round(self.wall, 6),
+            "total": self.total,
+            **self.counters,
+            "invalid_files": self.invalid.serialize(),
+            "phases": {k: p.serialize() for k, p in self.phases.items()},
+        }
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.serialize(), f, indent=2)
@@ -0,0 +1,158 @@
+"""
+incremental synchronization of a local metadir with a remote one (on a local
+path or any other storage backend) based on a manifest of file checksums.
+
+segments (`db/*.append`, `db/*.squashed`) are immutable, so their checksums
+are only computed once and only missing segments are transferred.
+"""
+
+import fnmatch
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha1
+
+from .backend import get_backend
+from .shards import MARKER
+
+log = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+LOCAL_MANIFEST = ".manifest.json"  # cache for local checksums
+SEGMENTS = (".append", ".squashed")
+# consumer-local files, local timestamps and temporary files are never synced
+EXCLUDE = (
+    "state*.db*",
+    MARKER,
+    ".*",
+    "*.tmp",
+    MANIFEST,
+    # local index, rebuilt from the segments on first use
+    "db/uids",
+    "_store/state_last_updated",
+    "_store/store_last_updated",
+    "_store/*_last_success",
+)
+
+
+def is_excluded(path):
+    name = os.path.basename(path)
+    return any(
+        fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern)
+        for pattern in EXCLUDE
+    )
+
+
+def build_manifest(backend, cache=None):
+    """
+    return a manifest {relative path: checksum} for all files in the metadir
+    of `backend` (a local filesystem backend), checksums of immutable segments
+    are taken from `cache` if present
+    """
+    cache = cache or {}
+    manifest = {}
+    for _, fp in backend.get_children():
+        path = os.path.relpath(fp, backend.base_path).replace(os.sep, "/")
+        if is_excluded(path):
+            continue
+        if path.endswith(SEGMENTS) and path in cache:
+            manifest[path] = cache[path]
+        else:
+            manifest[path] = sha1(backend.load_bytes(path)).hexdigest()
+    return manifest
+
+
+def drop_obsolete(manifest, *others):
+    """
+    drop the segments before the most recent squashed one (of `manifest` and
+    `others`) from `manifest`, they are never replayed (see
+    `AppendOnlyBackend.get_steps`) and may be removed by `squash`
+    """
+    squashed = [
+        os.path.basename(p)
+        for m in (manifest, *others)
+        for p in m
+        if p.endswith(".squashed")
+    ]
+    if not squashed:
+        return manifest
+    first = max(squashed)
+    return {
+        p: c
+        for p, c in manifest.items()
+        if not p.endswith(SEGMENTS) or os.path.basename(p) >= first
+    }
+
+
+def load_manifest(backend, path=MANIFEST):
+    if not backend.exists(path):
+        return {}
+    return json.loads(backend.load(path))["files"]
+
+
+def dump_manifest(backend, manifest, path=MANIFEST):
+    data = {"updated_at": datetime.now().isoformat(), "files": manifest}
+    backend.save(path, json.dumps(data, indent=2, sort_keys=True))
+
+
+def _transfer(source, target, paths, workers):
+    def _copy(path):
+        content = source.load_bytes(path)
+        target.save(path, content)
+        return len(content)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(_copy, paths))
+
+
+def push(metadir, remote, workers=8):
+    """
+    upload new or changed files from local `metadir` to `remote` (a path or
+    uri of the remote archive root or a backend for its metadir)
+    """
+    remote = _get_remote(remote)
+    local = metadir._backend
+    remote_manifest = load_manifest(remote)
+    cache = {**load_manifest(local, LOCAL_MANIFEST), **remote_manifest}
+    # squash can't remove segments while they are read
+    with metadir._metadata.lock():
+        manifest = drop_obsolete(build_manifest(local, cache), remote_manifest)
+        paths = sorted(p for p, c in manifest.items() if remote_manifest.get(p) != c)
+        log.info(f"Pushing {len(paths)} files to `{remote}` ...")
+        size = _transfer(local, remote, paths, workers)
+    # write manifest at last so that remote readers only see complete data.
+    # segments squashed (and maybe pruned) locally are dropped
+    dump_manifest(remote, drop_obsolete({**remote_manifest, **manifest}))
+    dump_manifest(local, manifest, LOCAL_MANIFEST)
+    log.info(f"Pushed {len(paths)} files ({size} bytes).")
+    return {"transferred": len(paths), "bytes": size, "total": len(manifest)}
+
+
+def pull(metadir, remote, workers=8):
+    """
+    download new or changed files from `remote` (a path or uri of the remote
+    archive root or a backend for its metadir) to local `metadir`
+    """
+    remote = _get_remote(remote)
+    local = metadir._backend
+    manifest = build_manifest(local, load_manifest(local, LOCAL_MANIFEST))
+    # segments before a local squashed one are not needed
+    remote_manifest = drop_obsolete(load_manifest(remote), manifest)
+    paths = sorted(p for p, c in remote_manifest.items() if manifest.get(p) != c)
+    log.info(f"Pulling {len(paths)} files from `{remote}` ...")
+    # like any other writer of segments
+    with metadir._metadata.lock():
+        size = _transfer(remote, local, paths, workers)
+    dump_manifest(local, {**manifest, **remote_manifest}, LOCAL_MANIFEST)
+    log.info(f"Pulled {len(paths)} files ({size} bytes).")
+    return {"transferred": len(paths), "bytes": size, "total": len(remote_manifest)}
+
+
+def _get_remote(remote):
+    if isinstance(remote, str):
+        if remote.startswith("s3://"):
+            return get_backend(remote.rstrip("/") + "/_mmmeta")
+        return get_backend(os.path.join(remote, "_mmmeta"))
+    return remote
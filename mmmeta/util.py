@@ -1,25 +1,108 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mmap
 import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import date, datetime
-from hashlib import sha1
+from operator import attrgetter
 from pathlib import Path
 
+from . import settings
+
 # from banal import as_bool, clean_dict
 
+try:
+    import ijson
+except ImportError:  # pragma: no cover
+    ijson = None
+
 BUF_SIZE = 1024 * 1024 * 16
-HASH_LENGTH = 40  # sha1
+HASH_ALGORITHMS = ("sha1", "sha256", "blake2b")
+MMAP_THRESHOLD = BUF_SIZE  # larger files are hashed via `mmap`
+PREHASH_SAMPLE_SIZE = 1024 * 64
+JSON_STREAM_THRESHOLD = 1024 * 1024 * 64  # larger json is parsed incrementally
+
+_buffers = threading.local()
+
+log = logging.getLogger(__name__)
+
+
+def _scan_directory(directory, exclude=(), suffix=None):
+    """
+    scan a single `directory` and return a tuple of (files, subdirectories)
+    as `os.DirEntry` objects, both sorted by name
+    """
+    files, dirs = [], []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # same as `os.walk`: don't follow symlinked directories
+                    if entry.name not in exclude and not entry.is_symlink():
+                        dirs.append(entry)
+                elif suffix is None or entry.name.endswith(suffix):
+                    files.append(entry)
+    except OSError:
+        # same as `os.walk`: ignore unreadable directories
+        pass
+    key = attrgetter("name")
+    return sorted(files, key=key), sorted(dirs, key=key)
 
 
-def get_files(directory, condition=lambda x: True):
+def walk_files(directory, exclude=(), suffix=None, workers=None):
+    """
+    yield `os.DirEntry` objects for files in given `directory` incl.
+    subdirectories. directories named in `exclude` are pruned, `suffix` (str
+    or tuple) is matched against the file names only.
+    with `workers` > 1 subdirectories are scanned in parallel threads (useful
+    for high-latency filesystems), then the order of results is not stable.
+    """
+    exclude = set(exclude)
+    if workers and workers > 1:
+        yield from _walk_files_parallel(directory, exclude, suffix, workers)
+        return
+    stack = [directory]
+    while stack:
+        files, dirs = _scan_directory(stack.pop(), exclude, suffix)
+        yield from files
+        stack.extend(d.path for d in reversed(dirs))
+
+
+def _walk_files_parallel(directory, exclude, suffix, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_directory, directory, exclude, suffix)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                for d in dirs:
+                    pending.add(
+                        executor.submit(_scan_directory, d.path, exclude, suffix)
+                    )
+                yield from files
+
+
+def get_files(directory, condition=None, exclude=(), suffix=None, workers=None):
     """
     yield tuples of (filename, path) for files in given `directory`
     that match `condition` (default: all) incl. subdirectories
+
+    see `walk_files` for `exclude`, `suffix` and `workers`
     """
-    return (
-        (os.path.splitext(f)[0], os.path.join(d, f))
-        for d, _, fnames in os.walk(directory)
-        for f in fnames
-        if condition(os.path.join(d, f))
-    )
+    for entry in walk_files(directory, exclude, suffix, workers):
+        if condition is None or condition(entry.path):
+            yield os.path.splitext(entry.name)[0], entry.path
 
 
 def cast(value, with_date=False):
@@ -67,23 +150,225 @@ def robust_dict(d):
     return {k: str(v) if v else None for k, v in flatten_dict(d).items()}
 
 
+def get_projection(keys):
+    """
+    build a prefix tree from flattened `keys` (like `publisher:name`) to only
+    select these values from nested data, `None` marks a selected key
+    """
+    tree = {}
+    for key in keys:
+        node = tree
+        for part in key.split(":"):
+            node = node.setdefault(part, {})
+        node[None] = True
+    return tree
+
+
+def _get_node(tree, key):
+    # keys are normalized like in `flatten_dict`
+    for part in key.replace("-", "_").split(":"):
+        tree = tree.get(part)
+        if tree is None:
+            return
+    return tree
+
+
+def project_dict(data, projection, prefix=""):
+    """
+    yield flattened (key, value) pairs of nested `data` like `flatten_dict`,
+    but only the ones selected by `projection` (see `get_projection`), other
+    subtrees are skipped
+    """
+    for key, value in data.items():
+        node = _get_node(projection, key)
+        if node is None:
+            continue
+        key = prefix + key.replace("-", "_")
+        if isinstance(value, dict):
+            yield from project_dict(value, node, key + ":")
+        elif None in node:
+            yield key, value
+
+
+def _skip_events(events):
+    depth = 1
+    for _, event, _ in events:
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def _build_events(event, events):
+    builder = ijson.ObjectBuilder()
+    builder.event(event, None)
+    depth = 1
+    for _, event, value in events:
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+            if depth == 0:
+                return builder.value
+
+
+def project_events(events, projection, prefix=""):
+    """
+    same as `project_dict` for `ijson.parse` events of a json object (after
+    its `start_map` event), skipped subtrees are never built
+    """
+    for _, event, key in events:
+        if event == "end_map":
+            return
+        _, event, value = next(events)
+        node = _get_node(projection, key)
+        key = prefix + key.replace("-", "_")
+        if event == "start_map":
+            if node is None:
+                _skip_events(events)
+            else:
+                yield from project_events(events, node, key + ":")
+        elif node is None or None not in node:
+            if event == "start_array":
+                _skip_events(events)
+        elif event == "start_array":
+            yield key, _build_events(event, events)
+        else:
+            yield key, value
+
+
+def robust_projection(data, projection):
+    """
+    `robust_dict` of only the values selected by `projection`, so large
+    unselected values are never flattened or stringified. `data` can be a dict
+    or json content, large json is parsed incrementally (if `ijson` is
+    installed)
+    """
+    if isinstance(data, (str, bytes)):
+        if ijson is not None and len(data) > JSON_STREAM_THRESHOLD:
+            if isinstance(data, str):
+                data = data.encode()
+            events = ijson.parse(data, use_float=True)
+            if next(events)[1] != "start_map":
+                raise ValueError("Metadata is not a json object")
+            items = project_events(events, projection)
+        else:
+            items = project_dict(json.loads(data), projection)
+    else:
+        items = project_dict(data, projection)
+    return {k: str(v) if v else None for k, v in items}
+
+
+def parse_size(value):
+    """
+    parse a size in bytes like `1048576`, `512K`, `256M` or `2G`
+    """
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+@contextmanager
+def tmp_db(tempdir=None, memory_limit=None):
+    """
+    yield a transaction on a temporary sqlite database: in memory by default,
+    or in a temporary file in `tempdir` with a page cache of at most
+    `memory_limit` (bytes or like `512M`) to keep memory bounded for large
+    metadata
+    """
+    import dataset
+
+    tempdir = tempdir or settings.MMMETA_TEMPDIR
+    memory_limit = parse_size(memory_limit or settings.MMMETA_MEMORY_LIMIT)
+    if not tempdir and not memory_limit:
+        with dataset.connect("sqlite:///:memory:") as tx:
+            yield tx
+        return
+
+    fd, path = tempfile.mkstemp(prefix="mmmeta-", suffix=".db", dir=tempdir)
+    os.close(fd)
+    # a throwaway db doesn't need durability
+    statements = [
+        "PRAGMA journal_mode=OFF",
+        "PRAGMA synchronous=OFF",
+        "PRAGMA locking_mode=EXCLUSIVE",
+        "PRAGMA temp_store=FILE",
+    ]
+    if memory_limit:
+        statements.append(f"PRAGMA cache_size=-{max(memory_limit // 1024, 1)}")
+    db = dataset.connect(
+        f"sqlite:///{path}", sqlite_wal_mode=False, on_connect_statements=statements
+    )
+    log.info(f"Using temporary database `{path}` ...")
+    try:
+        with db as tx:
+            yield tx
+    finally:
+        db.close()
+        os.remove(path)
+
+
 def ensure_path(file_path):
     if file_path is None or isinstance(file_path, Path):
         return file_path
     return Path(file_path).resolve()
 
 
-def checksum(file_name):
+def get_hasher(algorithm="sha1"):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm: `{algorithm}`")
+    return hashlib.new(algorithm)
+
+
+def _get_buffer():
+    # one reusable read buffer per thread
+    if not hasattr(_buffers, "buffer"):
+        _buffers.buffer = bytearray(BUF_SIZE)
+    return _buffers.buffer
+
+
+def checksum(file_name, algorithm="sha1"):
     """Generate a hash for a given file name."""
     file_name = ensure_path(file_name)
     if file_name is not None and file_name.is_file():
-        digest = sha1()
+        digest = get_hasher(algorithm)
+        with open(file_name, "rb", buffering=0) as fh:
+            if os.fstat(fh.fileno()).st_size > MMAP_THRESHOLD:
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    digest.update(mm)
+            else:
+                view = memoryview(_get_buffer())
+                while True:
+                    size = fh.readinto(view)
+                    if not size:
+                        break
+                    digest.update(view[:size])
+        return str(digest.hexdigest())
+
+
+def prehash(file_name, algorithm="sha1", sample_size=PREHASH_SAMPLE_SIZE):
+    """
+    Generate a quick fingerprint for a given file name from its size, mtime
+    and a sample of its head and tail. Only useful for change detection, this
+    is not a content hash.
+    """
+    file_name = ensure_path(file_name)
+    if file_name is not None and file_name.is_file():
+        digest = get_hasher(algorithm)
         with open(file_name, "rb") as fh:
-            while True:
-                block = fh.read(BUF_SIZE)
-                if not block:
-                    break
-                digest.update(block)
+            stat = os.fstat(fh.fileno())
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}:".encode())
+            digest.update(fh.read(sample_size))
+            if stat.st_size > sample_size:
+                fh.seek(max(sample_size, stat.st_size - sample_size))
+                digest.update(fh.read(sample_size))
         return str(digest.hexdigest())
 
 
@@ -104,3 +389,37 @@ def dict_is_subset(dict1, dict2, ignore=set()):
 def datetime_to_json(value):
     if isinstance(value, date):
         return value.isoformat()
+
+
+def read_ndjson(path):
+    """
+    yield records from a newline delimited json file at `path` (`-` for
+    stdin), gzip compressed input is detected automatically. lines with
+    invalid json or other values than objects are logged and skipped
+    """
+    if path == "-":
+        raw = sys.stdin.buffer
+        if not hasattr(raw, "peek"):
+            raw = io.BufferedReader(raw)
+    else:
+        raw = open(path, "rb")
+    try:
+        fh = raw
+        if raw.peek(2)[:2] == b"\x1f\x8b":
+            fh = gzip.GzipFile(fileobj=raw)
+        for number, line in enumerate(fh, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                log.error(f"Invalid json in `{path}` line {number}: {e}")
+                continue
+            if not isinstance(record, dict):
+                log.error(f"Not a json object in `{path}` line {number}")
+                continue
+            yield record
+    finally:
+        if path != "-":
+            raw.close()
@@ -33,5 +33,6 @@ setup(
         "python-dateutil",
         "structlog",
     ],
+    extras_require={"s3": ["boto3"], "ijson": ["ijson"]},
     zip_safe=False,
 )
@@ -1,12 +1,20 @@
 from uuid import uuid4
 import os
 import shutil
+import threading
 import unittest
 from datetime import datetime
+from unittest.mock import patch
 
 import dataset
 
 from mmmeta.backend.appendonly import AppendOnlyBackend
+from mmmeta.backend.uids import UidIndex, write_uids
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 
 class Test(unittest.TestCase):
@@ -91,3 +99,184 @@ class Test(unittest.TestCase):
             backend.load(table)
             data = table.find_one(uid=1)
             self.assertEqual(data["foo"], "bar2")
+
+    def test_concurrent_writers(self):
+        backends = [
+            AppendOnlyBackend("./testdata/aof", unique="uid", writer_id=f"writer{i}")
+            for i in range(4)
+        ]
+
+        def _write(backend):
+            for i in range(10):
+                backend.write(({"uid": i, "writer": backend.writer_id} for _ in (1,)))
+
+        threads = [threading.Thread(target=_write, args=(b,)) for b in backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # unique, sortable names and no leftover temporary files
+        children = list(backends[0].get_children())
+        self.assertEqual(len(children), 40)
+        self.assertEqual(len(os.listdir("./testdata/aof")), 41)  # + lock
+        name = os.path.basename(sorted(c[1] for c in children)[0])
+        ts, writer_id, seq = name.split(".append")[0].rsplit("-", 2)
+        self.assertIsInstance(datetime.fromisoformat(ts), datetime)
+        self.assertIn(writer_id, ("writer0", "writer1", "writer2", "writer3"))
+        self.assertEqual(len(seq), 6)
+
+        # deterministic merge order: the last written segment wins
+        steps = backends[0].get_steps()
+        self.assertListEqual(steps, sorted(steps, key=os.path.basename))
+        last_writer = os.path.basename(steps[-1]).rsplit("-", 2)[1]
+        with dataset.connect("sqlite:///:memory:") as tx:
+            table = tx["data"]
+            backends[1].load(table)
+            self.assertEqual(len(table), 10)
+            self.assertEqual(table.find_one(uid=9)["writer"], last_writer)
+
+    def test_concurrent_segments(self):
+        # segments with the same timestamp are ordered by writer id + sequence
+        backend = AppendOnlyBackend("./testdata/aof", unique="uid")
+        ts = "2021-01-01T00:00:00.000000"
+        for name, value in (
+            (f"{ts}-b-000000.append", "b0"),
+            (f"{ts}-a-000001.append", "a1"),
+            (f"{ts}-a-000000.append", "a0"),
+        ):
+            backend.save(name, f"uid,value\n1,{value}\n")
+        with dataset.connect("sqlite:///:memory:") as tx:
+            table = tx["data"]
+            backend.load(table)
+            self.assertEqual(table.find_one(uid=1)["value"], "b0")
+
+    def test_parallel_load(self):
+        backend = AppendOnlyBackend("./testdata/aof", unique="uid")
+        for i in range(6):
+            rows = [
+                {"uid": j, "step": i, f"key{i}": "x", "last": None}
+                for j in range(i, 20)
+            ]
+            # repeated rows in a segment are merged in order
+            rows.append({"uid": 1, "step": i, f"key{i}": None, "last": i})
+            backend.write(iter(rows))
+        backend.write(iter([{"uid": 2, "step": "partial", "__mmmeta_keys": "step"}]))
+        results = []
+        for workers in (1, 3):
+            backend.workers = workers
+            with dataset.connect("sqlite:///:memory:") as tx:
+                table = tx["data"]
+                backend.load(table)
+                results.append(sorted(table.find(), key=lambda r: int(r["uid"])))
+        self.assertListEqual(results[0], results[1])
+        data = {r["uid"]: r for r in results[1]}
+        self.assertEqual(len(data), 20)
+        self.assertEqual(data["1"]["last"], "5")
+        self.assertEqual(data["1"]["key0"], None)
+        self.assertEqual(data["3"]["key0"], "x")
+        self.assertEqual(data["2"]["step"], "partial")
+        self.assertEqual(data["19"]["step"], "5")
+
+    def test_squash_retention(self):
+        backend = AppendOnlyBackend("./testdata/aof", unique="uid")
+        old, new = "2020-01-01 00:00:00", "2030-01-01 00:00:00"
+        rows = [{"uid": i, "__deleted": None, "__deleted_at": None} for i in range(5)]
+        backend.write(iter(rows))
+        backend.squash()
+        rows = [
+            {"uid": 1, "__deleted": 1, "__deleted_at": old},
+            {"uid": 2, "__deleted": 1, "__deleted_at": new},
+        ]
+        backend.write(iter(rows))
+        squashed = []
+        backend.squash(
+            purge_before=datetime(2021, 1, 1), history=1, on_squashed=squashed.append
+        )
+        with dataset.connect("sqlite:///:memory:") as tx:
+            table = tx["data"]
+            backend.load(table)
+            self.assertSetEqual({r["uid"] for r in table}, {"0", "2", "3", "4"})
+        self.assertEqual(len(squashed), 1)
+        # older segments are removed
+        children = list(backend.get_children())
+        self.assertEqual(len(children), 1)
+        self.assertTrue(children[0][1].endswith(".squashed"))
+        self.assertNotIn("1", backend.get_uids())
+
+        # all purged, an empty squashed segment cuts off the history
+        rows = [{"uid": i, "__deleted": 1, "__deleted_at": old} for i in (0, 3, 4)]
+        backend.write(iter(rows))
+        backend.squash(purge_before=datetime(2040, 1, 1))
+        with dataset.connect("sqlite:///:memory:") as tx:
+            table = tx["data"]
+            backend.load(table)
+            self.assertEqual(len(table), 0)
+        self.assertEqual(len(list(backend.get_children())), 3)
+
+    @unittest.skipIf(fcntl is None, "requires fcntl")
+    def test_lock(self):
+        backend = AppendOnlyBackend("./testdata/aof", unique="uid")
+        lock_path = backend.get_path(".lock")
+        with backend.lock(exclusive=True):
+            # other writers can't acquire a (shared) lock meanwhile
+            with open(lock_path) as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        with backend.lock():
+            with open(lock_path) as f:
+                # shared locks are possible concurrently
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        # readers keep squash from removing the segments while loading
+        backend.write(iter([{"uid": 1}]))
+        load_step = backend.load_step
+
+        def _load_step(path):
+            with open(lock_path) as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return load_step(path)
+
+        with dataset.connect("sqlite:///:memory:") as tx:
+            table = tx["data"]
+            with patch.object(backend, "load_step", _load_step):
+                self.assertGreater(backend.load(table), 0)
+            self.assertEqual(len(table), 1)
+
+    def test_uids(self):
+        os.makedirs("./testdata/aof")
+        path = write_uids("./testdata/aof/uids", ["b", "ab", "a", "c", 10, "ä"])
+        index = UidIndex(path)
+        self.assertEqual(len(index), 6)
+        for uid in ("a", "ab", "b", "c", "10", 10, "ä"):
+            self.assertIn(uid, index)
+        for uid in ("", "0", "aa", "abc", "bb", "d", "1"):
+            self.assertNotIn(uid, index)
+        self.assertSetEqual(
+            index.contains_many(["d", "a", "c", 10, "x", "ab"]), {"a", "c", 10, "ab"}
+        )
+        self.assertTrue(index.is_current())
+        index = UidIndex(write_uids(path, []))
+        self.assertNotIn("a", index)
+        self.assertSetEqual(index.contains_many(["a"]), set())
+
+        backend = AppendOnlyBackend("./testdata/aof", unique="uid")
+        with dataset.connect("sqlite:///:memory:") as tx:
+            table = tx["data"]
+            table.insert_many([{"uid": str(i), "__deleted": None} for i in range(100)])
+            table.update({"uid": "7", "__deleted": 1}, ["uid"])
+            backend.write(table)
+        os.remove(path)
+        # rebuilt from segments if missing
+        index = backend.get_uids()
+        self.assertEqual(len(index), 99)
+        self.assertIn("42", index)
+        self.assertNotIn("7", index)
+        self.assertIs(backend.get_uids(), index)
+        backend.squash()
+        self.assertFalse(index.is_current())
+        self.assertEqual(len(backend.get_uids()), 99)
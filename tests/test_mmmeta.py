@@ -1,23 +1,37 @@
 import copy
 import csv
+import gzip
+import io
 import json
+import multiprocessing
 import os
 import shutil
+import sqlite3
+import subprocess
+import sys
+import tracemalloc
 import unittest
-from datetime import datetime
+from contextlib import closing
+from datetime import datetime, timedelta
 from importlib import reload
+from unittest.mock import patch
 
 import yaml
+from click.testing import CliRunner
 from dataset.database import Database
 from dataset.table import Table
 
-from mmmeta import mmmeta, settings
+from mmmeta import mmmeta, settings, statistics
+from mmmeta.backend.appendonly import AppendOnlyBackend
 from mmmeta.backend.filesystem import FilesystemBackend
 from mmmeta.backend.store import Store
+from mmmeta.cli import cli
 from mmmeta.config import Config
-from mmmeta.exceptions import StoreError, ValidationError
-from mmmeta.file import File
+from mmmeta.exceptions import ConfigError, StoreError, ValidationError
+from mmmeta.file import File, FilesWrapper
 from mmmeta.metadir import Metadir
+from mmmeta.shards import MARKER
+from mmmeta.stats import RunStats
 
 CONFIG = {
     "metadata": {
@@ -44,6 +58,18 @@ def create_config(data=""):
         yaml.dump(data, f)
 
 
+def _drain(worker):
+    m = mmmeta("./testdata")
+    processed = []
+    while True:
+        files = m.files.claim(2, worker=worker, imported=False)
+        if not files:
+            return processed
+        for file in files:
+            processed.append(file.uid)
+        m.files.ack(files, imported=True)
+
+
 class Test(unittest.TestCase):
     def get_m(self, config=""):
         """
@@ -103,6 +129,24 @@ class Test(unittest.TestCase):
         self.assertIn("foo", m._base_path)
         self.assertIn("bar", m._files_root)
 
+    def test_lazy_imports(self):
+        self.get_m(CONFIG)
+        code = (
+            "import sys;"
+            "from mmmeta.cli import cli;"
+            "cli(['--metadir', './testdata', 'inspect', '--stats'], standalone_mode=False);"
+            "heavy = ('dataset', 'sqlalchemy', 'structlog', 'boto3', 'alembic');"
+            "print(sorted(m for m in heavy if m in sys.modules))"
+        )
+        res = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        self.assertIn("files: 10", res.stdout)
+        self.assertTrue(res.stdout.strip().endswith("[]"), res.stdout)
+        self.assertEqual(mmmeta("./testdata").inspect()["files"], 10)
+        self.assertEqual(mmmeta("./testdata/empty").inspect()["files"], 0)
+        self.assertFalse(os.path.exists("./testdata/empty/_mmmeta/state.db"))
+
     def test_store(self):
         m = self.get_m()
         store = m.store
@@ -167,6 +211,104 @@ class Test(unittest.TestCase):
         count = len(meta.files)
         self.assertIn(f"INFO:mmmeta.db:Skipped {count} not changed files.", cm[1])
 
+    def test_stats(self):
+        m = self.get_m(CONFIG)
+        res = m.generate()
+        self.assertIsInstance(res, RunStats)
+        # behaves like the former result tuple
+        updated, added, invalid, deleted, skipped = res
+        self.assertEqual(skipped, 10)
+        self.assertEqual(res, (0, 0, 0, 0, 10))
+        self.assertFalse(any(res[:4]))
+        data = res.serialize()
+        self.assertEqual(data["command"], "generate")
+        self.assertEqual(data["total"], 10)
+        self.assertEqual(data["skipped"], 10)
+        for phase in ("segments", "load", "lookup", "diff", "write"):
+            self.assertIn(phase, data["phases"])
+        self.assertEqual(data["phases"]["load"]["rows"], 10)
+        self.assertGreater(data["phases"]["load"]["bytes"], 0)
+        self.assertGreater(data["phases"]["segments"]["bytes"], 0)
+
+        res = m.update()
+        data = res.serialize()
+        self.assertEqual(data["command"], "update")
+        for phase in ("segments", "cast", "lookup", "sweep", "commit"):
+            self.assertIn(phase, data["phases"])
+        self.assertEqual(data["phases"]["segments"]["rows"], 10)
+
+        runner = CliRunner()
+        result = runner.invoke(
+            cli, ["--metadir", "./testdata", "update", "--stats-json", "./stats.json"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        with open("./stats.json") as f:
+            data = json.load(f)
+        os.remove("./stats.json")
+        self.assertEqual(data["command"], "update")
+        self.assertEqual(data["total"], 10)
+        self.assertIn("rows_per_second", data["phases"]["lookup"])
+
+    def test_metrics(self):
+        m = self.get_m(CONFIG)
+        runner = CliRunner()
+        store_last_updated = m.store["store_last_updated"]
+        result = runner.invoke(
+            cli,
+            ["--metadir", "./testdata", "update", "--metrics-textfile", "./m.prom"],
+        )
+        self.assertEqual(result.exit_code, 0)
+        # the export doesn't count as a change of the metadir
+        self.assertEqual(m.store["store_last_updated"], store_last_updated)
+        with open("./m.prom") as f:
+            content = f.read()
+        os.remove("./m.prom")
+        self.assertIn("# TYPE mmmeta_run_success gauge", content)
+        metrics = {}
+        for line in content.splitlines():
+            if not line.startswith("#"):
+                key, value = line.rsplit(" ", 1)
+                metrics[key] = float(value)
+        labels = f'command="update",metadir="{m._base_path}"'
+        self.assertEqual(metrics[f"mmmeta_run_success{{{labels}}}"], 1)
+        self.assertEqual(metrics[f"mmmeta_table_files{{{labels}}}"], 10)
+        self.assertEqual(metrics[f'mmmeta_run_files{{{labels},result="skipped"}}'], 10)
+        self.assertIn(f"mmmeta_last_success_timestamp_seconds{{{labels}}}", metrics)
+        self.assertIn(
+            f'mmmeta_run_phase_duration_seconds{{{labels},phase="lookup"}}', metrics
+        )
+        self.assertEqual(metrics[f'mmmeta_segments{{metadir="{m._base_path}"}}'], 1)
+        self.assertGreater(
+            metrics[f'mmmeta_metadir_bytes{{metadir="{m._base_path}"}}'], 0
+        )
+        self.assertIn(
+            f'mmmeta_store_timestamp_seconds{{key="state_last_updated",metadir="{m._base_path}"}}',  # noqa
+            metrics,
+        )
+        last_success = metrics[f"mmmeta_last_success_timestamp_seconds{{{labels}}}"]
+
+        # a failed run keeps the last success, other commands write their own file
+        with patch.object(Metadir, "update", side_effect=RuntimeError):
+            result = runner.invoke(
+                cli,
+                [
+                    "--metadir",
+                    "./testdata",
+                    "update",
+                    "--metrics-textfile",
+                    "./m-{command}.prom",
+                ],
+            )
+        self.assertNotEqual(result.exit_code, 0)
+        with open("./m-update.prom") as f:
+            content = f.read()
+        os.remove("./m-update.prom")
+        self.assertIn(f"mmmeta_run_success{{{labels}}} 0.0", content)
+        self.assertIn(
+            f"mmmeta_last_success_timestamp_seconds{{{labels}}} {last_success!r}",
+            content,
+        )
+
     def test_file(self):
         meta = self.get_m()
         file = [f for f in meta.files][0]
@@ -194,6 +336,693 @@ class Test(unittest.TestCase):
         meta.files.insert({"content_hash": "foo"})
         self.assertEqual(len(meta.files), 11)
 
+    def test_find_columns(self):
+        m = self.get_m(CONFIG)
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        files = list(m.files.find(columns=["int_value", "foo"], chunk_size=3))
+        self.assertEqual(len(files), 10)
+        file = [f for f in files if f.uid == uid][0]
+        # projection pushed into the query, unique key always included
+        self.assertSetEqual(set(file._data), {"content_hash", "int_value"})
+        self.assertEqual(file["int_value"], 2)
+        # other columns are fetched lazily
+        self.assertIn("__meta_added", file)
+        self.assertEqual(
+            file["_file_name"], "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6.data.pdf"
+        )
+        self.assertGreater(len(file._data), 2)
+        # one query per chunk for the lazily fetched columns, not per file
+        files = list(m.files.find(columns=["int_value"], chunk_size=3))
+        with patch.object(
+            FilesWrapper, "_get_rows", autospec=True, side_effect=FilesWrapper._get_rows
+        ) as get_rows:
+            self.assertEqual(len({f["_file_name"] for f in files}), 10)
+        self.assertEqual(get_rows.call_count, 4)
+        # filters, ordering and limits
+        files = list(
+            m.files.find(
+                columns=["int_value"], order_by="-content_hash", _limit=2, int_value=2
+            )
+        )
+        expected = m.files.find(order_by="-content_hash", _limit=2, int_value=2)
+        self.assertListEqual([f.uid for f in files], [f.uid for f in expected])
+        # saving a projected file only updates the changed columns
+        file = list(m.files.find(columns=[], content_hash=uid))[0]
+        file["imported"] = True
+        file.save()
+        file = m.files.find_one(content_hash=uid)
+        self.assertTrue(file["imported"])
+        self.assertEqual(file["int_value"], 2)
+        self.assertEqual(len(list(m.files.find(chunk_size=1))), 10)
+
+        # dump only some columns
+        out = io.StringIO()
+        m.dump(out, columns=["content_hash", "int_value"], chunk_size=2)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 10)
+        self.assertListEqual(list(rows[0].keys()), ["content_hash", "int_value"])
+        result = CliRunner().invoke(
+            cli, ["--metadir", "./testdata", "dump", "-c", "int_value"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output.splitlines()[0], "int_value")
+
+    def test_ingest(self):
+        m = self.get_m(CONFIG)
+        records = [
+            m._backend.load_json(f"../{f.uid}.json") for f in m.files.find(columns=[])
+        ]
+        segments = len(list(m._metadata.get_children()))
+        # nothing changed
+        res = m.ingest(records)
+        self.assertEqual(res[-1], 10)
+        self.assertFalse(res.changed)
+        self.assertEqual(len(list(m._metadata.get_children())), segments)
+
+        uid = records[0]["content_hash"]
+        records[0]["int_value"] = 42
+        new = {**records[1], "content_hash": "new", "_file_name": "new.pdf"}
+        invalid = {"content_hash": "invalid"}
+        res = m.ingest(iter(records[1:] + [records[0], new, invalid]))
+        self.assertEqual(res.command, "ingest")
+        self.assertTupleEqual(res.as_tuple(), (1, 1, 1, 0, 9))
+        self.assertEqual(len(list(m._metadata.get_children())), segments + 1)
+        self.assertTrue(m.contains("new"))
+        m.update()
+        self.assertEqual(len(m), 11)
+        self.assertEqual(m.files.find_one(content_hash=uid)["int_value"], 42)
+
+        # chunked with soft deletion of files not ingested
+        records[0]["int_value"] = 43
+        res = m.ingest((r for r in records[:5]), ensure=True, chunk_size=2)
+        self.assertTupleEqual(res.as_tuple(), (1, 0, 0, 6, 4))
+        # 1 segment for the changed chunk, 1 for the deletions
+        self.assertEqual(len(list(m._metadata.get_children())), segments + 3)
+        m.update()
+        self.assertEqual(m.files.find_one(content_hash=uid)["int_value"], 43)
+        self.assertEqual(len(list(m.files.find(__deleted=None))), 5)
+        self.assertFalse(m.contains("new"))
+        # same result after squashing
+        m.squash()
+        m.update()
+        self.assertEqual(len(list(m.files.find(__deleted=None))), 5)
+
+    def test_generate_ndjson(self):
+        m = self.get_m(CONFIG)
+        records = [m._backend.load_json(f"../{f.uid}.json") for f in m.files]
+        records[0]["int_value"] = 42
+        content = "\n".join(json.dumps(r) for r in records[:5])
+        runner = CliRunner()
+        args = ["--metadir", "./testdata", "generate", "--from-ndjson", "-"]
+        result = runner.invoke(
+            cli,
+            args + ["--ensure", "--chunk-size", "2"],
+            input=gzip.compress(content.encode()),
+        )
+        self.assertEqual(result.exit_code, 0)
+        m.update()
+        self.assertEqual(len(list(m.files.find(__deleted=None))), 5)
+        self.assertEqual(
+            m.files.find_one(content_hash=records[0]["content_hash"])["int_value"], 42
+        )
+
+        records[1]["int_value"] = 43
+        with open("./testdata/records.ndjson", "w") as f:
+            f.write("\n".join(json.dumps(r) for r in records[:5]))
+            # other json values than objects are skipped
+            f.write('\n[]\n1\n"x"\nnull\n')
+        result = runner.invoke(
+            cli,
+            args[:-1]
+            + ["./testdata/records.ndjson", "--stats-json", "./testdata/stats.json"],
+        )
+        self.assertEqual(result.exit_code, 0)
+        with open("./testdata/stats.json") as f:
+            self.assertEqual(json.load(f)["updated"], 1)
+        m.update()
+        self.assertEqual(
+            m.files.find_one(content_hash=records[1]["content_hash"])["int_value"], 43
+        )
+        result = runner.invoke(cli, args + ["--no-meta"], input="")
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_contains(self):
+        m = self.get_m(CONFIG)
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        self.assertTrue(m.contains(uid))
+        self.assertFalse(m.contains("foo"))
+        self.assertSetEqual(m.contains_many([uid, "foo"]), {uid})
+        # works without a state db
+        os.remove("./testdata/_mmmeta/state.db")
+        m = mmmeta("./testdata")
+        self.assertTrue(m.contains(uid))
+        # deleted files
+        os.remove(f"./testdata/{uid}.json")
+        m.generate(ensure_metadata=True)
+        self.assertFalse(m.contains(uid))
+        self.assertEqual(len(m.contains_many(f.uid for f in m.files)), 0)
+        m.update()
+        self.assertEqual(len(m.contains_many(f.uid for f in m.files)), 9)
+        m.squash()
+        self.assertFalse(m.contains(uid))
+        self.assertEqual(len(m.contains_many(f.uid for f in m.files)), 9)
+        # a segment appended by another writer during generate is not lost
+        from mmmeta import db
+
+        generate = db._generate
+
+        def _other_writer(*args, **kwargs):
+            other = AppendOnlyBackend(m._metadata.base_path, "content_hash", "b")
+            other.write(iter([{"content_hash": "fromB"}]))
+            return generate(*args, **kwargs)
+
+        path = "./testdata/002b636979907f06222dd6454180e09a68374ed6.json"
+        with open(path) as f:
+            data = json.load(f)
+        data["title"] = "changed"
+        with open(path, "w") as f:
+            json.dump(data, f)
+        with patch("mmmeta.db._generate", _other_writer):
+            stats = m.generate()
+        self.assertEqual(stats.counters["updated"], 1)
+        self.assertTrue(mmmeta("./testdata").contains("fromB"))
+        # the statistics include the files of the other writer as well
+        self.assertEqual(statistics.read_file(m._metadata)["total"], stats.total + 1)
+        # a segment appended after the index was written invalidates it
+        self.assertFalse(m.contains("other"))
+        m._metadata.write(iter([{"content_hash": "other"}]))
+        self.assertTrue(m.contains("other"))
+
+    def test_statistics(self):
+        config = {**CONFIG, "statistics": {"facets": ["int_value", "bool_value"]}}
+        m = self.get_m(config)
+        res = m.inspect(stats=True)
+        self.assertEqual(res["statistics"]["total"], 10)
+        self.assertEqual(res["statistics"]["active"], 10)
+        self.assertEqual(res["statistics"]["deleted"], 0)
+        self.assertEqual(res["statistics"]["facet:int_value:2"], 10)
+        self.assertEqual(res["meta_statistics"]["active"], 10)
+
+        # incremental changes equal a full recompute
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        os.remove(f"./testdata/{uid}.json")
+        path = "./testdata/002b636979907f06222dd6454180e09a68374ed6.json"
+        with open(path) as f:
+            data = json.load(f)
+        data["int_value"] = 3
+        with open(path, "w") as f:
+            json.dump(data, f)
+        m.generate(ensure_metadata=True)
+        m.update()
+        res = m.inspect(stats=True)
+        expected = statistics.compute(m._db["files"], m.config.facets)
+        self.assertDictEqual(res["statistics"], expected)
+        self.assertEqual(res["statistics"]["deleted"], 1)
+        self.assertEqual(res["statistics"]["active"], 9)
+        self.assertEqual(res["statistics"]["facet:int_value:2"], 8)
+        self.assertEqual(res["statistics"]["facet:int_value:3"], 1)
+        self.assertEqual(res["meta_statistics"]["active"], 9)
+        m.update(cleanup=True)
+        self.assertDictEqual(m.inspect(stats=True)["statistics"], expected)
+
+        runner = CliRunner()
+        result = runner.invoke(cli, ["--metadir", "./testdata", "inspect", "--stats"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("statistics:\n", result.output)
+        self.assertIn("  facet:int_value:3: 1\n", result.output)
+
+        # only metadata keys, consumer columns are not accounted
+        create_config({**CONFIG, "statistics": {"facets": ["int_value", "imported"]}})
+        self.assertRaises(ConfigError, lambda: mmmeta("./testdata"))
+
+    def test_update_swap(self):
+        from mmmeta import db
+
+        m = self.get_m(CONFIG)
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        file = m.files.find_one(content_hash=uid)
+        file["imported"] = True
+        file.save()
+        seen = file["__seen"]
+        claimed = m.files.claim(2)
+        path = "./testdata/002b636979907f06222dd6454180e09a68374ed6.json"
+        with open(path) as f:
+            data = json.load(f)
+        data["title"] = "changed"
+        with open(path, "w") as f:
+            json.dump(data, f)
+        m.generate()
+
+        update_state = db._update_state
+
+        def _concurrent_consumer(tx, *args):
+            # live state db is readable and writable during the update
+            self.assertEqual(len(m.files), 10)
+            other = m.files.find_one(content_hash=claimed[1].uid)
+            other["imported"] = False
+            other.save()
+            m.files.insert({"content_hash": "consumer", "imported": True})
+            return update_state(tx, *args)
+
+        copy_consumer_columns = db._copy_consumer_columns
+
+        def _write_during_swap(*args):
+            copy_consumer_columns(*args)
+            # consumers can't write between the copy and the new state
+            path = "./testdata/_mmmeta/state.db"
+            with closing(sqlite3.connect(path, timeout=0)) as conn:
+                with self.assertRaisesRegex(sqlite3.OperationalError, "locked"):
+                    conn.execute("UPDATE files SET imported = 0")
+
+        with patch("mmmeta.db._update_state", _concurrent_consumer), patch(
+            "mmmeta.db._copy_consumer_columns", _write_during_swap
+        ):
+            stats = m.update(swap=True)
+        self.assertEqual(stats.counters["updated"], 1)
+        self.assertIn("swap", stats.phases)
+        self.assertEqual(m.files.find_one(content_hash=uid)["imported"], True)
+        # update owned columns are not copied back from the live db
+        self.assertGreater(m.files.find_one(content_hash=uid)["__seen"], seen)
+        changed = m.files.find_one(
+            content_hash="002b636979907f06222dd6454180e09a68374ed6"
+        )
+        self.assertEqual(changed["title"], "changed")
+        # consumer changes during the update are kept
+        self.assertEqual(
+            m.files.find_one(content_hash=claimed[1].uid)["imported"], False
+        )
+        self.assertTrue(m.files.find_one(content_hash="consumer")["imported"])
+        self.assertEqual(m.files.release(claimed), 2)
+        self.assertFalse(
+            any(p.endswith(".tmp") for p in os.listdir("./testdata/_mmmeta"))
+        )
+        self.assertEqual(m.inspect(stats=True)["statistics"]["active"], 10)
+
+        # replace and cli
+        runner = CliRunner()
+        result = runner.invoke(
+            cli, ["--metadir", "./testdata", "update", "--swap", "--replace"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(m.files), 10)
+        self.assertIsNone(m.files.find_one(content_hash=uid)["imported"])
+        # a swapped update can't resume from chunks
+        self.assertRaises(ValueError, m.update, swap=True, chunk_size=2)
+        result = runner.invoke(
+            cli, ["--metadir", "./testdata", "update", "--swap", "--chunk-size", "2"]
+        )
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_update_resume(self):
+        from mmmeta import db
+
+        m = self.get_m(CONFIG)
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        os.remove(f"./testdata/{uid}.json")
+        path = "./testdata/009855e01610aecd6b363b9f205658a16f664f18.json"
+        with open(path) as f:
+            data = json.load(f)
+        data["title"] = "changed"
+        with open(path, "w") as f:
+            json.dump(data, f)
+        m.generate(ensure_metadata=True)
+
+        upsert = db._upsert
+        calls = []
+
+        def _crash(*args, **kwargs):
+            calls.append(args[2])
+            if len(calls) == 3:
+                raise MemoryError
+            return upsert(*args, **kwargs)
+
+        with patch("mmmeta.db._upsert", _crash):
+            self.assertRaises(MemoryError, lambda: m.update(chunk_size=3))
+        checkpoint = m._db[db.CHECKPOINT].find_one()
+        self.assertEqual(checkpoint["offset"], 6)
+        # the first chunks are committed
+        self.assertIsNotNone(m.files.find_one(content_hash=uid)["__deleted"])
+        changed = m.files.find_one(
+            content_hash="009855e01610aecd6b363b9f205658a16f664f18"
+        )
+        self.assertNotEqual(changed["title"], "changed")
+
+        calls.clear()
+        with patch("mmmeta.db._upsert", _crash):
+            stats = m.update(chunk_size=3)
+        self.assertListEqual([len(c) for c in calls], [3, 1])
+        self.assertEqual(stats.counters["updated"], 1)
+        self.assertEqual(stats.counters["deleted"], 0)
+        self.assertEqual(stats.total, 10)
+        self.assertFalse(m._db.has_table(db.CHECKPOINT))
+        self.assertFalse(m._db.has_table("meta_files"))
+        self.assertIsNotNone(m.files.find_one(content_hash=uid)["__deleted"])
+        changed = m.files.find_one(
+            content_hash="009855e01610aecd6b363b9f205658a16f664f18"
+        )
+        self.assertEqual(changed["title"], "changed")
+        self.assertEqual(changed["__state_changed"], changed["__state_last_updated"])
+        expected = statistics.compute(m._db["files"], m.config.facets)
+        self.assertDictEqual(m.inspect(stats=True)["statistics"], expected)
+
+    def test_generate_tempdir(self):
+        m = self.get_m(CONFIG)
+
+        def _data():
+            return {
+                f.uid: {k: v for k, v in f.serialize().items() if k[:2] != "__"}
+                for f in m.files
+            }
+
+        expected = _data()
+        os.makedirs("./testdata/tmp")
+        stats = m.generate(replace=True, tempdir="./testdata/tmp", memory_limit="1M")
+        self.assertEqual(stats.counters["added"], 10)
+        m.squash(tempdir="./testdata/tmp")
+        self.assertListEqual(os.listdir("./testdata/tmp"), [])
+        m.update(replace=True)
+        self.assertDictEqual(_data(), expected)
+        with patch.dict(os.environ, {"MMMETA_MEMORY_LIMIT": "1M"}):
+            reload(settings)
+            with self.assertLogs("mmmeta.util", level="INFO") as cm:
+                m.generate()
+            self.assertIn("Using temporary database", cm.output[0])
+        reload(settings)
+
+    def test_invalid_aggregated(self):
+        m = self.get_m(CONFIG)
+        for i in range(8):
+            with open(f"./testdata/invalid{i}.json", "w") as f:
+                json.dump({"content_hash": f"invalid{i}", "_file_name": "x"}, f)
+        with open("./testdata/invalid8.json", "w") as f:
+            json.dump(
+                {"content_hash": "invalid8", "_file_name": "x", "foreign_id": "x"}, f
+            )
+        with self.assertLogs(level="WARNING") as cm:
+            stats = m.generate()
+        self.assertEqual(stats.counters["invalid"], 9)
+        errors = [o for o in cm.output if "not valid" in o]
+        self.assertEqual(len(errors), 6)
+        summary = [o for o in cm.output if "invalid files. Missing keys" in o]
+        self.assertEqual(len(summary), 2)
+        self.assertIn("8 invalid files", summary[0])
+        invalid = stats.serialize()["invalid_files"]
+        self.assertEqual(invalid[0]["missing"], ["foreign_id", "published_at"])
+        self.assertEqual(invalid[0]["count"], 8)
+        self.assertEqual(len(invalid[0]["examples"]), 5)
+        self.assertDictEqual(
+            invalid[1],
+            {"missing": ["published_at"], "count": 1, "examples": ["invalid8"]},
+        )
+
+    def test_log_queue(self):
+        code = (
+            "import logging, structlog;"
+            "from mmmeta.logging import configure_logging;"
+            "configure_logging('INFO', use_queue=True);"
+            "logging.getLogger('mmmeta.test').info('hello %s', 'queue');"
+            "structlog.get_logger('mmmeta.test').info('structured', a=1)"
+        )
+        res = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+            env={**os.environ, "LOG_FORMAT": "JSON"},
+        )
+        lines = [json.loads(line) for line in res.stdout.splitlines()]
+        self.assertEqual(lines[0]["message"], "hello queue")
+        self.assertEqual(lines[1]["message"], "structured")
+        self.assertEqual(lines[1]["a"], 1)
+
+    def test_profile(self):
+        import pstats
+
+        runner = CliRunner()
+        out = "./testdata/profile.prof"
+        result = runner.invoke(
+            cli,
+            ["--metadir", "./testdata", "--profile", "cpu", "--profile-out", out]
+            + ["generate"],
+        )
+        self.assertEqual(result.exit_code, 0)
+        functions = {f[2] for f in pstats.Stats(out).stats}
+        self.assertIn("_upsert", functions)
+
+        out = "./testdata/profile.txt"
+        result = runner.invoke(
+            cli,
+            ["--metadir", "./testdata", "--profile", "memory", "--profile-out", out]
+            + ["squash"],
+        )
+        self.assertEqual(result.exit_code, 0)
+        with open(out) as f:
+            report = f.read()
+        self.assertIn("## phases (net allocated)\nsquash: ", report)
+        self.assertIn("## top 25 allocations", report)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_sharded(self):
+        from mmmeta.shards import get_shard
+
+        m = self.get_m(CONFIG)
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        file = m.files.find_one(content_hash=uid)
+        file["imported"] = True
+        file.save()
+        feed = m.files.changed_since()
+        self.assertEqual(len(list(feed)), 10)
+        stats = m.update(shards=4)
+        self.assertEqual(m.shards, 4)
+        self.assertEqual(stats.counters["added"], 0)
+        self.assertEqual(stats.counters["updated"], 0)
+        self.assertEqual(stats.total, 10)
+        names = sorted(n for n in os.listdir("./testdata/_mmmeta") if ".db" in n)
+        self.assertListEqual(names[:4], [f"state.{i}-of-4.db" for i in range(4)])
+        self.assertNotIn("state.db", names)
+        # fan out over the shards
+        self.assertEqual(len(m.files), 10)
+        self.assertEqual(len(list(m.files)), 10)
+        self.assertEqual(m.inspect(stats=True)["files"], 10)
+        self.assertEqual(m.inspect(stats=True)["statistics"]["active"], 10)
+        # consumer data was migrated
+        file = m.files.find_one(content_hash=uid)
+        self.assertTrue(file["imported"])
+        self.assertTrue(
+            os.path.exists(f"./testdata/_mmmeta/state.{get_shard(uid, 4)}-of-4.db")
+        )
+        uids = [f.uid for f in m.files.find(order_by="content_hash")]
+        self.assertListEqual(uids, sorted(uids))
+        uids = [f.uid for f in m.files.find(order_by="-content_hash", _limit=3)]
+        self.assertListEqual(uids, sorted(uids, reverse=True)[:3])
+        self.assertEqual(len(list(m.files.find(_limit=4, _offset=8))), 2)
+        self.assertEqual(len(list(m.files.find(imported=True))), 1)
+        self.assertEqual(len(list(m.files.find(columns=["title"]))), 10)
+        out = io.StringIO()
+        m.dump(out)
+        self.assertEqual(len(out.getvalue().splitlines()), 11)
+        self.assertIsNotNone(m.state_last_updated)
+
+        # writes go to the shard of the file
+        other = m.files.find_one(content_hash={"not": uid}, imported=None)
+        other["imported"] = False
+        other.save()
+        self.assertFalse(m.files.find_one(content_hash=other.uid)["imported"])
+        claimed = m.files.claim(20, worker="a")
+        self.assertEqual(len(claimed), 10)
+        self.assertEqual(m.files.ack(claimed, imported=True), 10)
+        self.assertEqual(len(list(m.files.find(imported=True))), 10)
+
+        # parallel update of the shards
+        path = "./testdata/002b636979907f06222dd6454180e09a68374ed6.json"
+        with open(path) as f:
+            data = json.load(f)
+        data["title"] = "changed"
+        with open(path, "w") as f:
+            json.dump(data, f)
+        m.generate()
+        stats = m.update()
+        self.assertEqual(stats.counters["updated"], 1)
+        self.assertEqual(stats.total, 10)
+        # the segments are parsed once and routed to the shards
+        size = sum(os.path.getsize(s) for s in m._metadata.get_steps())
+        self.assertEqual(stats.phases["segments"].bytes, size)
+        self.assertEqual(stats.phases["segments"].rows, 10)
+        changed = m.files.find_one(
+            content_hash="002b636979907f06222dd6454180e09a68374ed6"
+        )
+        self.assertEqual(changed["title"], "changed")
+        self.assertTrue(changed["imported"])
+        changes = list(m.files.changed_since(feed.cursor))
+        self.assertListEqual([f.uid for f in changes], [changed.uid])
+        changes = list(m.files.changed_since(chunk_size=3))
+        self.assertEqual(len({f.uid for f in changes}), 10)
+        self.assertEqual(changes[-1].uid, changed.uid)
+        for kwargs in ({"swap": True}, {"chunk_size": 3}):
+            stats = m.update(**kwargs)
+            self.assertEqual(stats.counters["updated"], 0)
+            self.assertEqual(len(m.files), 10)
+
+        # back to a single state db via the cli
+        runner = CliRunner()
+        result = runner.invoke(
+            cli, ["--metadir", "./testdata", "update", "--shards", "1"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIsNone(m.shards)
+        self.assertEqual(len(m.files), 10)
+        self.assertEqual(len(list(m.files.find(imported=True))), 10)
+        self.assertTrue(os.path.exists("./testdata/_mmmeta/state.db"))
+
+    def test_reshard_interrupted(self):
+        from mmmeta import db
+
+        m = self.get_m(CONFIG)
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        file = m.files.find_one(content_hash=uid)
+        file["imported"] = True
+        file.save()
+        base = "./testdata/_mmmeta"
+        iter_chunks = db._iter_chunks
+        replace = os.replace
+
+        def _write_during_migration(*args):
+            # consumers can't write to the sources during the migration
+            with closing(sqlite3.connect(f"{base}/state.db", timeout=0)) as conn:
+                with self.assertRaisesRegex(sqlite3.OperationalError, "locked"):
+                    conn.execute("UPDATE files SET imported = 0")
+            return iter_chunks(*args)
+
+        def _crash(src, dst):
+            if dst.endswith("state.1-of-2.db"):
+                raise RuntimeError
+            return replace(src, dst)
+
+        # interrupted before the new layout is complete: the old one is kept
+        with patch("mmmeta.db._iter_chunks", _write_during_migration), patch(
+            "mmmeta.db.os.replace", _crash
+        ):
+            self.assertRaises(RuntimeError, m.update, shards=2)
+        self.assertTrue(os.path.exists(f"{base}/state.0-of-2.db"))
+        self.assertIsNone(m.shards)
+        self.assertEqual(len(m.files), 10)
+        m.update()
+        self.assertFalse(os.path.exists(f"{base}/state.0-of-2.db"))
+        self.assertFalse(os.path.exists(f"{base}/{MARKER}"))
+
+        # interrupted after the switch: the new layout is used
+        with patch("mmmeta.db._remove_db", side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, m.update, shards=2)
+        self.assertTrue(os.path.exists(f"{base}/state.db"))
+        self.assertEqual(m.shards, 2)
+        self.assertEqual(len(m.files), 10)
+        self.assertTrue(m.files.find_one(content_hash=uid)["imported"])
+        m.update()
+        self.assertFalse(os.path.exists(f"{base}/state.db"))
+        self.assertFalse(os.path.exists(f"{base}/{MARKER}"))
+        self.assertEqual(m.shards, 2)
+        self.assertEqual(len(m.files), 10)
+
+    def test_claim(self):
+        meta = self.get_m()
+        # the lease columns are created on the first claim only
+        self.assertNotIn("__lease_owner", meta.files.find_one())
+        for file in meta.files:
+            file["imported"] = False
+            file.save()
+        files = meta.files.claim(3, worker="a", imported=False)
+        self.assertEqual(len(files), 3)
+        self.assertTrue(all(f["__lease_owner"] == "a" for f in files))
+        # leased files are not claimed again
+        other = meta.files.claim(10, worker="b", imported=False)
+        self.assertEqual(len(other), 7)
+        self.assertFalse({f.uid for f in files} & {f.uid for f in other})
+        self.assertListEqual(meta.files.claim(worker="c"), [])
+        # release and re-claim
+        self.assertEqual(meta.files.release(other), 7)
+        other = meta.files.claim(10, worker="c", imported=False)
+        self.assertEqual(len(other), 7)
+        # ack with data that finishes the file
+        file = files[0]
+        last_updated = file["__state_last_updated"]
+        self.assertTrue(file.ack(imported=True))
+        self.assertIsNone(file["__lease_owner"])
+        file = meta.files.find_one(content_hash=file.uid)
+        self.assertTrue(file["imported"])
+        self.assertIsNone(file["__lease_owner"])
+        # acks don't count as state updates
+        self.assertEqual(file["__state_last_updated"], last_updated)
+        meta.files.release(other)
+        # expired leases can be claimed by another worker
+        files = meta.files.claim(2, lease=timedelta(0), worker="d", imported=False)
+        self.assertEqual(len(files), 2)
+        self.assertEqual(len(meta.files.claim(2, worker="e", imported=False)), 2)
+        # so the former lease holder can't finish them anymore
+        self.assertEqual(meta.files.ack(files, imported=True), 0)
+
+    def test_claim_parallel(self):
+        meta = self.get_m()
+        for file in meta.files:
+            file["imported"] = False
+            file.save()
+        with multiprocessing.get_context("spawn").Pool(4) as pool:
+            results = pool.map(_drain, ["w1", "w2", "w3", "w4"])
+        processed = [uid for res in results for uid in res]
+        # every file processed exactly once
+        self.assertEqual(len(processed), 10)
+        self.assertEqual(len(set(processed)), 10)
+        self.assertEqual(len(list(meta.files.find(imported=True))), 10)
+
+    def test_changed_since(self):
+        m = self.get_m(CONFIG)
+        changes = m.files.changed_since(chunk_size=3)
+        self.assertIsNone(changes.cursor)
+        files = list(changes)
+        self.assertEqual(len(files), 10)
+        self.assertEqual(len({f.uid for f in files}), 10)
+        cursor = changes.cursor
+        self.assertIsInstance(cursor, str)
+        # nothing changed since
+        self.assertListEqual(list(m.files.changed_since(cursor)), [])
+        m.update()
+        self.assertListEqual(list(m.files.changed_since(cursor)), [])
+        # local changes by consumers are not in the feed
+        files[0]["imported"] = True
+        files[0].save()
+        self.assertListEqual(list(m.files.changed_since(cursor)), [])
+
+        # change 1 file, delete another one
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        data = m._backend.load_json(f"../{uid}.json")
+        data["int_value"] = 3
+        m._backend.dump_json(f"../{uid}.json", data)
+        os.remove("./testdata/0056e789b42f3e5a08df08d28dcbe4ec843eeec9.json")
+        m.generate(ensure_metadata=True)
+        m.update()
+        changes = m.files.changed_since(cursor, chunk_size=1)
+        files = {f.uid: f for f in changes}
+        self.assertEqual(len(files), 2)
+        self.assertEqual(files[uid]["int_value"], 3)
+        self.assertIsNotNone(
+            files["0056e789b42f3e5a08df08d28dcbe4ec843eeec9"]["__deleted"]
+        )
+        self.assertListEqual(list(m.files.changed_since(changes.cursor)), [])
+        # filters
+        changes = m.files.changed_since(cursor, __deleted={"not": None})
+        self.assertEqual(len(list(changes)), 1)
+
+        # persist cursor in store
+        self.assertEqual(len(list(m.files.changed_since(store_key="feed"))), 10)
+        self.assertIsNotNone(m.store["feed"])
+        self.assertListEqual(list(m.files.changed_since(store_key="feed")), [])
+        # interrupted consumer continues after the last finished page
+        m.store["feed"] = cursor
+        for file in m.files.changed_since(chunk_size=1, store_key="feed"):
+            break
+        self.assertEqual(len(list(m.files.changed_since(store_key="feed"))), 2)
+        # uses an index for keyset pagination
+        self.assertTrue(m.files.has_index(["__state_changed", "content_hash"]))
+
     def test_config(self):
         m = self.get_m()
         self.assertIsInstance(m.config, Config)
@@ -277,6 +1106,46 @@ class Test(unittest.TestCase):
         self.assertEqual(res[3], 1)
         self.assertIn("soft deleted files", cm.output[0])
 
+    def test_retention(self):
+        config = {**CONFIG, "retention": {"tombstones": 0, "history": 1}}
+        m = self.get_m(config)
+        uid = "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6"
+        os.remove(f"./testdata/{uid}.json")
+        m.generate(ensure_metadata=True)
+        # a consumer that saw the deletion
+        self.assertEqual(m.update().counters["deleted"], 1)
+        feed = m.files.changed_since()
+        self.assertEqual(len(list(feed)), 10)
+        m.squash()
+        self.assertEqual(len(list(m._metadata.get_children())), 1)
+        self.assertEqual(statistics.read_file(m._metadata)["deleted"], 0)
+        # the purged file stays deleted in the state, without new changes
+        stats = m.update()
+        self.assertEqual(stats.counters["deleted"], 0)
+        self.assertEqual(stats.total, 10)
+        self.assertIsNotNone(m.files.find_one(content_hash=uid)["__deleted"])
+        self.assertListEqual(list(m.files.changed_since(feed.cursor)), [])
+        self.assertEqual(m.inspect(stats=True)["statistics"]["deleted"], 1)
+        self.assertEqual(m.generate(ensure_metadata=True).counters["deleted"], 0)
+
+        # a consumer that missed the deletion soft deletes it on its own
+        os.remove("./testdata/_mmmeta/state.db")
+        m.update()
+        remove = "0056e789b42f3e5a08df08d28dcbe4ec843eeec9"
+        os.remove(f"./testdata/{remove}.json")
+        m.generate(ensure_metadata=True)
+        m.squash()
+        stats = m.update()
+        self.assertEqual(stats.counters["deleted"], 1)
+        self.assertEqual(
+            m.files.find_one(content_hash=remove)["__deleted_reason"], "state-missing"
+        )
+
+        for retention in ({"tombstones": -1}, {"history": 0}, {"history": "all"}):
+            create_config({**CONFIG, "retention": retention})
+            with self.assertRaises(ConfigError):
+                mmmeta("./testdata")
+
     def test_generate_no_meta(self):
         # generate metadir from actual files, no json metadata
         create_config(
@@ -306,6 +1175,47 @@ class Test(unittest.TestCase):
                     file._data.keys(),
                 )
 
+    def test_generate_empty_file(self):
+        create_config({"metadata": {"file_name": "file_name"}})
+        os.makedirs("./testdata/empty", exist_ok=True)
+        open("./testdata/empty/empty.pdf", "w").close()
+        m = mmmeta("./testdata")
+        m.generate(path="./testdata/empty", replace=True, no_meta=True)
+        m.update(replace=True)
+        file = m.files.find_one(file_name="empty.pdf")
+        self.assertEqual(file["file_size"], 0)
+
+    def test_generate_hashing(self):
+        config = {
+            "metadata": {"unique": "content_hash", "file_name": "file_name"},
+            "hashing": {"algorithm": "sha256", "prehash": True},
+        }
+        create_config(config)
+        m = mmmeta("./testdata")
+        self.assertEqual(m.config.hash_algorithm, "sha256")
+        self.assertTrue(m.config.prehash)
+        m.generate(replace=True, no_meta=True)
+        m.update(replace=True)
+        file = m.files.find_one(
+            file_name="0011d580dcdff07f0c3a95ddc80b8fd545faa7d6.json"
+        )
+        self.assertEqual(len(file["content_hash"]), 64)
+        self.assertIn("content_prehash", file)
+        # nothing changed, so nothing is hashed again
+        with patch("mmmeta.db.checksum") as checksum:
+            res = m.generate(no_meta=True)
+        checksum.assert_not_called()
+        self.assertEqual(res[-1], 20)
+        # changed file is hashed again (and added with its new content hash)
+        with open("./testdata/0011d580dcdff07f0c3a95ddc80b8fd545faa7d6.json", "a") as f:
+            f.write(" ")
+        res = m.generate(no_meta=True)
+        self.assertEqual(res[1], 1)
+
+        config["hashing"]["algorithm"] = "md5"
+        create_config(config)
+        self.assertRaises(ConfigError, lambda: mmmeta("./testdata"))
+
     def test_other_files_root(self):
         # assert that no files are found in different root location
         m = mmmeta("./testdata", "./testdata/other_files")
@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+
+from mmmeta import mmmeta
+from mmmeta.backend import get_backend
+from mmmeta.backend.s3 import S3Backend
+from mmmeta.exceptions import ConfigError
+from mmmeta.util import get_files
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+    from moto import mock_aws
+except ImportError:  # pragma: no cover
+    mock_aws = None
+
+
+@unittest.skipIf(mock_aws is None, "`boto3` and `moto` required")
+class Test(unittest.TestCase):
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.mock = mock_aws()
+        self.mock.start()
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="archive")
+        # upload testdata metadata files to bucket
+        for _, fp in get_files("./testdata", suffix=".json"):
+            with open(fp, "rb") as f:
+                client.put_object(
+                    Bucket="archive", Key=f"files/{os.path.basename(fp)}", Body=f
+                )
+        client.put_object(Bucket="archive", Key="files/_mmmeta/foo.json", Body="{}")
+        if os.path.exists("./testdata/s3"):
+            shutil.rmtree("./testdata/s3")
+
+    def tearDown(self):
+        self.mock.stop()
+        if os.path.exists("./testdata/s3"):
+            shutil.rmtree("./testdata/s3")
+
+    def test_backend(self):
+        backend = get_backend("s3://archive/files")
+        self.assertIsInstance(backend, S3Backend)
+        self.assertEqual(str(backend), "s3://archive/files")
+        self.assertEqual(
+            backend.get_path("foo/bar.json"), "s3://archive/files/foo/bar.json"
+        )
+        self.assertEqual(backend.get_path("../other"), "s3://archive/other")
+
+        children = list(backend.get_children())
+        self.assertEqual(len(children), 11)
+        children = list(backend.get_children(exclude=("_mmmeta",), suffix=".json"))
+        self.assertEqual(len(children), 10)
+        name, path = children[0]
+        self.assertTrue(path.startswith("s3://archive/files/"))
+        self.assertTrue(path.endswith(f"{name}.json"))
+        self.assertTrue(backend.exists(path))
+        self.assertTrue(backend.exists("_mmmeta"))
+        self.assertFalse(backend.exists("not-existing"))
+        self.assertIsInstance(backend.load_json(path), dict)
+        self.assertRaises(FileNotFoundError, lambda: backend.load("not-existing"))
+
+        # prefetching keeps the order
+        paths = [p for _, p in children]
+        self.assertListEqual([p for p, _ in backend.load_many(paths, workers=3)], paths)
+
+        backend.save("store/key", 1)
+        self.assertEqual(backend.get_value("store/key"), 1)
+        backend.delete("store")
+        self.assertFalse(backend.exists("store/key"))
+
+        # paginated listing
+        backend.page_size = 3
+        client = backend.client
+        with patch.object(
+            client, "list_objects_v2", wraps=client.list_objects_v2
+        ) as list_objects:
+            children = list(backend.get_children())
+        self.assertEqual(len(children), 11)
+        self.assertEqual(len(set(children)), 11)
+        # 11 keys in pages of 3
+        self.assertEqual(list_objects.call_count, 4)
+        backend.page_size = None
+
+        # only missing objects count as not existing
+        error = ClientError({"Error": {"Code": "403"}}, "HeadObject")
+        with patch.object(client, "head_object", side_effect=error):
+            self.assertRaises(ClientError, lambda: backend.exists("_mmmeta"))
+
+        backend.delete()
+        self.assertEqual(len(list(backend.get_children())), 0)
+
+    def test_generate(self):
+        # read metadata directly from the archive
+        m = mmmeta("./testdata/s3", "s3://archive/files")
+        res = m.generate()
+        self.assertEqual(res[1], 10)
+        m.update()
+        self.assertEqual(len(m), 10)
+        data = json.loads(
+            get_backend("s3://archive/files").load(
+                "0011d580dcdff07f0c3a95ddc80b8fd545faa7d6.json"
+            )
+        )
+        file = m.files.find_one(content_hash=data["content_hash"])
+        self.assertEqual(file.uid, data["content_hash"])
+        # nothing changed
+        res = m.generate()
+        self.assertEqual(res[-1], 10)
+        # actual files only for local files roots
+        self.assertRaises(ConfigError, lambda: m.generate(no_meta=True))
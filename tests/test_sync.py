@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import unittest
+
+from click.testing import CliRunner
+
+from mmmeta import mmmeta
+from mmmeta.cli import cli
+from mmmeta.sync import MANIFEST, is_excluded
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        for path in (
+            "./testdata/archive",
+            "./testdata/consumer",
+            "./testdata/consumer2",
+        ):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        if os.path.exists("./testdata/_mmmeta"):
+            shutil.rmtree("./testdata/_mmmeta")
+        if os.path.exists("./testdata/new.json"):
+            os.remove("./testdata/new.json")
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_excluded(self):
+        for path in (
+            "state.db",
+            "state.db-journal",
+            "state.reshard",
+            ".manifest.json",
+            "db/.lock",
+            "db/foo.append.123.tmp",
+            "manifest.json",
+            "_store/state_last_updated",
+            "_store/store_last_updated",
+            "_store/update_last_success",
+            "db/uids",
+        ):
+            self.assertTrue(is_excluded(path))
+        for path in ("config.yml", "db/2021-01-01T00:00:00.append", "_store/foo"):
+            self.assertFalse(is_excluded(path))
+
+    def test_sync(self):
+        publisher = mmmeta("./testdata")
+        publisher.generate()
+        publisher.update()  # creates a local state.db
+        publisher.store["foo"] = "bar"
+        res = publisher.push("./testdata/archive")
+        self.assertEqual(res["transferred"], res["total"])
+
+        archive = "./testdata/archive/_mmmeta"
+        with open(os.path.join(archive, MANIFEST)) as f:
+            manifest = json.load(f)["files"]
+        self.assertIn("_store/foo", manifest)
+        self.assertTrue(any(p.endswith(".append") for p in manifest))
+        self.assertNotIn("db/uids", manifest)
+        self.assertIn("db/statistics", manifest)
+        # consumer-local files are never shipped
+        self.assertFalse(os.path.exists(os.path.join(archive, "state.db")))
+        self.assertFalse(any(p.startswith("state") for p in manifest))
+
+        # nothing changed
+        res = publisher.push("./testdata/archive")
+        self.assertEqual(res["transferred"], 0)
+
+        consumer = mmmeta("./testdata/consumer")
+        res = consumer.pull("./testdata/archive")
+        self.assertEqual(res["transferred"], len(manifest))
+        self.assertEqual(consumer.store["foo"], "bar")
+        consumer.update()
+        self.assertEqual(len(consumer), 10)
+
+        # publisher adds a segment, only this is transferred
+        with open("./testdata/new.json", "w") as f:
+            json.dump({"content_hash": "new"}, f)
+        publisher.generate()
+        res = publisher.push("./testdata/archive")
+        # new segment + statistics + touched store key
+        self.assertEqual(res["transferred"], 3)
+        self.assertFalse(consumer.contains("new"))
+        res = consumer.pull("./testdata/archive")
+        self.assertEqual(res["transferred"], 3)
+        # the local uid index is rebuilt with the pulled segment
+        self.assertTrue(consumer.contains("new"))
+        self.assertLess(res["bytes"], 1024)
+        consumer.update()
+        self.assertEqual(len(consumer), 11)
+        self.assertEqual(consumer.pull("./testdata/archive")["transferred"], 0)
+
+    def test_squashed(self):
+        publisher = mmmeta("./testdata")
+        publisher.generate()
+        publisher.push("./testdata/archive")
+        consumer = mmmeta("./testdata/consumer")
+        consumer.pull("./testdata/archive")
+
+        with open("./testdata/new.json", "w") as f:
+            json.dump({"content_hash": "new"}, f)
+        publisher.generate()
+        publisher._metadata.squash(history=1)
+        publisher.push("./testdata/archive")
+        with open(os.path.join("./testdata/archive/_mmmeta", MANIFEST)) as f:
+            manifest = json.load(f)["files"]
+        # pruned segments are dropped from the remote manifest
+        segments = [p for p in manifest if p.startswith("db/2")]
+        self.assertEqual(len(segments), 1)
+        self.assertTrue(segments[0].endswith(".squashed"))
+
+        res = consumer.pull("./testdata/archive")
+        # squashed segment + statistics + touched store key, not the pruned one
+        self.assertEqual(res["transferred"], 3)
+        self.assertEqual(len(list(consumer._metadata.get_children())), 2)
+        consumer.update()
+        self.assertEqual(len(consumer), 11)
+        other = mmmeta("./testdata/consumer2")
+        res = other.pull("./testdata/archive")
+        self.assertEqual(res["transferred"], len(manifest))
+        self.assertEqual(len(list(other._metadata.get_children())), 1)
+
+    def test_cli(self):
+        mmmeta("./testdata").generate()
+        runner = CliRunner()
+        result = runner.invoke(
+            cli, ["--metadir", "./testdata", "sync", "push", "./testdata/archive"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Pushed 3 of 3 files", result.output)
+        result = runner.invoke(
+            cli,
+            ["--metadir", "./testdata/consumer", "sync", "pull", "./testdata/archive"],
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Pulled 3 of 3 files", result.output)
+        result = runner.invoke(cli, ["--metadir", "./testdata", "sync", "push"])
+        self.assertNotEqual(result.exit_code, 0)
@@ -0,0 +1,182 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+
+from mmmeta import util
+from mmmeta.util import (
+    HASH_ALGORITHMS,
+    checksum,
+    get_files,
+    get_projection,
+    parse_size,
+    prehash,
+    read_ndjson,
+    robust_dict,
+    robust_projection,
+    tmp_db,
+    walk_files,
+)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("./testdata/walk"):
+            shutil.rmtree("./testdata/walk")
+        for d in ("a/b/c", "a/_mmmeta/db", "d"):
+            os.makedirs(os.path.join("./testdata/walk", d))
+        for fp in (
+            "root.json",
+            "a/1.json",
+            "a/1.pdf",
+            "a/b/2.json",
+            "a/b/c/3.json",
+            "a/_mmmeta/db/4.json",
+            "d/5.txt",
+        ):
+            with open(os.path.join("./testdata/walk", fp), "w") as f:
+                f.write(fp)
+
+    def tearDown(self):
+        if os.path.exists("./testdata/walk"):
+            shutil.rmtree("./testdata/walk")
+
+    def test_get_files(self):
+        files = list(get_files("./testdata/walk"))
+        self.assertEqual(len(files), 7)
+        self.assertIn(("root", "./testdata/walk/root.json"), files)
+        # same result as os.walk based implementation
+        self.assertSetEqual(
+            set(files),
+            set(
+                (os.path.splitext(f)[0], os.path.join(d, f))
+                for d, _, fnames in os.walk("./testdata/walk")
+                for f in fnames
+            ),
+        )
+        # legacy condition on full paths
+        files = list(get_files("./testdata/walk", lambda x: x.endswith(".pdf")))
+        self.assertListEqual(files, [("1", "./testdata/walk/a/1.pdf")])
+
+    def test_walk_files(self):
+        # prune excluded directories and match suffix on names
+        entries = list(
+            walk_files("./testdata/walk", exclude=("_mmmeta",), suffix=".json")
+        )
+        self.assertListEqual(
+            [e.name for e in entries], ["root.json", "1.json", "2.json", "3.json"]
+        )
+        self.assertTrue(all(isinstance(e, os.DirEntry) for e in entries))
+        entries = list(walk_files("./testdata/walk", suffix=(".pdf", ".txt")))
+        self.assertSetEqual(set(e.name for e in entries), {"1.pdf", "5.txt"})
+
+        # parallel walking yields the same files
+        sequential = set(e.path for e in walk_files("./testdata/walk"))
+        parallel = set(e.path for e in walk_files("./testdata/walk", workers=4))
+        self.assertEqual(len(parallel), 7)
+        self.assertSetEqual(sequential, parallel)
+
+    def test_checksum(self):
+        fp = "./testdata/walk/large.bin"
+        with open(fp, "wb") as f:
+            f.write(os.urandom(1024 * 100))
+        with open(fp, "rb") as f:
+            content = f.read()
+        for algorithm in HASH_ALGORITHMS:
+            self.assertEqual(
+                checksum(fp, algorithm), hashlib.new(algorithm, content).hexdigest()
+            )
+        self.assertEqual(checksum(fp), hashlib.sha1(content).hexdigest())
+        self.assertIsNone(checksum("./testdata/walk/not-existing"))
+        self.assertRaises(ValueError, lambda: checksum(fp, "md5"))
+
+        # large files are hashed via mmap
+        with patch("mmmeta.util.MMAP_THRESHOLD", 1024):
+            self.assertEqual(checksum(fp), hashlib.sha1(content).hexdigest())
+
+        # prehash only changes if size, mtime, head or tail change
+        value = prehash(fp, sample_size=1024)
+        self.assertEqual(value, prehash(fp, sample_size=1024))
+        mtime = os.stat(fp).st_mtime_ns
+        with open(fp, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\x00" if content[-1:] != b"\x00" else b"\x01")
+        os.utime(fp, ns=(mtime, mtime))
+        self.assertNotEqual(value, prehash(fp, sample_size=1024))
+
+    def test_read_ndjson(self):
+        content = b'{"a": 1}\n\n{"a": 2, "b": {"c": 3}}\nnot json\n{"a": 3}'
+        fp = "./testdata/walk/records.ndjson"
+        with open(fp, "wb") as f:
+            f.write(content)
+        with self.assertLogs("mmmeta.util", level="ERROR") as cm:
+            records = list(read_ndjson(fp))
+        self.assertIn("line 4", cm.output[0])
+        self.assertListEqual(records, [{"a": 1}, {"a": 2, "b": {"c": 3}}, {"a": 3}])
+        # gzip is detected by content
+        with gzip.open(fp, "wb") as f:
+            f.write(content)
+        with self.assertLogs("mmmeta.util", level="ERROR"):
+            self.assertEqual(len(list(read_ndjson(fp))), 3)
+        # stdin
+        stdin = io.TextIOWrapper(io.BytesIO(gzip.compress(b'{"a": 1}\n')))
+        with patch("sys.stdin", stdin):
+            self.assertListEqual(list(read_ndjson("-")), [{"a": 1}])
+
+    def test_tmp_db(self):
+        self.assertEqual(parse_size("512K"), 512 * 1024)
+        self.assertEqual(parse_size("1.5G"), 1536 * 1024**2)
+        self.assertEqual(parse_size("256mb"), 256 * 1024**2)
+        self.assertEqual(parse_size("1000"), 1000)
+        self.assertIsNone(parse_size(None))
+        with tmp_db() as tx:
+            self.assertEqual(tx.url, "sqlite:///:memory:")
+        tempdir = "./testdata/walk"
+        with tmp_db(tempdir, "1M") as tx:
+            path = tx.url[len("sqlite:///") :]
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(
+                os.path.dirname(os.path.abspath(path)), os.path.abspath(tempdir)
+            )
+            self.assertEqual(tx.query("PRAGMA cache_size").next()["cache_size"], -1024)
+            tx["files"].insert_many([{"uid": str(i)} for i in range(100)])
+            self.assertEqual(tx["files"].count(), 100)
+        self.assertFalse(os.path.exists(path))
+
+    def test_robust_projection(self):
+        data = {
+            "content_hash": "abc",
+            "title": "Title",
+            "empty": "",
+            "publisher": {"name": "Pub", "url": "https://", "meta-data": {"a": 1}},
+            "text-blob": "x" * 1000,
+            "provenance": {"steps": [{"a": 1}, {"b": [2, 3]}]},
+            "tags": ["a", "b"],
+            "amount": 1.5,
+            "big": 1e21,
+            "flag": False,
+        }
+        keys_list = (
+            {"content_hash"},
+            {"content_hash", "title", "publisher:name", "tags", "amount", "big"},
+            {"publisher", "publisher:meta_data:a", "provenance:steps", "empty"},
+            {"flag", "text_blob", "not:existing", "title:sub"},
+        )
+        content = json.dumps(data)
+        for keys in keys_list:
+            expected = {k: v for k, v in robust_dict(data).items() if k in keys}
+            projection = get_projection(keys)
+            self.assertDictEqual(robust_projection(data, projection), expected)
+            self.assertDictEqual(robust_projection(content, projection), expected)
+            # incremental parsing
+            with patch.object(util, "JSON_STREAM_THRESHOLD", 0):
+                self.assertDictEqual(robust_projection(content, projection), expected)
+                self.assertDictEqual(
+                    robust_projection(content.encode(), projection), expected
+                )
+        with patch.object(util, "JSON_STREAM_THRESHOLD", 0):
+            self.assertRaises(ValueError, robust_projection, "[]", {})